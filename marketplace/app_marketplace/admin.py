@@ -7,7 +7,7 @@ from .models import (
     ProductModel, ProductOnShopModel, FilesModel, TagsModel, ProductGroupModel,
     ReviewModel, CartProductModel, CartModel, OrderModel,
     ProductViewHistoryModel, PurchaseHistoryModel, DeliveryModel, PaymentModel,
-    StatusModel, BannerModel
+    StatusModel, BannerModel, EffectivePriceModel, StockReservationModel
 )
 from import_export.admin import (
     ImportExportModelAdmin, ExportMixin, ImportExportMixin
@@ -130,6 +130,16 @@ class ProductOnShopAdmin(ImportExportModelAdmin):
     search_fields = ('product__model',)
 
 
+@admin.register(EffectivePriceModel)
+class EffectivePriceAdmin(admin.ModelAdmin):
+    list_display = (
+        'id', 'product_on_shop', 'price', 'discount', 'valid_until'
+    )
+    ordering = ('id',)
+    list_display_links = ('id', 'product_on_shop')
+    search_fields = ('product_on_shop__product__model',)
+
+
 @admin.register(FilesModel)
 class FilesAdmin(admin.ModelAdmin):
     list_display = ('id', 'file', 'slug', 'is_active')
@@ -175,6 +185,14 @@ class CartProductAdmin(admin.ModelAdmin):
     search_fields = ('product', 'user',)
 
 
+@admin.register(StockReservationModel)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'product_on_shop', 'user', 'quantity', 'expires_at')
+    ordering = ('id',)
+    list_display_links = ('id', 'product_on_shop')
+    search_fields = ('product_on_shop__product__model',)
+
+
 @admin.register(CartModel)
 class CartAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'quantity', 'total_price', 'status')
@@ -198,7 +216,7 @@ class OrderAdmin(ExportMixin, admin.ModelAdmin):
 
 @admin.register(ProductViewHistoryModel)
 class ProductViewHistoryAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'product')
+    list_display = ('id', 'user', 'product', 'viewed_at')
     ordering = ('id',)
     list_display_links = ('id', 'user', 'product')
     search_fields = ('user', 'product')
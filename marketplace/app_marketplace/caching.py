@@ -0,0 +1,201 @@
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import caches
+from django_redis import get_redis_connection
+from django_redis.cache import RedisCache
+
+_MISSING = object()
+
+
+class CacheStats:
+    """Счетчики обращений к кэшу в текущем процессе."""
+    fields = ('hits', 'misses', 'stale', 'refreshes', 'waits', 'wait_time')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(self.fields, 0)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict.fromkeys(self.fields, 0)
+
+
+cache_stats = CacheStats()
+
+
+def get_or_set(key, compute, timeout, cache_alias='default', beta=1.0,
+               stale_time=None, depends_on=None):
+    """
+    Получение значения из кэша с защитой от одновременного пересчета.
+
+    При попадании выполняется одно обращение к кэшу. При промахе значение
+     пересчитывает только процесс, получивший блокировку по ключу, остальные
+      ждут его результат. После истечения timeout значение еще stale_time
+       секунд отдается устаревшим, пока один процесс его обновляет. Чем
+        ближе срок истечения, тем выше вероятность раннего пересчета
+         (коэффициент beta, 0 - отключить ранний пересчет).
+
+    depends_on - список зависимостей (см. dependency) или функция,
+     возвращающая его по вычисленному значению. При изменении любой из
+      зависимостей ключ удаляется функцией invalidate.
+    """
+    if not timeout:
+        return compute()
+    cache = caches[cache_alias]
+    lock_key = 'lock:{}'.format(key)
+    entry = cache.get(key, _MISSING)
+
+    if entry is not _MISSING:
+        value, expires_at, compute_time = entry
+        early = compute_time * beta * math.log(1 - random.random())
+        if time.time() - early < expires_at:
+            cache_stats.incr('hits')
+            return value
+        # Значение устарело: обновляет один процесс, остальные получают
+        # устаревшее значение без ожидания
+        if not cache.add(lock_key, 1, settings.CACHE_LOCK_TIMEOUT):
+            cache_stats.incr('stale')
+            return value
+        cache_stats.incr('refreshes')
+        try:
+            return _compute_and_set(
+                cache_alias, key, compute, timeout, stale_time, depends_on
+            )
+        finally:
+            cache.delete(lock_key)
+
+    cache_stats.incr('misses')
+    if cache.add(lock_key, 1, settings.CACHE_LOCK_TIMEOUT):
+        try:
+            return _compute_and_set(
+                cache_alias, key, compute, timeout, stale_time, depends_on
+            )
+        finally:
+            cache.delete(lock_key)
+
+    # Значение пересчитывает другой процесс - ожидаем результат
+    cache_stats.incr('waits')
+    started = time.monotonic()
+    while time.monotonic() - started < settings.CACHE_LOCK_WAIT_TIME:
+        time.sleep(0.05)
+        entry = cache.get(key, _MISSING)
+        if entry is not _MISSING:
+            break
+    cache_stats.incr('wait_time', time.monotonic() - started)
+    if entry is not _MISSING:
+        return entry[0]
+    return _compute_and_set(
+        cache_alias, key, compute, timeout, stale_time, depends_on
+    )
+
+
+def set_value(key, value, timeout, cache_alias='default', stale_time=None,
+              compute_time=0.0, depends_on=None):
+    """Запись значения в кэш в формате, который читает get_or_set."""
+    if stale_time is None:
+        stale_time = settings.CACHE_STALE_TIME
+    caches[cache_alias].set(
+        key, (value, time.time() + timeout, compute_time),
+        timeout + stale_time
+    )
+    if callable(depends_on):
+        depends_on = depends_on(value)
+    if depends_on:
+        register_dependencies(cache_alias, key, depends_on)
+
+
+def _compute_and_set(cache_alias, key, compute, timeout, stale_time,
+                     depends_on):
+    started = time.monotonic()
+    value = compute()
+    set_value(
+        key, value, timeout, cache_alias=cache_alias, stale_time=stale_time,
+        compute_time=time.monotonic() - started, depends_on=depends_on
+    )
+    return value
+
+
+def dependency(model, pk=None, **lookup):
+    """
+    Зависимость фрагмента кэша: объект модели (pk), объекты модели с
+     заданным значением поля (например, product_id=1) или вся таблица
+      (без аргументов).
+    """
+    if pk is not None:
+        lookup = {'pk': pk}
+    if not lookup:
+        return '{}:*'.format(model._meta.label_lower)
+    (field, value), = lookup.items()
+    return '{}:{}={}'.format(model._meta.label_lower, field, value)
+
+
+def register_dependencies(cache_alias, key, dependencies):
+    """
+    Запоминаем, что ключ key кэша cache_alias зависит от dependencies.
+     Для каждой зависимости в Redis хранится множество зависящих от нее
+      ключей; все множества обновляются одним запросом. Если кэш
+       зависимостей не Redis (например, LocMemCache), множества хранятся
+        обычными значениями кэша.
+    """
+    cache = caches[settings.CACHE_DEPENDENCY_ALIAS]
+    member = '{}:{}'.format(cache_alias, key)
+    if not isinstance(cache, RedisCache):
+        names = ['deps:{}'.format(name) for name in set(dependencies)]
+        members = cache.get_many(names)
+        cache.set_many({
+            name: members.get(name, set()) | {member} for name in names
+        }, settings.CACHE_DEPENDENCY_TIME)
+        return
+    pipeline = get_redis_connection(
+        settings.CACHE_DEPENDENCY_ALIAS).pipeline(transaction=False)
+    for name in set(dependencies):
+        dependency_key = cache.make_key('deps:{}'.format(name))
+        pipeline.sadd(dependency_key, member)
+        pipeline.expire(dependency_key, settings.CACHE_DEPENDENCY_TIME)
+    pipeline.execute()
+
+
+def invalidate(dependencies):
+    """
+    Удаление всех ключей, зависящих от dependencies. Множества ключей
+     читаются и удаляются одной транзакцией, затем ключи удаляются одним
+      запросом для каждого кэша.
+    """
+    dependencies = set(dependencies)
+    if not dependencies:
+        return
+    cache = caches[settings.CACHE_DEPENDENCY_ALIAS]
+    if isinstance(cache, RedisCache):
+        dependency_keys = [
+            cache.make_key('deps:{}'.format(name)) for name in dependencies
+        ]
+        pipeline = get_redis_connection(
+            settings.CACHE_DEPENDENCY_ALIAS).pipeline()
+        for dependency_key in dependency_keys:
+            pipeline.smembers(dependency_key)
+        pipeline.delete(*dependency_keys)
+        *members, _ = pipeline.execute()
+        members = {member.decode() for member in set().union(*members)}
+    else:
+        names = ['deps:{}'.format(name) for name in dependencies]
+        members = set().union(*cache.get_many(names).values())
+        cache.delete_many(names)
+
+    keys = defaultdict(set)
+    for member in members:
+        cache_alias, key = member.split(':', 1)
+        keys[cache_alias].add(key)
+    for cache_alias, cache_keys in keys.items():
+        caches[cache_alias].delete_many(list(cache_keys))
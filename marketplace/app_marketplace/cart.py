@@ -1,73 +1,254 @@
+import uuid
 from decimal import Decimal
-from app_marketplace.models import ProductOnShopModel
+from app_marketplace.models import CartModel, ProductOnShopModel
 from django.conf import settings
-import copy
+from django.core.cache import caches
+from django.db import transaction
+
+KOPECKS = Decimal(100)
+CART_SUMMARY_SALT = 'app_marketplace.cart_summary'
+
+
+def to_kopecks(price) -> int:
+    """Цена в целых копейках."""
+    return int((Decimal(price) * KOPECKS).to_integral_value())
+
+
+def from_kopecks(kopecks) -> Decimal:
+    return (Decimal(kopecks) / KOPECKS).quantize(Decimal('0.01'))
 
 
 class Cart:
-    """Инициализируем корзину."""
+    """
+    Корзина в сессии. Хранится компактно: {'items': [[id товара магазина,
+     количество, цена в копейках], ...], 'count': количество товаров,
+      'total': сумма в копейках}. Количество и сумма пересчитываются при
+       изменении корзины, поэтому для значка корзины в шапке не нужны ни
+        запросы к базе данных, ни обход товаров. Товары магазинов
+         загружаются одним запросом только при обходе корзины.
+    """
     def __init__(self, request):
         self.session = request.session
-        cart = self.session.get(settings.CART_SESSION_ID)
-        if not cart:
-            cart = self.session[settings.CART_SESSION_ID] = {}
-        self.cart = cart
+        data = self.session.get(settings.CART_SESSION_ID)
+        if data is not None and 'items' not in data:
+            data = self.convert(data)
+        self.data = data or {'items': [], 'count': 0, 'total': 0}
+        self._items = None
+        self._products = None
 
-    def __iter__(self):
-        product_ids = self.cart.keys()
-        products = ProductOnShopModel.objects.filter(id__in=product_ids)
-        cart = copy.deepcopy(self.cart)
+    @staticmethod
+    def convert(data) -> dict:
+        """Перевод корзины из прежнего формата {'id': {'price', 'qty'}}."""
+        items = [
+            [int(product_id), item['qty'], to_kopecks(item['price'])]
+            for product_id, item in data.items()
+        ]
+        return {
+            'items': items,
+            'count': sum(qty for _, qty, _ in items),
+            'total': sum(qty * price for _, qty, price in items),
+        }
 
-        for product in products:
-            cart[str(product.id)]['product'] = product
+    @property
+    def items(self) -> dict:
+        """Позиции корзины: {id товара магазина: [количество, цена]}."""
+        if self._items is None:
+            self._items = {
+                product_id: [qty, price]
+                for product_id, qty, price in self.data['items']
+            }
+        return self._items
 
-        for item in cart.values():
-            item['price'] = Decimal(item['price']) * item['qty']
-            item['quantity'] = item['qty']
-            yield item
+    def get_products(self) -> dict:
+        """Товары магазинов корзины, загружаются одним запросом."""
+        if self._products is None:
+            self._products = ProductOnShopModel.objects.select_related(
+                'product__main_image', 'shop'
+            ).in_bulk(list(self.items))
+        return self._products
+
+    def __iter__(self):
+        products = self.get_products()
+        for product_id, (qty, price) in list(self.items.items()):
+            product = products.get(product_id)
+            if product is None:
+                continue
+            yield {
+                'product': product,
+                'price': from_kopecks(price * qty),
+                'quantity': qty,
+            }
 
     def __len__(self):
         """Количество товара в корзине."""
-        return sum(item['qty'] for item in self.cart.values())
+        return self.data['count']
 
     def add(self, product, qty, price=None):
         """Добавление и обновление товара в корзине сессии."""
-        product_id = str(product.id)
-
-        if product_id in self.cart:
-            self.cart[product_id]['qty'] = self.cart[product_id]['qty'] + qty
+        qty = int(qty)
+        if product.id in self.items:
+            self.items[product.id][0] += qty
         else:
-            self.cart[product_id] = {'price': str(price), 'qty': qty}
-
+            self.items[product.id] = [
+                qty, to_kopecks(product.price if price is None else price)
+            ]
         self.save()
 
     def update(self, product, qty):
-        """Обновление количества товара."""
-        product_id = str(product.id)
-        if product_id in self.cart:
-            self.cart[product_id]['qty'] = self.cart[product_id]['qty'] + qty
+        """
+        Изменение количества товара на qty; позиция с нулевым количеством
+         удаляется.
+        """
+        if product.id in self.items:
+            self.items[product.id][0] += int(qty)
+            if self.items[product.id][0] <= 0:
+                del self.items[product.id]
+        self.save()
+
+    def set_items(self, items):
+        """
+        Установка количества нескольких позиций: items - {id товара
+         магазина: (количество, цена единицы)}; позиции с нулевым
+          количеством удаляются. Сессия сохраняется один раз.
+        """
+        for product_id, (qty, price) in items.items():
+            if qty > 0:
+                self.items[product_id] = [qty, to_kopecks(price)]
+            else:
+                self.items.pop(product_id, None)
         self.save()
 
     def delete(self, product):
         """Удаление товара."""
-        product_id = str(product.id)
-
-        if product_id in self.cart:
-            del self.cart[product_id]
+        if product.id in self.items:
+            del self.items[product.id]
             self.save()
 
     def get_total_price(self):
         """Сумма товаров в корзине."""
-        return sum(
-            Decimal(item['price']) * item['qty'] for item in self.cart.values()
-        )
+        return from_kopecks(self.data['total'])
 
     def save(self):
-        """Сохранение сессии."""
-        self.session[settings.CART_SESSION_ID] = self.cart
+        """Пересчет итогов и сохранение сессии."""
+        self.data = {
+            'items': [
+                [product_id, qty, price]
+                for product_id, (qty, price) in self.items.items()
+            ],
+            'count': sum(qty for qty, _ in self.items.values()),
+            'total': sum(qty * price for qty, price in self.items.values()),
+        }
+        self.session[settings.CART_SESSION_ID] = self.data
         self.session.modified = True
+        self._products = None
 
     def clear(self):
         """Очищаем корзину в сессии."""
-        del self.session[settings.CART_SESSION_ID]
-        self.save()
+        self.session.pop(settings.CART_SESSION_ID, None)
+        self.session.modified = True
+        self.data = {'items': [], 'count': 0, 'total': 0}
+        self._items = None
+        self._products = None
+
+
+def get_cart_version_key(user_id) -> str:
+    return 'cart:version:{}'.format(user_id)
+
+
+def get_cart_version(user_id) -> str:
+    """
+    Версия корзины пользователя в кэше. Меняется при каждом сохранении
+     корзины (cart_changed), в том числе вне запроса - например, при оплате
+      заказа.
+    """
+    cache = caches[settings.CART_SUMMARY_CACHE_ALIAS]
+    key = get_cart_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex[:12]
+        if not cache.add(key, version, settings.CART_SUMMARY_COOKIE_AGE):
+            version = cache.get(key, version)
+    return version
+
+
+def cart_changed(user_id):
+    """
+    Смена версии корзины: сохраненные в cookie итоги устаревают. Версия
+     меняется после фиксации транзакции, иначе параллельный запрос может
+      подписать новой версией еще не измененные итоги.
+    """
+    if settings.CART_SUMMARY_COOKIE_AGE:
+        transaction.on_commit(
+            lambda: caches[settings.CART_SUMMARY_CACHE_ALIAS].set(
+                get_cart_version_key(user_id), uuid.uuid4().hex[:12],
+                settings.CART_SUMMARY_COOKIE_AGE
+            )
+        )
+
+
+def read_cart_cookie(request, user_id, version):
+    """Итоги корзины из подписанной cookie, если она той же версии."""
+    value = request.get_signed_cookie(
+        settings.CART_SUMMARY_COOKIE, default=None, salt=CART_SUMMARY_SALT,
+        max_age=settings.CART_SUMMARY_COOKIE_AGE
+    )
+    try:
+        cookie_user, cookie_version, count, total = value.split(':')
+        if cookie_user != str(user_id) or cookie_version != version:
+            return None
+        return int(count), from_kopecks(int(total))
+    except (AttributeError, ValueError):
+        return None
+
+
+def load_cart_summary(request) -> tuple:
+    if not request.user.is_authenticated:
+        cart = Cart(request)
+        return len(cart), cart.get_total_price()
+    user_id = request.user.pk
+    if settings.CART_SUMMARY_COOKIE_AGE:
+        # Версия читается до запроса к базе данных: изменение корзины во
+        # время запроса сделает записанную cookie устаревшей
+        version = get_cart_version(user_id)
+        summary = read_cart_cookie(request, user_id, version)
+        if summary is not None:
+            return summary
+        request._cart_cookie = (user_id, version)
+    summary = CartModel.objects.filter(
+        user_id=user_id, status='actively'
+    ).values_list('quantity', 'total_price').first()
+    return summary or (0, 0)
+
+
+def get_cart_summary(request) -> tuple:
+    """
+    Количество товаров и сумма корзины (count, total) для шапки сайта.
+     Вычисляются один раз за запрос. Для авторизованного пользователя
+      итоги берутся из подписанной cookie, если версия корзины с тех пор
+       не менялась, иначе - одним запросом к базе данных, после чего
+        cookie перезаписывается (CartSummaryMiddleware).
+    """
+    summary = getattr(request, '_cart_summary', None)
+    if summary is None:
+        summary = request._cart_summary = load_cart_summary(request)
+    return summary
+
+
+def save_cart_cookie(request, response):
+    """
+    Запись в ответ cookie с итогами корзины, загруженными в этом запросе
+     из базы данных. После выхода пользователя cookie удаляется.
+    """
+    name = settings.CART_SUMMARY_COOKIE
+    pending = getattr(request, '_cart_cookie', None)
+    if pending is not None:
+        user_id, version = pending
+        count, total = get_cart_summary(request)
+        response.set_signed_cookie(
+            name, '{}:{}:{}:{}'.format(
+                user_id, version, count, to_kopecks(total)),
+            salt=CART_SUMMARY_SALT, max_age=settings.CART_SUMMARY_COOKIE_AGE,
+            httponly=True, samesite='Lax'
+        )
+    elif name in request.COOKIES and not request.user.is_authenticated:
+        response.delete_cookie(name, samesite='Lax')
@@ -0,0 +1,67 @@
+import contextvars
+from contextlib import contextmanager
+
+_current_scope = contextvars.ContextVar('discount_scope', default=None)
+
+
+class DiscountScope:
+    """
+    Приоритетные скидки товаров, уже полученные в рамках одного запроса.
+     Скидка каждого товара (или ее отсутствие) загружается из базы данных
+      не больше одного раза, повторные обращения из представлений,
+       шаблонов и контекстных процессоров берут ее из памяти.
+
+    lookups - число обращений за скидками, resolutions - число запросов к
+     базе данных, products - число товаров, скидки которых загружены.
+    """
+
+    def __init__(self):
+        self.discounts = {}
+        self.lookups = 0
+        self.resolutions = 0
+        self.products = 0
+
+    def resolve(self, product_ids, load) -> dict:
+        """
+        Скидки товаров product_ids: {id товара: скидка}. Для товаров,
+         которых еще нет в памяти, вызывается load(ids).
+        """
+        self.lookups += 1
+        missing = set(product_ids) - self.discounts.keys()
+        if missing:
+            self.resolutions += 1
+            self.products += len(missing)
+            loaded = load(missing)
+            for product_id in missing:
+                self.discounts[product_id] = loaded.get(product_id)
+        return {
+            product_id: self.discounts[product_id]
+            for product_id in product_ids
+            if self.discounts[product_id] is not None
+        }
+
+    def clear(self):
+        self.discounts = {}
+
+
+@contextmanager
+def discount_scope():
+    """Область запоминания скидок (например, на время запроса)."""
+    scope = DiscountScope()
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+
+
+def get_discount_scope():
+    """Текущая область запоминания скидок или None вне ее."""
+    return _current_scope.get()
+
+
+def clear_discount_scope():
+    """Сброс запомненных скидок текущей области (при изменении скидок)."""
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.clear()
@@ -6,9 +6,11 @@ from django.utils.translation import gettext_lazy as _
 
 
 def get_cache_choices():
+    """Именованные кэши с временем жизни ключей."""
     caches = settings.CACHES or {}
     return [
-        (key, f"{key} ({cache['BACKEND']}") for key, cache in caches.items()
+        (key, f"{key} ({cache['LOCATION']}, TTL {cache.get('TIMEOUT')})")
+        for key, cache in caches.items()
     ]
 
 
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from app_marketplace.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Полное перестроение поискового индекса товаров'
+
+    def handle(self, *args, **options):
+        count = rebuild_index()
+        self.stdout.write('Indexed products: %s' % count)
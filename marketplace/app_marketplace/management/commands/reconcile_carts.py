@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from app_marketplace.models import CartModel
+from app_marketplace.services import CartTotalsService
+
+
+class Command(BaseCommand):
+    help = 'Пересчет итогов корзин, разошедшихся с товарами в корзине'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Проверять и завершенные корзины, а не только активные'
+        )
+
+    def handle(self, *args, **options):
+        carts = CartModel.objects.all()
+        if not options['all']:
+            carts = carts.filter(status='actively')
+        count = CartTotalsService.reconcile(carts)
+        self.stdout.write('Reconciled carts: %s' % count)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from app_marketplace.services import AddCommentToProductService
+
+
+class Command(BaseCommand):
+    help = 'Пересчет количества активных отзывов товаров'
+
+    def handle(self, *args, **options):
+        count = AddCommentToProductService.recount_reviews()
+        self.stdout.write('Recounted products: %s' % count)
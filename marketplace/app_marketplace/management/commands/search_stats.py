@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from app_marketplace.search import get_query_stats
+
+
+class Command(BaseCommand):
+    help = 'Самые частые поисковые запросы с долей попаданий в кэш'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20)
+
+    def handle(self, *args, **options):
+        for item in get_query_stats(options['limit']):
+            self.stdout.write('%6d  hits %5.1f%%  %7.2f ms  %s' % (
+                item['count'], 100 * item['hits'] / item['count'],
+                item['avg_time'], item['query']
+            ))
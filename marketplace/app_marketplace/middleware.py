@@ -0,0 +1,46 @@
+import logging
+from django.conf import settings
+from .cart import save_cart_cookie
+from .discounts import discount_scope
+
+logger = logging.getLogger(__name__)
+
+
+class DiscountScopeMiddleware:
+    """
+    Скидки товаров запоминаются на время обработки запроса. Число
+     запросов к базе данных за скидками записывается в журнал, а при
+      DEBUG - в заголовок ответа X-Discount-Resolutions.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with discount_scope() as scope:
+            response = self.get_response(request)
+        logger.debug(
+            'Discount resolutions for %s: %s queries, %s products, '
+            '%s lookups', request.path, scope.resolutions, scope.products,
+            scope.lookups
+        )
+        if settings.DEBUG:
+            response['X-Discount-Resolutions'] = scope.resolutions
+        return response
+
+
+class CartSummaryMiddleware:
+    """
+    Итоги корзины, загруженные в запросе из базы данных, сохраняются в
+     подписанной cookie, чтобы следующие страницы выводили шапку без
+      запросов к корзине. Отключается CART_SUMMARY_COOKIE_AGE = 0.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if settings.CART_SUMMARY_COOKIE_AGE:
+            save_cart_cookie(request, response)
+        return response
@@ -1,13 +1,17 @@
 import os
 from binascii import hexlify
 from django.contrib.auth import get_user_model
-from django.core.cache import cache
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from django.db.models.signals import post_save, pre_save
+from django.db import models, transaction
+from django.db.models.signals import (
+    post_init, post_save, pre_save, pre_delete, post_delete, m2m_changed
+)
 from django.dispatch import receiver
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
+from .caching import dependency, invalidate
+from .discounts import clear_discount_scope
 from .utils import validate_size_file
 
 User = get_user_model()
@@ -18,6 +22,42 @@ def _createHash():
     return hexlify(os.urandom(5))
 
 
+def get_changed_fields(instance):
+    """
+    Поля из tracked_fields модели, измененные после загрузки объекта из
+     базы данных. Значения полей запоминаются при создании объекта
+      (сигнал post_init), поэтому повторное чтение из базы не требуется.
+       Для нового объекта все отслеживаемые поля считаются измененными.
+    """
+    fields = getattr(instance, 'tracked_fields', ())
+    loaded = getattr(instance, '_loaded_values', None)
+    if instance._state.adding or loaded is None:
+        return set(fields)
+    return {
+        field for field in fields
+        if instance.__dict__.get(field) != loaded.get(field)
+    }
+
+
+def get_cache_dependencies(instance):
+    """
+    Зависимости кэша, затрагиваемые изменением объекта: сам объект, вся
+     таблица, выборки по полям cache_lookup_fields (прежнее и новое
+      значение поля) и выборки по связанным объектам, которые возвращает
+       метод модели get_related_cache_dependencies.
+    """
+    model = type(instance)
+    dependencies = [dependency(model, instance.pk), dependency(model)]
+    loaded = getattr(instance, '_loaded_values', None) or {}
+    for field in getattr(model, 'cache_lookup_fields', ()):
+        for value in {instance.__dict__.get(field), loaded.get(field)}:
+            if value is not None:
+                dependencies.append(dependency(model, **{field: value}))
+    if hasattr(instance, 'get_related_cache_dependencies'):
+        dependencies += instance.get_related_cache_dependencies(loaded)
+    return dependencies
+
+
 class CategoryModel(models.Model):
     """Модель категорий."""
     icon = models.ForeignKey('FilesModel', verbose_name=_('Иконка категории'),
@@ -132,14 +172,6 @@ class ShopModel(models.Model):
         ordering = ['id']
 
 
-@receiver(post_save, sender=ShopModel)
-def tags_clear_cache_shop_model(sender, instance, **kwargs):
-    """Функция очистки кэша по сигналу при изменении модели ShopModel."""
-    shop_cache_key = 'shop:{}'.format(instance.slug)
-    if cache.get(shop_cache_key) is not None:
-        cache.delete(shop_cache_key)
-
-
 class TypeOfDiscountModel(models.Model):
     """Типы скидок.
     """
@@ -247,39 +279,62 @@ class ProductModel(models.Model):
     view_count = models.PositiveIntegerField(
         verbose_name=_('Счетчик просмотров'), default=0
     )
+    # Поля для сортировки каталога, пересчитываются сервисами
+    final_price = models.DecimalField(
+        max_digits=10, decimal_places=2, blank=True, null=True,
+        editable=False, verbose_name=_('Минимальная итоговая цена')
+    )
+    review_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('Количество отзывов')
+    )
+
+    # Изменение счетчиков и цены не сбрасывает кэш товара
+    tracked_fields = (
+        'model', 'description', 'category_id', 'main_image_id', 'slug',
+        'limited_edition', 'code', 'manufacturer', 'is_active'
+    )
+    cache_lookup_fields = ('category_id',)
+    # Поля, которые пересчитываются запросами UPDATE: при сохранении товара
+    # они не перезаписываются устаревшими значениями
+    derived_fields = ('final_price', 'review_count', 'view_count')
 
     def __str__(self):
         return self.model
 
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        if not self._state.adding and not force_insert and \
+                update_fields is None:
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name not in self.derived_fields
+            ]
+        super().save(force_insert, force_update, using, update_fields)
+
     class Meta:
         verbose_name = _('Товар')
         verbose_name_plural = _('Товары')
         ordering = ['id']
-
-
-@receiver(pre_save, sender=ProductModel)
-def product_clear_cache(sender, instance, **kwargs):
-    """Функция очистки кэша при изменении модели продукта."""
-    if instance.id is None:  # Будет создан новый объект
-        pass
-    else:
-        # Сброс кэша по изменению перечисленных в условии полей
-        previous = ProductModel.objects.filter(id=instance.id)
-        if (
-                previous.model != instance.model or
-                previous.description != instance.description or
-                previous.characteristics != instance.characteristics or
-                previous.main_image != instance.main_image or
-                previous.gallery != instance.gallery or
-                previous.files != instance.files or
-                previous.discounts != instance.discounts or
-                previous.code != instance.code or
-                previous.manufacturer != instance.manufacturer or
-                previous.is_active != instance.is_active
-        ):
-            product_cache_key = 'product:{}'.format(instance.slug)
-            if cache.get(product_cache_key) is not None:
-                cache.delete(product_cache_key)
+        # Индексы под режимы сортировки каталога (CatalogService.sort_modes)
+        indexes = [
+            models.Index(
+                fields=['category', 'is_active', '-view_count', '-id'],
+                name='product_popular_idx'
+            ),
+            models.Index(
+                fields=['category', 'is_active', 'final_price', 'id'],
+                name='product_price_idx'
+            ),
+            models.Index(
+                fields=['category', 'is_active', '-created_at', '-id'],
+                name='product_new_idx'
+            ),
+            models.Index(
+                fields=['category', 'is_active', '-review_count', '-id'],
+                name='product_reviews_idx'
+            ),
+        ]
 
 
 class FilesModel(models.Model):
@@ -319,6 +374,8 @@ class TagsModel(models.Model):
     )
     is_active = models.BooleanField(default=True)
 
+    cache_lookup_fields = ('product_id',)
+
     def __str__(self):
         return self.name
 
@@ -328,14 +385,6 @@ class TagsModel(models.Model):
         ordering = ['id']
 
 
-@receiver(post_save, sender=TagsModel)
-def tags_clear_cache_tags_model(sender, instance, **kwargs):
-    """Функция очистки кэша по сигналу при изменении модели TagsModel."""
-    tags_cache_key = 'tags:{}'.format(instance.product.slug)
-    if cache.get(tags_cache_key) is not None:
-        cache.delete(tags_cache_key)
-
-
 class ProductOnShopModel(models.Model):
     """Товар, находящийся в магазине.
     """
@@ -355,9 +404,21 @@ class ProductOnShopModel(models.Model):
         default=False, verbose_name=_('Для продажи')
     )
 
+    tracked_fields = ('shop_id', 'product_id', 'quantity', 'price', 'for_sale')
+    cache_lookup_fields = ('product_id',)
+
     def __str__(self):
         return self.product.model
 
+    def get_related_cache_dependencies(self, loaded) -> list:
+        """Предложения товаров категории прежнего и нового товара."""
+        product_ids = {self.product_id, loaded.get('product_id')} - {None}
+        return [
+            dependency(ProductOnShopModel, product__category_id=category_id)
+            for category_id in ProductModel.objects.filter(
+                pk__in=product_ids).values_list('category_id', flat=True)
+        ]
+
     class Meta:
         verbose_name = _('Товар магазина')
         verbose_name_plural = _('Товары магазина')
@@ -365,25 +426,117 @@ class ProductOnShopModel(models.Model):
 
 
 @receiver(pre_save, sender=ProductOnShopModel)
-def review_clear_cache_product_on_shop(sender, instance, **kwargs):
+def price_changed_product_on_shop(sender, instance, **kwargs):
+    """Отмечаем изменение цены для пересчета итоговой цены после сохранения."""
+    instance._price_changed = 'price' in get_changed_fields(instance)
+
+
+class EffectivePriceModel(models.Model):
     """
-    Функция очистки кэша по сигналу при изменении полей
-     price и for_sale модели ProductOnShopModel.
+    Итоговая цена товара в магазине с учетом приоритетной скидки.
+     Пересчитывается при изменении скидок, типов скидок и цен товаров,
+      а также периодической задачей по истечении valid_until.
     """
-    if instance.id is None:  # Будет создан новый объект
-        pass
-    else:
-        previous = ProductOnShopModel.objects.get(id=instance.id)
-
-        # Сброс кэша по изменению перечисленных в условии полей
-        if (previous.price != instance.price or
-                previous.for_sale != instance.for_sale):
-            slug = instance.product.slug
-            product_on_shops_cache_key = 'product_on_shops:{}'.format(slug)
-            min_price_cache_key = 'min_price_cache_key:{}'.format(slug)
-            if cache.get(product_on_shops_cache_key) is not None:
-                cache.delete(product_on_shops_cache_key)
-                cache.delete(min_price_cache_key)
+    product_on_shop = models.OneToOneField(
+        ProductOnShopModel, on_delete=models.CASCADE,
+        related_name='effective_price', verbose_name=_('Товар магазина')
+    )
+    price = models.DecimalField(
+        max_digits=10, decimal_places=2, verbose_name=_('Итоговая цена')
+    )
+    discount = models.ForeignKey(
+        DiscountModel, on_delete=models.SET_NULL, blank=True, null=True,
+        related_name='effective_price', verbose_name=_('Примененная скидка')
+    )
+    valid_until = models.DateTimeField(
+        blank=True, null=True, db_index=True,
+        verbose_name=_('Действительна до')
+    )
+
+    def __str__(self):
+        return f'{self.product_on_shop_id}: {self.price}'
+
+    class Meta:
+        verbose_name = _('Итоговая цена')
+        verbose_name_plural = _('Итоговые цены')
+        ordering = ['id']
+
+
+@receiver(post_save, sender=ProductOnShopModel)
+def effective_price_product_on_shop(sender, instance, created, **kwargs):
+    """Пересчет итоговой цены при создании товара магазина или смене цены."""
+    if created or getattr(instance, '_price_changed', False):
+        from .services import EffectivePriceService
+        EffectivePriceService.update_prices(
+            ProductOnShopModel.objects.filter(id=instance.id)
+        )
+
+
+@receiver(post_delete, sender=ProductOnShopModel)
+def effective_price_product_on_shop_delete(sender, instance, **kwargs):
+    """Пересчет минимальной цены товара после удаления товара магазина."""
+    from .services import EffectivePriceService
+    EffectivePriceService.update_min_prices([instance.product_id])
+
+
+@receiver(post_save, sender=DiscountModel)
+def effective_price_discount(sender, instance, **kwargs):
+    """Пересчет итоговых цен товаров при изменении скидки."""
+    from .services import EffectivePriceService
+    clear_discount_scope()
+    EffectivePriceService.update_product_prices(
+        instance.product.values_list('id', flat=True)
+    )
+
+
+@receiver(pre_delete, sender=DiscountModel)
+def effective_price_discount_pre_delete(sender, instance, **kwargs):
+    """Запоминаем товары удаляемой скидки до удаления связей."""
+    instance._product_ids = list(
+        instance.product.values_list('id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=DiscountModel)
+def effective_price_discount_post_delete(sender, instance, **kwargs):
+    """Пересчет итоговых цен товаров после удаления скидки."""
+    from .services import EffectivePriceService
+    clear_discount_scope()
+    EffectivePriceService.update_product_prices(
+        getattr(instance, '_product_ids', [])
+    )
+
+
+@receiver(post_save, sender=TypeOfDiscountModel)
+def effective_price_type_of_discount(sender, instance, **kwargs):
+    """Пересчет итоговых цен товаров при изменении типа скидки."""
+    from .services import EffectivePriceService
+    clear_discount_scope()
+    EffectivePriceService.update_product_prices(
+        ProductModel.objects.filter(
+            discounts__type_of_discount=instance
+        ).values_list('id', flat=True)
+    )
+
+
+@receiver(m2m_changed, sender=ProductModel.discounts.through)
+def effective_price_product_discounts(sender, instance, action, reverse,
+                                      pk_set, **kwargs):
+    """Пересчет итоговых цен при изменении списка скидок товара."""
+    from .services import EffectivePriceService
+    if action == 'pre_clear' and reverse:
+        instance._product_ids = list(
+            instance.product.values_list('id', flat=True)
+        )
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        clear_discount_scope()
+        if not reverse:
+            product_ids = [instance.pk]
+        elif action == 'post_clear':
+            product_ids = getattr(instance, '_product_ids', [])
+        else:
+            product_ids = pk_set
+        EffectivePriceService.update_product_prices(product_ids)
 
 
 class ProductGroupModel(models.Model):
@@ -421,6 +574,10 @@ class ReviewModel(models.Model):
     is_active = models.BooleanField(default=True)
     add_datetime = models.DateTimeField(auto_now_add=True)
 
+    # is_active также нужен для счетчика ProductModel.review_count
+    tracked_fields = ('review', 'is_active')
+    cache_lookup_fields = ('product_id',)
+
     def __str__(self):
         return self.review
 
@@ -430,19 +587,38 @@ class ReviewModel(models.Model):
         ordering = ['id']
 
 
+def change_review_count(product_id, delta):
+    if delta > 0:
+        ProductModel.objects.filter(pk=product_id).update(
+            review_count=models.F('review_count') + delta
+        )
+    elif delta < 0:
+        ProductModel.objects.filter(
+            pk=product_id, review_count__gt=0
+        ).update(review_count=models.F('review_count') + delta)
+
+
 @receiver(post_save, sender=ReviewModel)
-def review_clear_cache_review_model(sender, instance, **kwargs):
-    """Функция очистки кэша по сигналу при изменении модели отзывов."""
-    slug = instance.product.slug
-    count_comments_cache_key = 'count_comments:{}'.format(slug)
-    all_comments_cache_key = 'all_comments_cache_key:{}'.format(slug)
-    comments_cache_key = 'comments_cache_key:{}'.format(slug)
-    if cache.get(count_comments_cache_key) is not None:
-        cache.delete(count_comments_cache_key)
-    if cache.get(all_comments_cache_key) is not None:
-        cache.delete(all_comments_cache_key)
-    if cache.get(comments_cache_key) is not None:
-        cache.delete(comments_cache_key)
+def review_count_review(sender, instance, created, **kwargs):
+    """
+    Изменение счетчика активных отзывов товара при добавлении отзыва,
+     включении и отключении его показа.
+    """
+    if kwargs.get('raw'):
+        return
+    if created:
+        change_review_count(instance.product_id, int(instance.is_active))
+    elif 'is_active' in get_changed_fields(instance):
+        change_review_count(
+            instance.product_id, 1 if instance.is_active else -1)
+
+
+@receiver(post_delete, sender=ReviewModel)
+def review_count_review_delete(sender, instance, **kwargs):
+    """Уменьшение счетчика отзывов товара при удалении активного отзыва."""
+    loaded = getattr(instance, '_loaded_values', None) or {}
+    if loaded.get('is_active', instance.is_active):
+        change_review_count(instance.product_id, -1)
 
 
 class CartProductModel(models.Model):
@@ -473,6 +649,52 @@ class CartProductModel(models.Model):
         ordering = ['id']
 
 
+class StockReservationModel(models.Model):
+    """
+    Количество товара магазина, зарезервированное для корзины
+     пользователя или сессии. Зарезервированный товар уже вычтен из
+      ProductOnShopModel.quantity и возвращается при удалении из корзины
+       или по истечении expires_at.
+    """
+    product_on_shop = models.ForeignKey(
+        ProductOnShopModel, on_delete=models.CASCADE,
+        related_name='reservations', verbose_name=_('Товар магазина')
+    )
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, null=True, blank=True,
+        related_name='reservations', verbose_name=_('Пользователь')
+    )
+    session_key = models.CharField(
+        max_length=40, blank=True, db_index=True,
+        verbose_name=_('Ключ сессии')
+    )
+    quantity = models.PositiveIntegerField(verbose_name=_('Количество'))
+    expires_at = models.DateTimeField(
+        db_index=True, verbose_name=_('Действует до')
+    )
+
+    def __str__(self):
+        return f'{self.product_on_shop_id}: {self.quantity}'
+
+    class Meta:
+        verbose_name = _('Резерв товара')
+        verbose_name_plural = _('Резервы товаров')
+        ordering = ['id']
+        # Одна строка резерва на товар магазина у каждого владельца
+        constraints = [
+            models.UniqueConstraint(
+                fields=['product_on_shop', 'user'],
+                condition=models.Q(user__isnull=False),
+                name='unique_user_reservation'
+            ),
+            models.UniqueConstraint(
+                fields=['product_on_shop', 'session_key'],
+                condition=~models.Q(session_key=''),
+                name='unique_session_reservation'
+            ),
+        ]
+
+
 class CartModel(models.Model):
     """Модель хранения товаров в Корзина."""
     STATUS = (
@@ -588,11 +810,24 @@ class ProductViewHistoryModel(models.Model):
         ProductModel, on_delete=models.CASCADE, related_name='view_history',
         verbose_name=_('Посмотренный товар')
     )
+    viewed_at = models.DateTimeField(
+        default=timezone.now, verbose_name=_('Время просмотра')
+    )
 
     class Meta:
         verbose_name = _('История просмотра')
         verbose_name_plural = _('Истории просмотров')
-        ordering = ['id']
+        ordering = ['-viewed_at', '-id']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'product'], name='unique_user_product_view'
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=['user', '-viewed_at'], name='view_history_user_idx'
+            )
+        ]
 
     def __str__(self):
         return f'{self.user.email}{_(", товар: ")}{self.product.model}'
@@ -720,3 +955,201 @@ class BannerModel(models.Model):
         verbose_name = _('Баннер')
         verbose_name_plural = _('Баннеры')
         ordering = ['id']
+
+
+class SearchTermModel(models.Model):
+    """
+    Поисковый индекс товаров: основа слова из текстовых полей товара и ее
+     вес (см. app_marketplace.search).
+    """
+    term = models.CharField(
+        max_length=64, db_index=True, verbose_name=_('Основа слова')
+    )
+    product = models.ForeignKey(
+        ProductModel, on_delete=models.CASCADE, related_name='search_terms',
+        verbose_name=_('Товар')
+    )
+    weight = models.PositiveSmallIntegerField(
+        default=1, verbose_name=_('Вес')
+    )
+
+    def __str__(self):
+        return self.term
+
+    class Meta:
+        verbose_name = _('Слово поискового индекса')
+        verbose_name_plural = _('Поисковый индекс')
+        ordering = ['id']
+
+
+# Поля товара, по которым строится поисковый индекс
+SEARCH_FIELDS = {'model', 'description', 'manufacturer', 'code'}
+
+
+@receiver(post_save, sender=ProductModel)
+def search_index_product(sender, instance, created, **kwargs):
+    """
+    Обновление поискового индекса при изменении текстовых полей. При
+     загрузке фикстур (raw) индекс перестраивается командой
+      rebuild_search_index.
+    """
+    if kwargs.get('raw'):
+        return
+    if created or SEARCH_FIELDS & get_changed_fields(instance):
+        from .search import index_products
+        index_products([instance.pk])
+
+
+@receiver(post_save, sender=TagsModel)
+@receiver(post_delete, sender=TagsModel)
+def search_index_tag(sender, instance, **kwargs):
+    """Обновление поискового индекса товара при изменении тегов."""
+    if kwargs.get('raw'):
+        return
+    from .search import index_products
+    index_products([instance.product_id])
+
+
+@receiver(m2m_changed, sender=ProductModel.characteristics.through)
+def search_index_characteristics(sender, instance, action, reverse, pk_set,
+                                 **kwargs):
+    """Обновление поискового индекса при изменении характеристик товара."""
+    from .search import index_products
+    if action == 'pre_clear' and reverse:
+        instance._product_ids = list(
+            instance.product.values_list('id', flat=True)
+        )
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            product_ids = [instance.pk]
+        elif action == 'post_clear':
+            product_ids = getattr(instance, '_product_ids', [])
+        else:
+            product_ids = pk_set
+        index_products(product_ids)
+
+
+@receiver(post_save, sender=CharacteristicModel)
+@receiver(post_save, sender=ValueModel)
+def search_index_value(sender, instance, created, **kwargs):
+    """Обновление поискового индекса товаров при изменении значения."""
+    if created or kwargs.get('raw'):
+        return
+    from .search import index_products
+    lookup = 'characteristics' if sender is CharacteristicModel \
+        else 'characteristics__value'
+    index_products(
+        ProductModel.objects.filter(**{lookup: instance}).values_list(
+            'id', flat=True)
+    )
+
+
+# Поля товара, которые выводятся в подсказках поиска
+SUGGEST_FIELDS = {'model', 'slug', 'manufacturer', 'is_active'}
+
+
+def log_suggestion_changes(changes):
+    """
+    Запись в журнал после фиксации транзакции: иначе процесс, который
+     обновит индекс до фиксации, прочитает старые строки с новой версией.
+    """
+    from .suggestions import SuggestionIndex
+    transaction.on_commit(lambda: SuggestionIndex.log_changes(changes))
+
+
+@receiver(post_save, sender=ProductModel)
+@receiver(post_delete, sender=ProductModel)
+def suggestions_product(sender, instance, created=False, **kwargs):
+    """Запись изменения товара и его производителя в журнал подсказок."""
+    if kwargs.get('raw'):
+        return
+    if kwargs.get('signal') is post_save and not created and \
+            not SUGGEST_FIELDS & get_changed_fields(instance):
+        return
+    loaded = getattr(instance, '_loaded_values', None) or {}
+    manufacturers = {instance.manufacturer, loaded.get('manufacturer')}
+    log_suggestion_changes(
+        [('products', instance.pk)] +
+        [('manufacturers', name) for name in manufacturers if name]
+    )
+
+
+@receiver(post_save, sender=TagsModel)
+@receiver(post_delete, sender=TagsModel)
+def suggestions_tag(sender, instance, **kwargs):
+    """Запись изменения тегов товара в журнал подсказок."""
+    if not kwargs.get('raw'):
+        log_suggestion_changes([('products', instance.product_id)])
+
+
+@receiver(post_save, sender=CategoryModel)
+@receiver(post_delete, sender=CategoryModel)
+def suggestions_category(sender, instance, **kwargs):
+    """Запись изменения категории в журнал подсказок."""
+    if not kwargs.get('raw'):
+        log_suggestion_changes([('categories', instance.pk)])
+
+
+@receiver(post_save, sender=CartModel)
+@receiver(post_delete, sender=CartModel)
+def cart_summary_cart(sender, instance, **kwargs):
+    """Итоги корзины в cookie пользователя устаревают."""
+    if instance.user_id and not kwargs.get('raw'):
+        from .cart import cart_changed
+        cart_changed(instance.user_id)
+
+
+def track_fields(sender, instance, **kwargs):
+    """Запоминаем значения отслеживаемых полей при загрузке объекта."""
+    fields = sender.tracked_fields + getattr(sender, 'cache_lookup_fields', ())
+    instance._loaded_values = {
+        field: instance.__dict__.get(field) for field in fields
+    }
+
+
+def clear_cache_dependencies(sender, instance, created=False, **kwargs):
+    """
+    Удаление фрагментов кэша, зависящих от сохраненного или удаленного
+     объекта. Сохранение без изменения отслеживаемых полей кэш не
+      сбрасывает. Кэш сбрасывается после фиксации транзакции, чтобы
+       параллельный запрос не закэшировал заново еще не измененные данные.
+    """
+    if (kwargs.get('signal') is post_save and not created and
+            hasattr(sender, 'tracked_fields') and
+            not get_changed_fields(instance)):
+        return
+    dependencies = get_cache_dependencies(instance)
+    transaction.on_commit(lambda: invalidate(dependencies))
+    if hasattr(sender, 'tracked_fields'):
+        track_fields(sender, instance)
+
+
+def clear_cache_m2m_dependencies(sender, instance, action, reverse, model,
+                                 pk_set, **kwargs):
+    """Удаление фрагментов кэша при изменении связей многие-ко-многим."""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    dependencies = [dependency(type(instance), instance.pk)]
+    if reverse:
+        # Изменены связи объекта, на который ссылается закэшированный объект
+        dependencies += [dependency(model, pk) for pk in pk_set or ()]
+    transaction.on_commit(lambda: invalidate(dependencies))
+
+
+# Модели, от которых зависят фрагменты кэша
+for cached_model in (
+        CategoryModel, CharacteristicModel, CharacteristicNameModel,
+        ValueModel, ShopAddressModel, ShopModel, TypeOfDiscountModel,
+        DiscountModel, ProductModel, FilesModel, TagsModel,
+        ProductOnShopModel, ReviewModel, BannerModel
+):
+    if hasattr(cached_model, 'tracked_fields'):
+        post_init.connect(track_fields, sender=cached_model)
+    post_save.connect(clear_cache_dependencies, sender=cached_model)
+    post_delete.connect(clear_cache_dependencies, sender=cached_model)
+
+for through_model in (
+        ProductModel.characteristics.through, ProductModel.gallery.through,
+        ProductModel.discounts.through, ShopModel.address.through
+):
+    m2m_changed.connect(clear_cache_m2m_dependencies, sender=through_model)
@@ -0,0 +1,257 @@
+import hashlib
+import math
+from collections.abc import Sequence
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.db.models import F, Q
+from .caching import get_or_set
+
+CURSOR_SALT = 'app_marketplace.pagination'
+
+
+class KeysetPaginator:
+    """
+    Постраничный вывод по ключу сортировки (keyset pagination).
+
+    Вместо OFFSET следующая страница выбирается условием "после последней
+     строки предыдущей страницы", поэтому дальние страницы читаются так же
+      быстро, как первая. Сортировка берется из запроса, первичный ключ
+       добавляется в конец для однозначного порядка. Поля, которые могут
+        быть NULL (например, final_price товара без предложений), сортируются
+         с NULL в конце при любом направлении, и seek учитывает это условием
+          IS NULL.
+
+    Номер страницы передается курсором - подписанной строкой с номером,
+     сортировкой и ключом сортировки граничной строки. Общее количество
+      строк задается аргументом count (число или функция) или считается
+       с кэшированием.
+    """
+
+    def __init__(self, queryset, per_page, count=None):
+        self.per_page = int(per_page)
+        self._count = count
+        self.ordering = self.get_ordering(queryset)
+        self.nullable = {
+            field for field, _ in self.ordering
+            if self.is_nullable(queryset, field)
+        }
+        self.queryset = queryset.order_by(*[
+            self.get_order_by(field, descending)
+            for field, descending in self.ordering
+        ])
+
+    @staticmethod
+    def get_ordering(queryset) -> list:
+        """Сортировка запроса: [(поле, по убыванию), ...]."""
+        query = queryset.query
+        ordering = list(query.order_by or (
+            query.get_meta().ordering if query.default_ordering else []
+        ))
+        pk_names = {'pk', query.get_meta().pk.name}
+        result = []
+        for field in ordering:
+            if not isinstance(field, str) or '__' in field or field == '?':
+                raise ValueError(
+                    'Keyset pagination supports only field names, '
+                    'got {!r}'.format(field)
+                )
+            result.append((field.lstrip('-'), field.startswith('-')))
+        if not pk_names & {field for field, _ in result}:
+            result.append(('pk', False))
+        return result
+
+    @staticmethod
+    def is_nullable(queryset, field) -> bool:
+        """Может ли поле сортировки быть NULL (аннотации - может)."""
+        if field == 'pk':
+            return False
+        try:
+            return queryset.query.get_meta().get_field(field).null
+        except FieldDoesNotExist:
+            return True
+
+    def get_order_by(self, field, descending):
+        if field not in self.nullable:
+            return '-' + field if descending else field
+        if descending:
+            return F(field).desc(nulls_last=True)
+        return F(field).asc(nulls_last=True)
+
+    @property
+    def count(self) -> int:
+        if callable(self._count):
+            self._count = self._count()
+        if self._count is None:
+            self._count = self.get_cached_count(self.queryset)
+        return self._count
+
+    @staticmethod
+    def get_cached_count(queryset) -> int:
+        """Количество строк запроса, кэшируется на короткое время."""
+        queryset = queryset.order_by()
+        try:
+            sql = str(queryset.query)
+        except EmptyResultSet:
+            return 0
+        key = 'count:{}'.format(hashlib.md5(sql.encode()).hexdigest())
+        return get_or_set(
+            key, queryset.count, settings.PAGINATION_COUNT_CACHE_TIME,
+            cache_alias='pages'
+        )
+
+    @property
+    def num_pages(self) -> int:
+        return max(math.ceil(self.count / self.per_page), 1)
+
+    def get_key(self, obj) -> list:
+        """Значения полей сортировки объекта для курсора."""
+        values = []
+        for field, _ in self.ordering:
+            value = obj.pk if field == 'pk' else getattr(obj, field)
+            if value is not None and not isinstance(value, (int, float)):
+                value = str(value)
+            values.append(value)
+        return values
+
+    def get_signature(self) -> str:
+        return ','.join(
+            '-' + field if descending else field
+            for field, descending in self.ordering
+        )
+
+    def make_cursor(self, number, obj, backwards=False) -> str:
+        return signing.dumps(
+            {'n': number, 'o': self.get_signature(), 'k': self.get_key(obj),
+             'b': backwards},
+            salt=CURSOR_SALT, compress=True
+        )
+
+    def parse_cursor(self, cursor):
+        """
+        Данные курсора или None для первой страницы, в том числе если
+         курсор поврежден или создан для другой сортировки.
+        """
+        if not cursor:
+            return None
+        try:
+            data = signing.loads(cursor, salt=CURSOR_SALT)
+            if data['o'] != self.get_signature():
+                return None
+            return int(data['n']), list(data['k']), bool(data['b'])
+        except (signing.BadSignature, KeyError, TypeError, ValueError):
+            return None
+
+    def seek(self, queryset, key, backwards=False):
+        """
+        Строки после key в порядке сортировки (до key при backwards).
+         NULL находится в конце: после NULL по полю идут только строки
+          с тем же NULL, до NULL - все строки с непустым значением.
+        """
+        condition = Q()
+        for i, (field, descending) in enumerate(self.ordering):
+            equal = Q()
+            for (name, _), value in zip(self.ordering[:i], key):
+                if value is None:
+                    equal &= Q(**{name + '__isnull': True})
+                else:
+                    equal &= Q(**{name: value})
+            if key[i] is None:
+                if backwards:
+                    condition |= equal & Q(**{field + '__isnull': False})
+                continue
+            lookup = 'lt' if descending != backwards else 'gt'
+            beyond = Q(**{'{}__{}'.format(field, lookup): key[i]})
+            if field in self.nullable and not backwards:
+                beyond |= Q(**{field + '__isnull': True})
+            condition |= equal & beyond
+        return queryset.filter(condition)
+
+    def page(self, cursor=None):
+        """Страница по курсору; неверный курсор - первая страница."""
+        data = self.parse_cursor(cursor)
+        if data is None or len(data[1]) != len(self.ordering):
+            data = 1, None, False
+        number, key, backwards = data
+
+        queryset = self.queryset
+        if backwards:
+            queryset = queryset.reverse()
+        if key is not None:
+            queryset = self.seek(queryset, key, backwards)
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+
+        if backwards:
+            object_list.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, key is not None
+        return KeysetPage(
+            object_list, max(number, 1), self, has_next, has_previous
+        )
+
+
+class KeysetPage(Sequence):
+    """Страница KeysetPaginator с интерфейсом django.core.paginator.Page."""
+
+    def __init__(self, object_list, number, paginator, has_next,
+                 has_previous):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_next = has_next and bool(object_list)
+        self._has_previous = has_previous and number > 1
+
+    def __repr__(self):
+        return '<Page {}>'.format(self.number)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_number(self):
+        """Курсор следующей страницы."""
+        if not self.has_next():
+            return None
+        return self.paginator.make_cursor(
+            self.number + 1, self.object_list[-1]
+        )
+
+    def previous_page_number(self):
+        """Курсор предыдущей страницы."""
+        if not self.has_previous():
+            return None
+        return self.paginator.make_cursor(
+            self.number - 1, self.object_list[0], backwards=True
+        )
+
+
+class KeysetPaginationMixin:
+    """
+    Постраничный вывод ListView через KeysetPaginator. Параметр page
+     содержит курсор страницы; get_pagination_count может вернуть
+      известное количество строк вместо подсчета.
+    """
+
+    def get_pagination_count(self, queryset):
+        return None
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(
+            queryset, page_size, count=self.get_pagination_count(queryset)
+        )
+        page = paginator.page(self.request.GET.get(self.page_kwarg))
+        return paginator, page, page.object_list, page.has_other_pages()
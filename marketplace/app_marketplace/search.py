@@ -0,0 +1,302 @@
+import hashlib
+import re
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Exists, IntegerField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django_redis import get_redis_connection
+from .caching import dependency, get_or_set, invalidate, set_value
+from .models import ProductModel, SearchTermModel
+
+TOKEN_RE = re.compile(r'[0-9a-zа-я]+')
+TERM_LENGTH = SearchTermModel._meta.get_field('term').max_length
+MAX_QUERY_TOKENS = 8
+MIN_STEM_LENGTH = 3
+
+# Окончания существительных и прилагательных, отбрасываемые при приведении
+# слова к основе. Проверяются от длинных к коротким, отбрасывается одно
+# окончание
+RUSSIAN_ENDINGS = sorted((
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ией',
+    'ий', 'ый', 'ой', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ую', 'юю', 'ых',
+    'их', 'ом', 'ем', 'ам', 'ям', 'ах', 'ях', 'ов', 'ев', 'ей', 'ью', 'ия',
+    'ы', 'и', 'а', 'я', 'о', 'е', 'у', 'ю', 'ь', 'й',
+), key=len, reverse=True)
+ENGLISH_ENDINGS = ('ing', 'ed', 'ly', 's')
+
+# Вес слова в зависимости от поля товара
+FIELD_WEIGHTS = {
+    'code': 10,
+    'model': 8,
+    'manufacturer': 5,
+    'tags': 4,
+    'characteristics': 2,
+    'description': 1,
+}
+
+
+def normalize(text) -> str:
+    """Приведение текста к нижнему регистру с заменой ё на е."""
+    return (text or '').lower().replace('ё', 'е')
+
+
+def stem(word) -> str:
+    """
+    Упрощенное приведение русского или английского слова к основе:
+     отбрасывается одно окончание, если основа остается не короче
+      MIN_STEM_LENGTH символов. Числа и артикулы не изменяются.
+    """
+    if not word.isalpha():
+        return word[:TERM_LENGTH]
+    endings = ENGLISH_ENDINGS if word.isascii() else RUSSIAN_ENDINGS
+    for ending in endings:
+        if word.endswith(ending) and not word.endswith('ss') and \
+                len(word) - len(ending) >= MIN_STEM_LENGTH:
+            word = word[:-len(ending)]
+            break
+    return word[:TERM_LENGTH]
+
+
+def tokenize(text) -> list:
+    """Основы слов текста в порядке следования."""
+    return [stem(word) for word in TOKEN_RE.findall(normalize(text))]
+
+
+def get_query_tokens(query) -> list:
+    """
+    Нормализованный запрос: уникальные основы слов в алфавитном порядке.
+     Запросы, отличающиеся регистром, буквой ё, пробелами и порядком
+      слов, дают один и тот же список.
+    """
+    tokens = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TOKENS]
+    return sorted(tokens)
+
+
+def get_query_key(query) -> str:
+    return ' '.join(get_query_tokens(query))
+
+
+def get_product_terms(product) -> dict:
+    """
+    Слова товара для поискового индекса с весами: {основа: вес}. Вес
+     слова - сумма весов полей, в которых оно встречается.
+    """
+    texts = {
+        'code': [product.code],
+        'model': [product.model],
+        'manufacturer': [product.manufacturer],
+        'description': [product.description],
+        'tags': [
+            tag.name for tag in product.tags.all() if tag.is_active
+        ],
+        'characteristics': [
+            characteristic.value.value
+            for characteristic in product.characteristics.all()
+        ],
+    }
+    terms = defaultdict(int)
+    for field, values in texts.items():
+        for term in {term for text in values for term in tokenize(text)}:
+            terms[term] += FIELD_WEIGHTS[field]
+    return terms
+
+
+def index_products(product_ids):
+    """
+    Обновление поискового индекса переданных товаров: слова товаров
+     пересчитываются и записываются одной транзакцией.
+    """
+    product_ids = set(product_ids)
+    if not product_ids:
+        return 0
+    products = ProductModel.objects.filter(pk__in=product_ids).only(
+        'id', 'code', 'model', 'manufacturer', 'description'
+    ).prefetch_related('tags', 'characteristics__value')
+    terms = [
+        SearchTermModel(product_id=product.pk, term=term, weight=weight)
+        for product in products
+        for term, weight in get_product_terms(product).items()
+    ]
+    with transaction.atomic():
+        SearchTermModel.objects.filter(product_id__in=product_ids).delete()
+        SearchTermModel.objects.bulk_create(terms, batch_size=1000)
+        # index_products может вызываться внутри внешней транзакции
+        transaction.on_commit(
+            lambda: invalidate([dependency(SearchTermModel)]))
+    return len(terms)
+
+
+def rebuild_index(batch_size=500):
+    """Полное перестроение поискового индекса по всем товарам."""
+    SearchTermModel.objects.all().delete()
+    product_ids = list(ProductModel.objects.values_list('id', flat=True))
+    for start in range(0, len(product_ids), batch_size):
+        index_products(product_ids[start:start + batch_size])
+    return len(product_ids)
+
+
+def search_products(query, queryset=None):
+    """
+    Поиск товаров по индексу. Товар должен содержать слова, начинающиеся
+     с каждого слова запроса, поэтому порядок слов не важен, а
+      недописанное слово тоже находится. Результат отсортирован по
+       релевантности - сумме весов найденных слов - и аннотирован полем
+        rank.
+    """
+    return search_tokens(get_query_tokens(query), queryset)
+
+
+def search_tokens(tokens, queryset=None):
+    """Поиск товаров по нормализованным словам запроса."""
+    if queryset is None:
+        queryset = ProductModel.objects.filter(is_active=True)
+    if not tokens:
+        return queryset.none()
+
+    conditions = [Q(term__startswith=token) for token in tokens]
+    terms = SearchTermModel.objects.filter(product=OuterRef('pk'))
+    any_condition = Q()
+    for condition in conditions:
+        queryset = queryset.filter(Exists(terms.filter(condition)))
+        any_condition |= condition
+    rank = terms.filter(any_condition).order_by().values(
+        'product').annotate(rank=Sum('weight')).values('rank')
+    return queryset.annotate(
+        rank=Coalesce(Subquery(rank, output_field=IntegerField()), 0)
+    ).order_by('-rank', '-id')
+
+
+def get_search_key(key) -> str:
+    return 'search:{}'.format(hashlib.md5(key.encode()).hexdigest())
+
+
+def get_search_dependencies() -> list:
+    return [dependency(ProductModel), dependency(SearchTermModel)]
+
+
+def find_ids(key) -> list:
+    return list(search_tokens(key.split()).values_list(
+        'id', flat=True)[:settings.SEARCH_RESULTS_LIMIT])
+
+
+def get_search_ids(query) -> list:
+    """
+    Id найденных товаров в порядке релевантности (не больше
+     SEARCH_RESULTS_LIMIT). Результат кэшируется по нормализованному
+      запросу и сбрасывается при изменении товаров и поискового
+       индекса. Каждый запрос записывается в журнал запросов.
+    """
+    key = get_query_key(query)
+    if not key:
+        return []
+    computed = []
+
+    def compute():
+        computed.append(True)
+        return find_ids(key)
+
+    started = time.monotonic()
+    ids = get_or_set(
+        get_search_key(key), compute, settings.SEARCH_CACHE_TIME,
+        cache_alias='pages', depends_on=get_search_dependencies()
+    )
+    log_query(key, query, not computed, time.monotonic() - started)
+    return ids
+
+
+def get_log_keys() -> dict:
+    cache = caches[settings.SEARCH_LOG_CACHE_ALIAS]
+    return {
+        name: cache.make_key('search:log:{}'.format(name))
+        for name in ('count', 'hits', 'time', 'query')
+    }
+
+
+def log_query(key, query, hit, elapsed):
+    """
+    Журнал поисковых запросов: количество запросов, попаданий в кэш,
+     суммарное время (мс) и пример исходного текста для каждого
+      нормализованного запроса. Пишется одним обращением к Redis.
+    """
+    keys = get_log_keys()
+    pipeline = get_redis_connection(
+        settings.SEARCH_LOG_CACHE_ALIAS).pipeline(transaction=False)
+    pipeline.zincrby(keys['count'], 1, key)
+    if hit:
+        pipeline.hincrby(keys['hits'], key, 1)
+    pipeline.hincrbyfloat(keys['time'], key, elapsed * 1000)
+    pipeline.hset(keys['query'], key, query.strip()[:255])
+    pipeline.execute()
+
+
+def get_query_stats(limit=20) -> list:
+    """
+    Самые частые запросы: [{'key', 'query', 'count', 'hits', 'avg_time'}],
+     avg_time - среднее время ответа в миллисекундах.
+    """
+    keys = get_log_keys()
+    redis = get_redis_connection(settings.SEARCH_LOG_CACHE_ALIAS)
+    top = [
+        (key.decode(), int(count)) for key, count in
+        redis.zrevrange(keys['count'], 0, limit - 1, withscores=True)
+    ]
+    if not top:
+        return []
+    names = [key for key, _ in top]
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.hmget(keys['hits'], names)
+    pipeline.hmget(keys['time'], names)
+    pipeline.hmget(keys['query'], names)
+    hits, times, queries = pipeline.execute()
+    return [
+        {
+            'key': key,
+            'query': query.decode() if query else key,
+            'count': count,
+            'hits': int(hit or 0),
+            'avg_time': float(total or 0) / count,
+        }
+        for (key, count), hit, total, query in zip(top, hits, times, queries)
+    ]
+
+
+def trim_query_log(size=None) -> int:
+    """
+    Обрезка журнала запросов до size (SEARCH_LOG_SIZE) самых частых
+     запросов, чтобы случайные запросы не занимали память Redis.
+      Возвращает количество удаленных запросов.
+    """
+    size = size or settings.SEARCH_LOG_SIZE
+    keys = get_log_keys()
+    redis = get_redis_connection(settings.SEARCH_LOG_CACHE_ALIAS)
+    pipeline = redis.pipeline()
+    pipeline.zrange(keys['count'], 0, -size - 1)
+    pipeline.zremrangebyrank(keys['count'], 0, -size - 1)
+    removed, _ = pipeline.execute()
+    if removed:
+        pipeline = redis.pipeline(transaction=False)
+        for name in ('hits', 'time', 'query'):
+            pipeline.hdel(keys[name], *removed)
+        pipeline.execute()
+    return len(removed)
+
+
+def warm_up_searches(size=None) -> int:
+    """
+    Обрезка журнала запросов и пересчет результатов самых частых
+     запросов из журнала. Запросы прогрева в журнал не записываются.
+    """
+    trim_query_log()
+    stats = get_query_stats(size or settings.SEARCH_WARM_UP_SIZE)
+    for item in stats:
+        started = time.monotonic()
+        ids = find_ids(item['key'])
+        set_value(
+            get_search_key(item['key']), ids, settings.SEARCH_CACHE_TIME,
+            cache_alias='pages', compute_time=time.monotonic() - started,
+            depends_on=get_search_dependencies()
+        )
+    return len(stats)
@@ -1,13 +1,33 @@
+import hashlib
+import json
+import random
+from decimal import Decimal
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-from django.db.models import Q, Min, Count, Max, IntegerField
+from django.core.cache import caches
+from django.db import IntegrityError, connection, transaction
+from django.db.models import (
+    Q, F, Min, Max, Count, IntegerField, DecimalField, OuterRef, Subquery,
+    Prefetch, Case, When, Value, Exists, Sum
+)
+from django.db.models.functions import Coalesce
 from django.http import HttpResponseRedirect
 from django.utils import timezone
-from .cart import Cart
+from django_redis import get_redis_connection
+from .caching import dependency, get_or_set, invalidate, set_value
+from .discounts import get_discount_scope
+from .pagination import KeysetPaginator
+from .cart import Cart, cart_changed, from_kopecks
 from .models import (
     ReviewModel, ProductViewHistoryModel, ProductModel, OrderModel,
     PurchaseHistoryModel, CategoryModel, ShopModel, CartModel,
-    ProductOnShopModel
+    ProductOnShopModel, EffectivePriceModel, FilesModel, BannerModel,
+    CharacteristicModel, CharacteristicNameModel, ValueModel, TagsModel,
+    ShopAddressModel, DiscountModel, TypeOfDiscountModel, CartProductModel,
+    StockReservationModel
 )
 from .serializers import PaymentSerializer
 from .tasks import payment_request
@@ -21,22 +41,144 @@ class GetAdminSettingsService:
 class AddLookedProductsService:
     """
     Сервис добавления товара в список просмотренных товаров
-     пользователем.
+     пользователем. Просмотры накапливаются в очереди в кэше counters и
+      записываются в базу пакетами задачей flush_view_history. События,
+       которые не удалось записать max_attempts раз, переносятся в список
+        failed_key.
     """
+    cache_alias = 'counters'
+    queue_key = 'view_history:events'
+    failed_key = 'view_history:failed'
+    batch_size = 500
+    history_size = 20
+    max_attempts = 3
+
     @classmethod
     def add_item_to_watch_list(cls, user, product):
         """
-        Добавление товара в список просмотренных товаров. Если список включает
-         более 20 товаров у текущего пользователя, товары добавленные ранее
-          будут удалены из базы.
+        Добавление товара в список просмотренных товаров. Событие просмотра
+         помещается в очередь без обращения к базе данных.
+        """
+        event = '{}:{}:{}'.format(
+            user.pk, product.pk, timezone.now().timestamp()
+        )
+        get_redis_connection(cls.cache_alias).rpush(
+            caches[cls.cache_alias].make_key(cls.queue_key), event
+        )
+
+    @classmethod
+    def flush_watch_list(cls) -> int:
+        """
+        Запись накопленных просмотров в базу данных. Для каждой пары
+         пользователь-товар выполняется вставка или обновление времени
+          просмотра, затем у каждого пользователя удаляются записи сверх
+           последних history_size. Если пакет не записался, события
+            записываются по одному; не записавшиеся возвращаются в конец
+             очереди со счетчиком попыток и обрабатываются следующим
+              запуском. Возвращает количество записанных событий.
+        """
+        redis = get_redis_connection(cls.cache_alias)
+        cache = caches[cls.cache_alias]
+        queue_key = cache.make_key(cls.queue_key)
+        total = 0
+        retry, failed = [], []
+        while True:
+            pipeline = redis.pipeline()
+            pipeline.lrange(queue_key, 0, cls.batch_size - 1)
+            pipeline.ltrim(queue_key, cls.batch_size, -1)
+            events, _ = pipeline.execute()
+            if not events:
+                break
+            try:
+                total += cls.save_views(events)
+            except Exception:
+                for event in events:
+                    try:
+                        total += cls.save_views([event])
+                    except Exception:
+                        event, attempts = cls.get_attempts(event)
+                        if attempts + 1 >= cls.max_attempts:
+                            failed.append(event)
+                        else:
+                            retry.append(
+                                '{}:{}'.format(event, attempts + 1))
+        if retry:
+            redis.rpush(queue_key, *retry)
+        if failed:
+            redis.rpush(cache.make_key(cls.failed_key), *failed)
+        return total
+
+    @staticmethod
+    def get_attempts(event):
+        """Событие без счетчика попыток и число неудачных попыток."""
+        parts = event.decode(errors='replace').split(':')
+        attempts = int(parts[3]) if len(parts) == 4 and \
+            parts[3].isdigit() else 0
+        return ':'.join(parts[:3]), attempts
+
+    @classmethod
+    def save_views(cls, events) -> int:
+        """
+        Запись пакета событий просмотра "user_id:product_id:timestamp"
+         (после неудачной попытки - с номером попытки в конце).
+          Неразборчивые события и события удаленных пользователей и
+           товаров пропускаются. Возвращает количество записанных событий.
         """
-        if not cls.is_product_already_in_watch_list(user, product):
-            ProductViewHistoryModel.objects.create(user=user, product=product)
-        ProductViewHistoryModel.objects.filter(
-            user=user,
-            pk__in=ProductViewHistoryModel.objects.order_by(
-                'pk').values_list('pk')[20:]
-        ).delete()
+        parsed = []
+        for event in events:
+            try:
+                user_id, product_id, timestamp = event.decode().split(
+                    ':')[:3]
+                parsed.append(
+                    (int(user_id), int(product_id), float(timestamp)))
+            except ValueError:
+                continue
+        user_ids = set(get_user_model().objects.filter(
+            pk__in={user_id for user_id, _, _ in parsed}
+        ).values_list('pk', flat=True))
+        product_ids = set(ProductModel.objects.filter(
+            pk__in={product_id for _, product_id, _ in parsed}
+        ).values_list('pk', flat=True))
+        views = {}
+        saved = 0
+        for user_id, product_id, timestamp in parsed:
+            if user_id not in user_ids or product_id not in product_ids:
+                continue
+            key = (user_id, product_id)
+            views[key] = max(views.get(key, 0), timestamp)
+            saved += 1
+        if not views:
+            return 0
+
+        field = ProductViewHistoryModel._meta.get_field('viewed_at')
+        qn = connection.ops.quote_name
+        table = qn(ProductViewHistoryModel._meta.db_table)
+        rows, params = [], []
+        for (user_id, product_id), timestamp in views.items():
+            viewed_at = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+            rows.append('(%s, %s, %s)')
+            params += [
+                user_id, product_id,
+                field.get_db_prep_value(viewed_at, connection)
+            ]
+        # Более раннее событие не перезаписывает более позднее
+        sql = (
+            'INSERT INTO {table} (user_id, product_id, viewed_at) '
+            'VALUES {rows} ON CONFLICT (user_id, product_id) DO UPDATE '
+            'SET viewed_at = excluded.viewed_at '
+            'WHERE {table}.viewed_at < excluded.viewed_at'
+        ).format(table=table, rows=', '.join(rows))
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+            for user_id in {user_id for user_id, _ in views}:
+                ProductViewHistoryModel.objects.filter(
+                    user=user_id,
+                    pk__in=ProductViewHistoryModel.objects.filter(
+                        user=user_id
+                    ).values('pk')[cls.history_size:]
+                ).delete()
+        return saved
 
     @classmethod
     def remove_item_from_watch_list(cls, user, product):
@@ -70,12 +212,9 @@ class AddLookedProductsService:
         Метод, информирующий есть ли переданный товар в списке просмотренных
          товаров. При наличии товара возвращается True, иначе False.
         """
-        product = ProductViewHistoryModel.objects.filter(
+        return ProductViewHistoryModel.objects.filter(
             user=user, product=product
-        )
-        if len(product):
-            return True
-        return False
+        ).exists()
 
     @classmethod
     def get_the_number_of_items_viewed(cls, user):
@@ -87,6 +226,93 @@ class AddLookedProductsService:
         return quantity
 
 
+class ProductViewCounterService:
+    """
+    Счетчик просмотров товаров. Просмотры накапливаются в кэше counters
+     атомарным увеличением счетчика и периодически переносятся в
+      ProductModel.view_count одним запросом. Одновременно выполняется
+       только один перенос (блокировка lock_key в кэше).
+    """
+    cache_alias = 'counters'
+    pending_key = 'views:pending'
+    processing_key = 'views:processing'
+    lock_key = 'views:flush_lock'
+    lock_timeout = 600
+
+    @classmethod
+    def add_view(cls, product_id):
+        """Учет просмотра товара без обращения к базе данных."""
+        cache = caches[cls.cache_alias]
+        pipeline = get_redis_connection(cls.cache_alias).pipeline(
+            transaction=False)
+        pipeline.incr(cache.make_key('views:{}'.format(product_id)))
+        pipeline.sadd(cache.make_key(cls.pending_key), product_id)
+        pipeline.execute()
+
+    @classmethod
+    def flush(cls) -> int:
+        """
+        Перенос накопленных просмотров в базу данных. Если перенос уже
+         выполняется, возвращает 0. Счетчики забираются и удаляются одной
+          транзакцией Redis до записи в базу, поэтому повторный или
+           прерванный перенос не учитывает просмотры дважды, а просмотры во
+            время переноса попадают в новые счетчики. При ошибке базы
+             забранные значения возвращаются в счетчики. Возвращает
+              количество обновленных товаров.
+        """
+        cache = caches[cls.cache_alias]
+        if not cache.add(cls.lock_key, 1, cls.lock_timeout):
+            return 0
+        try:
+            return cls.flush_counters(cache)
+        finally:
+            cache.delete(cls.lock_key)
+
+    @classmethod
+    def flush_counters(cls, cache) -> int:
+        connection = get_redis_connection(cls.cache_alias)
+        processing_key = cache.make_key(cls.processing_key)
+        if not connection.exists(processing_key):
+            if not connection.exists(cache.make_key(cls.pending_key)):
+                return 0
+            connection.rename(cache.make_key(cls.pending_key), processing_key)
+
+        product_ids = [int(pk) for pk in connection.smembers(processing_key)]
+        counter_keys = [
+            cache.make_key('views:{}'.format(pk)) for pk in product_ids
+        ]
+        views = {}
+        if counter_keys:
+            pipeline = connection.pipeline()
+            pipeline.mget(counter_keys)
+            pipeline.delete(*counter_keys)
+            counts, _ = pipeline.execute()
+            views = {
+                pk: int(count) for pk, count in zip(product_ids, counts)
+                if count and int(count) > 0
+            }
+        if views:
+            try:
+                ProductModel.objects.filter(pk__in=views).update(
+                    view_count=F('view_count') + Case(
+                        *(When(pk=pk, then=Value(count))
+                          for pk, count in views.items()),
+                        output_field=IntegerField()
+                    )
+                )
+            except Exception:
+                pipeline = connection.pipeline()
+                for pk, count in views.items():
+                    pipeline.incrby(
+                        cache.make_key('views:{}'.format(pk)), count)
+                pipeline.sadd(cache.make_key(cls.pending_key), *views)
+                pipeline.delete(processing_key)
+                pipeline.execute()
+                raise
+        connection.delete(processing_key)
+        return len(views)
+
+
 class GetPurchaseHistoryService:
     """Сервис получения истории заказов и покупок пользователем."""
     @classmethod
@@ -123,139 +349,850 @@ class GetDiscountsForProductsService:
     @classmethod
     def get_priority_discount(cls, product: ProductModel):
         """
-        Получение приоритетных скидок на товары. Метод получает экземпляры
-         класса товаров в виде множества (чтобы предотвратить повторы),
-          после чего обращается по каждому товару в базу данных чтобы получить
-           все действующие скидки с наибольшим весом на текущий товар.
+        Получение действующей скидки с наибольшим весом на товар или None.
+         В рамках запроса скидка товара загружается из базы данных один раз
+          (см. get_priority_discounts).
+        """
+        return cls.get_priority_discounts([product]).get(product.pk)
+
+    @classmethod
+    def get_active_discount_relations(cls):
+        """
+        Связи товаров со скидками (промежуточная таблица
+         ProductModel.discounts), действующими на текущую дату.
         """
         today = timezone.now()
-        discount = product.discounts.filter(
-            Q(date_start__date__lte=today) | Q(date_start=None),
-            is_active=True, date_end__date__gte=today
-        ).select_related('type_of_discount').filter(
-            type_of_discount__is_active=True).order_by(
-            '-type_of_discount__weight').first()
-        return discount
+        return ProductModel.discounts.through.objects.filter(
+            Q(discountmodel__date_start__date__lte=today) |
+            Q(discountmodel__date_start=None),
+            discountmodel__is_active=True,
+            discountmodel__date_end__date__gte=today,
+            discountmodel__type_of_discount__is_active=True
+        )
 
     @classmethod
-    def get_discount_price(cls, product: ProductModel, price) -> tuple:
+    def get_priority_discounts(cls, products) -> dict:
         """
-        Метод расчета цены товара с учетом действующей наиболее приоритетной
-         скидки. Максимальная скидка составляет 99 % от цены товара.
+        Получение приоритетных скидок для набора товаров одним запросом.
+         Метод принимает экземпляры класса товаров (или их id) и возвращает
+          словарь {id товара: скидка с наибольшим весом}. Товары без
+           действующих скидок в словарь не попадают.
+        """
+        product_ids = {getattr(product, 'pk', product) for product in products}
+        if not product_ids:
+            return {}
+        # В рамках запроса скидка каждого товара загружается один раз
+        scope = get_discount_scope()
+        if scope is not None:
+            return scope.resolve(product_ids, cls.load_priority_discounts)
+        return cls.load_priority_discounts(product_ids)
+
+    @classmethod
+    def load_priority_discounts(cls, product_ids) -> dict:
+        """Приоритетные скидки товаров с id product_ids из базы данных."""
+        relations = cls.get_active_discount_relations().filter(
+            productmodel_id__in=product_ids
+        ).select_related('discountmodel__type_of_discount').order_by(
+            'productmodel_id', '-discountmodel__type_of_discount__weight',
+            'discountmodel_id'
+        )
+        discounts = {}
+        for relation in relations:
+            discounts.setdefault(
+                relation.productmodel_id, relation.discountmodel
+            )
+        return discounts
+
+    @classmethod
+    def calculate_discount_price(cls, price, discount):
+        """
+        Расчет цены товара с учетом переданной скидки. Максимальная скидка
+         составляет 99 % от цены товара. Если скидки нет, цена возвращается
+          без изменений.
         """
-        discount = cls.get_priority_discount(product)
         if discount:
             discount_prices = 0
             percent_discount = discount.percent_discount
             value_discount = discount.value_discount
             if percent_discount:
-                percent_discount = percent_discount
                 new_price = price - price * percent_discount / 100
                 if new_price >= price * 1 / 100:
                     discount_prices = new_price
                 else:
                     discount_prices = price * 1 / 100
             elif value_discount:
-                value_discount = value_discount
                 new_price = price - value_discount
                 if new_price >= price * 1 / 100:
                     discount_prices = new_price
                 else:
                     discount_prices = price * 1 / 100
             price = round(discount_prices, 2)
-        return price, discount
+        return price
+
+    @classmethod
+    def get_discount_price(cls, product: ProductModel, price) -> tuple:
+        """
+        Метод расчета цены товара с учетом действующей наиболее приоритетной
+         скидки. Максимальная скидка составляет 99 % от цены товара.
+        """
+        discount = cls.get_priority_discount(product)
+        return cls.calculate_discount_price(price, discount), discount
+
+    @classmethod
+    def get_discount_prices(cls, items, use_scope=True) -> dict:
+        """
+        Пакетный расчет цен с учетом приоритетных скидок. Метод принимает
+         пары (товар, цена), где товар - экземпляр ProductModel или
+          ProductOnShopModel, и возвращает словарь
+           {товар: (цена со скидкой, скидка)}. Скидки для всех товаров
+            получаются одним запросом; use_scope=False - скидки всегда
+             загружаются из базы данных, минуя запомненные в запросе.
+        """
+        items = list(items)
+        product_ids = {cls._get_product_id(obj) for obj, _ in items}
+        if use_scope:
+            discounts = cls.get_priority_discounts(product_ids)
+        else:
+            discounts = cls.load_priority_discounts(product_ids) \
+                if product_ids else {}
+        prices = {}
+        for obj, price in items:
+            discount = discounts.get(cls._get_product_id(obj))
+            prices[obj] = (
+                cls.calculate_discount_price(price, discount), discount
+            )
+        return prices
+
+    @staticmethod
+    def _get_product_id(obj):
+        """Id товара для экземпляра ProductModel или ProductOnShopModel."""
+        if isinstance(obj, ProductOnShopModel):
+            return obj.product_id
+        return obj.pk
+
+
+class EffectivePriceService:
+    """
+    Сервис поддержки таблицы итоговых цен товаров в магазинах
+     (EffectivePriceModel) с учетом приоритетных скидок.
+    """
+    batch_size = 500
+
+    @classmethod
+    def update_product_prices(cls, product_ids):
+        """Пересчет итоговых цен во всех магазинах для переданных товаров."""
+        product_ids = list(product_ids)
+        if not product_ids:
+            return 0
+        return cls.update_prices(
+            ProductOnShopModel.objects.filter(product_id__in=product_ids)
+        )
+
+    @classmethod
+    def update_expired_prices(cls):
+        """
+        Пересчет итоговых цен с истекшим сроком действия, а также цен товаров
+         магазинов, для которых итоговая цена еще не рассчитана.
+        """
+        updated = cls.update_prices(
+            ProductOnShopModel.objects.filter(
+                Q(effective_price__valid_until__lte=timezone.now()) |
+                Q(effective_price=None)
+            )
+        )
+        cls.update_min_prices(
+            ProductModel.objects.filter(
+                final_price=None, product_on_shop__isnull=False
+            ).values_list('id', flat=True).distinct()
+        )
+        return updated
+
+    @classmethod
+    def update_prices(cls, product_on_shops):
+        """
+        Пересчет итоговых цен переданных товаров магазинов. Скидки и границы
+         их действия получаются пакетно, записи обновляются через
+          bulk_create/bulk_update. Возвращает количество пересчитанных цен.
+        """
+        product_on_shops = list(
+            product_on_shops.only('id', 'product_id', 'price')
+        )
+        for start in range(0, len(product_on_shops), cls.batch_size):
+            cls._update_batch(
+                product_on_shops[start:start + cls.batch_size]
+            )
+        cls.update_min_prices(
+            {product_on_shop.product_id for product_on_shop
+             in product_on_shops}
+        )
+        return len(product_on_shops)
+
+    @classmethod
+    def update_min_prices(cls, product_ids):
+        """
+        Пересчет минимальной итоговой цены товаров (ProductModel.final_price),
+         по которой каталог сортируется и фильтруется без подзапросов.
+        """
+        product_ids = list(product_ids)
+        if product_ids:
+            ProductModel.objects.filter(pk__in=product_ids).update(
+                final_price=cls.get_min_price_subquery()
+            )
+
+    @classmethod
+    def _update_batch(cls, product_on_shops):
+        # Пересчет запускается сигналами при изменении скидок, поэтому
+        # скидки, запомненные в запросе, могут быть устаревшими
+        prices = GetDiscountsForProductsService.get_discount_prices(
+            ((product_on_shop, product_on_shop.price)
+             for product_on_shop in product_on_shops),
+            use_scope=False
+        )
+        valid_until = cls.get_valid_until(
+            {product_on_shop.product_id for product_on_shop
+             in product_on_shops}
+        )
+        existing = {
+            effective_price.product_on_shop_id: effective_price
+            for effective_price in EffectivePriceModel.objects.filter(
+                product_on_shop__in=product_on_shops
+            )
+        }
+        to_create, to_update = [], []
+        for product_on_shop in product_on_shops:
+            price, discount = prices[product_on_shop]
+            effective_price = existing.get(product_on_shop.pk)
+            if effective_price is None:
+                effective_price = EffectivePriceModel(
+                    product_on_shop_id=product_on_shop.pk
+                )
+                to_create.append(effective_price)
+            else:
+                to_update.append(effective_price)
+            effective_price.price = price
+            effective_price.discount = discount
+            effective_price.valid_until = valid_until.get(
+                product_on_shop.product_id
+            )
+        EffectivePriceModel.objects.bulk_create(to_create)
+        EffectivePriceModel.objects.bulk_update(
+            to_update, ['price', 'discount', 'valid_until']
+        )
+
+    @classmethod
+    def get_valid_until(cls, product_ids) -> dict:
+        """
+        Ближайшая граница действия скидок для каждого товара: начало будущей
+         скидки или окончание действующей. Скидки действуют по дням, поэтому
+          граница приходится на начало суток. Возвращает словарь
+           {id товара: дата и время}.
+        """
+        today = timezone.localdate()
+        relations = ProductModel.discounts.through.objects.filter(
+            productmodel_id__in=product_ids,
+            discountmodel__is_active=True,
+            discountmodel__type_of_discount__is_active=True,
+            discountmodel__date_end__date__gte=today
+        ).values_list(
+            'productmodel_id', 'discountmodel__date_start',
+            'discountmodel__date_end'
+        )
+        valid_until = {}
+        for product_id, date_start, date_end in relations:
+            if (
+                    date_start is not None and
+                    timezone.localtime(date_start).date() > today
+            ):
+                day = timezone.localtime(date_start).date()
+            else:
+                day = timezone.localtime(date_end).date() + timedelta(days=1)
+            boundary = timezone.make_aware(datetime.combine(day, time.min))
+            if (
+                    product_id not in valid_until or
+                    boundary < valid_until[product_id]
+            ):
+                valid_until[product_id] = boundary
+        return valid_until
+
+    @classmethod
+    def get_min_price_annotation(cls):
+        """
+        Выражение для аннотации минимальной итоговой цены товара среди
+         магазинов. Если итоговые цены еще не рассчитаны, используется
+          минимальная цена без скидки.
+        """
+        return Coalesce(
+            Min('product_on_shop__effective_price__price'),
+            Min('product_on_shop__price'),
+            output_field=DecimalField()
+        )
+
+    @classmethod
+    def get_final_price_offers(cls):
+        """Предложения товара OuterRef('pk') с итоговой ценой final_price."""
+        return ProductOnShopModel.objects.filter(
+            product=OuterRef('pk')
+        ).annotate(final_price=Coalesce('effective_price__price', 'price'))
+
+    @classmethod
+    def get_min_price_subquery(cls):
+        """
+        Минимальная итоговая цена товара в виде подзапроса. В отличие от
+         get_min_price_annotation не требует группировки запроса товаров,
+          поэтому по ней можно фильтровать и агрегировать.
+        """
+        offers = cls.get_final_price_offers().order_by(
+            'final_price').values('final_price')[:1]
+        return Subquery(offers, output_field=DecimalField())
+
+
+class StockReservationService:
+    """
+    Резервирование товара магазина для корзин без блокировок строк.
+
+    Остаток уменьшается условным запросом UPDATE ... SET quantity =
+     quantity - n WHERE quantity >= n, поэтому одновременные
+      резервирования не могут увести остаток в минус. Зарезервированное
+       количество записывается в StockReservationModel с временем
+        действия; просроченные резервы возвращает задача
+         release_expired_reservations.
+
+    Владелец резерва - словарь {'user': пользователь} или
+     {'session_key': ключ сессии} (см. get_owner).
+    """
+    batch_size = 500
+
+    @staticmethod
+    def get_owner(request) -> dict:
+        """Владелец резервов текущего запроса."""
+        if request.user.is_authenticated:
+            return {'user': request.user}
+        if request.session.session_key is None:
+            request.session.save()
+        return {'session_key': request.session.session_key}
+
+    @staticmethod
+    def get_expires_at():
+        return timezone.now() + timedelta(
+            seconds=settings.STOCK_RESERVATION_TIME)
+
+    @classmethod
+    def reserve(cls, product_on_shop, quantity, owner) -> bool:
+        """
+        Резервирование quantity единиц товара магазина. Возвращает False,
+         если товара недостаточно или количество не положительное; остаток
+          при этом не меняется. У владельца одна строка резерва на товар
+           магазина (уникальные ограничения StockReservationModel).
+        """
+        if quantity <= 0:
+            return False
+        product_on_shop_id = getattr(product_on_shop, 'pk', product_on_shop)
+        with transaction.atomic():
+            reserved = ProductOnShopModel.objects.filter(
+                pk=product_on_shop_id, quantity__gte=quantity
+            ).update(quantity=F('quantity') - quantity)
+            if not reserved:
+                return False
+            expires_at = cls.get_expires_at()
+            reservation = StockReservationModel.objects.filter(
+                product_on_shop_id=product_on_shop_id, **owner
+            )
+            if not reservation.update(quantity=F('quantity') + quantity,
+                                      expires_at=expires_at):
+                try:
+                    with transaction.atomic():
+                        StockReservationModel.objects.create(
+                            product_on_shop_id=product_on_shop_id,
+                            quantity=quantity, expires_at=expires_at,
+                            **owner
+                        )
+                except IntegrityError:
+                    # Строку одновременно создал другой запрос
+                    reservation.update(quantity=F('quantity') + quantity,
+                                       expires_at=expires_at)
+        cls.stock_changed(product_on_shop_id, 0)
+        return True
+
+    @classmethod
+    def reserve_many(cls, quantities, owner) -> set:
+        """
+        Резервирование нескольких товаров магазинов: quantities - {id
+         товара магазина: количество}. Остатки проверяются одним запросом,
+          товары, которых заведомо недостаточно, не резервируются; для
+           остальных остаток уменьшается условным UPDATE, резервы
+            записываются пакетно. Возвращает id товаров, которые не удалось
+             зарезервировать.
+        """
+        if not quantities:
+            return set()
+        stock = dict(ProductOnShopModel.objects.filter(
+            pk__in=list(quantities)).values_list('pk', 'quantity'))
+        failed = {
+            pk for pk, quantity in quantities.items()
+            if stock.get(pk, 0) < quantity
+        }
+        reserved = {}
+        with transaction.atomic():
+            for pk, quantity in quantities.items():
+                if pk in failed:
+                    continue
+                if ProductOnShopModel.objects.filter(
+                        pk=pk, quantity__gte=quantity
+                ).update(quantity=F('quantity') - quantity):
+                    reserved[pk] = quantity
+                else:
+                    failed.add(pk)
+            if reserved:
+                expires_at = cls.get_expires_at()
+                existing = {}
+                for reservation in StockReservationModel.objects.filter(
+                        product_on_shop_id__in=list(reserved), **owner
+                ).select_for_update():
+                    existing.setdefault(
+                        reservation.product_on_shop_id, reservation)
+                new = []
+                for pk, quantity in reserved.items():
+                    reservation = existing.get(pk)
+                    if reservation is None:
+                        new.append(StockReservationModel(
+                            product_on_shop_id=pk, quantity=quantity,
+                            expires_at=expires_at, **owner
+                        ))
+                    else:
+                        reservation.quantity += quantity
+                        reservation.expires_at = expires_at
+                StockReservationModel.objects.bulk_update(
+                    existing.values(), ['quantity', 'expires_at'])
+                StockReservationModel.objects.bulk_create(new)
+        if reserved:
+            cls.stocks_changed(dict.fromkeys(reserved, 0))
+        return failed
+
+    @classmethod
+    def ensure_reserved(cls, cart, owner) -> set:
+        """
+        Проверка резервов перед оформлением и оплатой заказа. Срок
+         действия резервов владельца продлевается; товар позиций корзины,
+          резерв которого уже истек и вернулся в остаток, резервируется
+           повторно условным UPDATE. Возвращает id товаров магазинов,
+            которых недостаточно - заказ с ними оформлять нельзя.
+        """
+        needed = defaultdict(int)
+        for product_id, quantity in CartProductModel.objects.filter(
+                cart=cart).values_list('product_id', 'quantity'):
+            needed[product_id] += quantity
+        with transaction.atomic():
+            # Продленные резервы не вернет release_expired, поэтому
+            # количество читается после продления
+            StockReservationModel.objects.filter(**owner).update(
+                expires_at=cls.get_expires_at())
+            reserved = dict(StockReservationModel.objects.filter(
+                product_on_shop_id__in=list(needed), **owner
+            ).order_by().values('product_on_shop').annotate(
+                total=Sum('quantity')).values_list('product_on_shop', 'total'))
+            return cls.reserve_many({
+                product_id: quantity - reserved.get(product_id, 0)
+                for product_id, quantity in needed.items()
+                if quantity > reserved.get(product_id, 0)
+            }, owner)
+
+    @classmethod
+    def release(cls, product_on_shop, owner, quantity=None) -> int:
+        """
+        Возврат в остаток quantity единиц (None - всего резерва) товара
+         магазина, зарезервированных владельцем. Возвращается не больше
+          зарезервированного; результат - возвращенное количество.
+        """
+        product_on_shop_id = getattr(product_on_shop, 'pk', product_on_shop)
+        reservations = StockReservationModel.objects.filter(
+            product_on_shop_id=product_on_shop_id, **owner
+        )
+        released = 0
+        with transaction.atomic():
+            for pk, reserved in reservations.values_list('pk', 'quantity'):
+                count = reserved if quantity is None else \
+                    min(reserved, quantity - released)
+                if count <= 0:
+                    break
+                # Условие на количество защищает от двойного возврата при
+                # одновременном освобождении одного резерва
+                if StockReservationModel.objects.filter(
+                        pk=pk, quantity__gte=count).update(
+                        quantity=F('quantity') - count):
+                    released += count
+            reservations.filter(quantity=0).delete()
+            if released:
+                ProductOnShopModel.objects.filter(
+                    pk=product_on_shop_id
+                ).update(quantity=F('quantity') + released)
+        if released:
+            cls.stock_changed(product_on_shop_id, released)
+        return released
+
+    @classmethod
+    def commit(cls, owner) -> int:
+        """
+        Списание резервов владельца после оформления заказа: товар
+         остается вычтенным из остатка.
+        """
+        deleted, _ = StockReservationModel.objects.filter(**owner).delete()
+        return deleted
+
+    @classmethod
+    def assign_to_user(cls, session_key, user) -> int:
+        """
+        Передача резервов сессии пользователю после входа. Резерв сессии
+         на товар, который пользователь уже зарезервировал, добавляется
+          к его строке, остальные строки переходят к пользователю.
+        """
+        if not session_key:
+            return 0
+        expires_at = cls.get_expires_at()
+        with transaction.atomic():
+            session_reservations = list(
+                StockReservationModel.objects.select_for_update().filter(
+                    session_key=session_key, user=None)
+            )
+            if not session_reservations:
+                return 0
+            user_reservations = {
+                reservation.product_on_shop_id: reservation
+                for reservation in
+                StockReservationModel.objects.select_for_update().filter(
+                    user=user, product_on_shop_id__in=[
+                        reservation.product_on_shop_id
+                        for reservation in session_reservations
+                    ]
+                )
+            }
+            merged = []
+            for reservation in session_reservations:
+                target = user_reservations.get(reservation.product_on_shop_id)
+                if target is not None:
+                    target.quantity += reservation.quantity
+                    target.expires_at = expires_at
+                    merged.append(reservation.pk)
+            StockReservationModel.objects.bulk_update(
+                user_reservations.values(), ['quantity', 'expires_at'])
+            StockReservationModel.objects.filter(pk__in=merged).delete()
+            StockReservationModel.objects.filter(
+                session_key=session_key, user=None
+            ).update(session_key='', user=user, expires_at=expires_at)
+        return len(session_reservations)
+
+    @classmethod
+    def release_expired(cls) -> int:
+        """
+        Возврат в остаток просроченных резервов. Резервы выбираются с
+         блокировкой (занятые другими транзакциями пропускаются), остатки
+          всех товаров пачки возвращаются одним запросом.
+        """
+        released = 0
+        while True:
+            with transaction.atomic():
+                reservations = list(
+                    StockReservationModel.objects.select_for_update(
+                        skip_locked=True
+                    ).filter(expires_at__lte=timezone.now()).values_list(
+                        'pk', 'product_on_shop_id', 'quantity'
+                    )[:cls.batch_size]
+                )
+                if not reservations:
+                    break
+                quantities = defaultdict(int)
+                for _, product_on_shop_id, quantity in reservations:
+                    quantities[product_on_shop_id] += quantity
+                StockReservationModel.objects.filter(
+                    pk__in=[pk for pk, _, _ in reservations]).delete()
+                ProductOnShopModel.objects.filter(
+                    pk__in=quantities
+                ).update(quantity=F('quantity') + Case(
+                    *(When(pk=pk, then=Value(quantity))
+                      for pk, quantity in quantities.items()),
+                    output_field=IntegerField()
+                ))
+            dependencies = []
+            for product_id, category_id in ProductOnShopModel.objects.filter(
+                    pk__in=quantities
+            ).values_list('product_id', 'product__category_id'):
+                dependencies += [
+                    dependency(ProductOnShopModel, product_id=product_id),
+                    dependency(ProductOnShopModel,
+                               product__category_id=category_id),
+                ]
+            invalidate(dependencies)
+            released += len(reservations)
+        return released
+
+    @classmethod
+    def stock_changed(cls, product_on_shop_id, returned):
+        cls.stocks_changed({product_on_shop_id: returned})
+
+    @staticmethod
+    def stocks_changed(returned):
+        """
+        Сброс кэша предложений товаров, которые закончились или снова
+         появились в наличии: returned - {id товара магазина: возвращенное
+          количество (0 после резервирования)}, товар изменился, если
+           остаток равен возвращенному количеству. Остаток меняется
+            запросами UPDATE без сигналов, поэтому проверяется отдельно.
+        """
+        dependencies = []
+        for pk, quantity, product_id, category_id in \
+                ProductOnShopModel.objects.filter(
+                    pk__in=list(returned)
+                ).values_list('pk', 'quantity', 'product_id',
+                              'product__category_id'):
+            if quantity == returned[pk]:
+                dependencies += [
+                    dependency(ProductOnShopModel, pk),
+                    dependency(ProductOnShopModel, product_id=product_id),
+                    dependency(ProductOnShopModel,
+                               product__category_id=category_id),
+                ]
+        if dependencies:
+            invalidate(dependencies)
+
+
+class CartTotalsService:
+    """
+    Итоги корзины (количество и сумма) - производные от позиций
+     корзины. При изменении позиции итоги меняются атомарным UPDATE с F()
+      в той же транзакции, поэтому одновременные запросы не теряют
+       изменений. Разошедшиеся итоги исправляет reconcile (команда
+        reconcile_carts).
+    """
+    batch_size = 500
+
+    @classmethod
+    def change(cls, cart, quantity, price):
+        """Изменение итогов корзины на quantity товаров и сумму price."""
+        CartModel.objects.filter(pk=cart.pk).update(
+            quantity=F('quantity') + quantity,
+            total_price=F('total_price') + price
+        )
+        cart.refresh_from_db(fields=['quantity', 'total_price'])
+        # UPDATE не отправляет сигналов
+        cart_changed(cart.user_id)
+
+    @staticmethod
+    def get_totals() -> dict:
+        """Итоги корзины по ее позициям: подзапросы для UPDATE."""
+        lines = CartProductModel.objects.filter(
+            cart=OuterRef('pk')).order_by().values('cart')
+        price_field = DecimalField(max_digits=10, decimal_places=2)
+        return {
+            'quantity': Coalesce(Subquery(
+                lines.annotate(total=Sum('quantity')).values('total'),
+                output_field=IntegerField()
+            ), 0),
+            'total_price': Coalesce(Subquery(
+                lines.annotate(total=Sum('price')).values('total'),
+                output_field=price_field
+            ), Value(0), output_field=price_field),
+        }
+
+    @classmethod
+    def recalculate(cls, cart):
+        """Пересчет итогов корзины по позициям одним запросом."""
+        CartModel.objects.filter(pk=cart.pk).update(**cls.get_totals())
+        cart.refresh_from_db(fields=['quantity', 'total_price'])
+        cart_changed(cart.user_id)
+
+    @classmethod
+    def reconcile(cls, carts=None) -> int:
+        """
+        Исправление корзин, итоги которых разошлись с позициями. Корзины
+         находятся одним запросом и пересчитываются пачками по batch_size.
+          Возвращает количество исправленных корзин.
+        """
+        if carts is None:
+            carts = CartModel.objects.all()
+        totals = cls.get_totals()
+        drifted = list(carts.annotate(
+            real_quantity=totals['quantity'],
+            real_total_price=totals['total_price']
+        ).exclude(
+            quantity=F('real_quantity'),
+            total_price=F('real_total_price')
+        ).values_list('pk', 'user_id'))
+        for start in range(0, len(drifted), cls.batch_size):
+            batch = drifted[start:start + cls.batch_size]
+            CartModel.objects.filter(
+                pk__in=[pk for pk, _ in batch]).update(**totals)
+        for user_id in {user_id for _, user_id in drifted if user_id}:
+            cart_changed(user_id)
+        return len(drifted)
 
 
 class AddItemToCart:
     """Сервис добавления товара в корзину."""
     @classmethod
     def add_item_to_cart(cls, cart, product, amount, price):
-        """Добавление товара в корзину."""
-        cart.quantity += amount
-        cart.total_price += price * amount
-        cart.products.add(product)
-        cart.save()
+        """Добавление товара в корзину, price - цена единицы товара."""
+        with transaction.atomic():
+            cart.products.add(product)
+            CartTotalsService.change(cart, amount, price * amount)
 
     @classmethod
     def increasing_the_number_of_items_in_the_cart(cls, cart, amount, price):
         """Увеличение количества товара в корзине."""
-        cart.quantity += amount
-        cart.total_price += price * amount
-        cart.save()
+        CartTotalsService.change(cart, amount, price * amount)
+
+    @classmethod
+    def add_product(cls, user, product, amount, price):
+        """
+        Добавление amount единиц товара магазина по цене price в активную
+         корзину пользователя (если ее нет - создается). Позиция и итоги
+          корзины меняются атомарными UPDATE в одной транзакции.
+          Одновременные запросы выполняются по очереди (см.
+           get_cart_for_update) и не создают две позиции одного товара.
+        """
+        with transaction.atomic():
+            cart = cls.get_cart_for_update(user)
+            updated = CartProductModel.objects.filter(
+                cart=cart, product=product
+            ).update(quantity=F('quantity') + amount,
+                     price=F('price') + price * amount)
+            if updated:
+                cls.increasing_the_number_of_items_in_the_cart(
+                    cart, amount, price)
+            else:
+                cart_product = CartProductModel.objects.create(
+                    user=user, product=product, quantity=amount,
+                    price=price * amount
+                )
+                cls.add_item_to_cart(cart, cart_product, amount, price)
+        return cart
+
+    @staticmethod
+    def get_cart_for_update(user):
+        """
+        Активная корзина пользователя (если ее нет - создается) с
+         блокировкой до конца транзакции. Если корзины нет, блокируется
+          строка пользователя, чтобы одновременные запросы не создали две
+           корзины.
+        """
+        carts = CartModel.objects.select_for_update().filter(
+            user=user, status='actively')
+        cart = carts.first()
+        if cart is None:
+            list(get_user_model().objects.select_for_update().filter(
+                pk=user.pk).values_list('pk'))
+            cart = carts.first() or CartModel.objects.create(
+                user=user, status='actively')
+        return cart
+
+    @staticmethod
+    def add_cart_products(cart, cart_products):
+        """
+        Пакетное создание позиций корзины (несохраненных экземпляров
+         CartProductModel) и добавление их в корзину. Если база данных не
+          возвращает id созданных строк, они выбираются по id больше
+           последнего существовавшего, чтобы не захватить старые позиции
+            пользователя без корзины.
+        """
+        if not cart_products:
+            return
+        last_pk = None
+        if not connection.features.can_return_rows_from_bulk_insert:
+            last_pk = CartProductModel.objects.aggregate(
+                last_pk=Coalesce(Max('pk'), 0))['last_pk']
+        created = CartProductModel.objects.bulk_create(cart_products)
+        if last_pk is not None:
+            created = CartProductModel.objects.filter(
+                pk__gt=last_pk, user_id=cart.user_id, cart=None,
+                product_id__in=[
+                    cart_product.product_id for cart_product in cart_products
+                ]
+            )
+        cart.products.add(*created)
+
+    @staticmethod
+    def get_cart_product(cart, product):
+        """Позиция корзины с блокировкой до конца транзакции."""
+        if cart is None:
+            return None
+        return CartProductModel.objects.select_for_update().filter(
+            cart=cart, product=product).first()
 
     @classmethod
     def remove_item_from_cart(cls, request, product):
         """Убирает товар из корзины."""
         if not isinstance(request.user, AnonymousUser):
-            cart = CartModel.objects.filter(
-                user=request.user, status='actively').prefetch_related(
-                'products').first()
-            cart_product = cart.products.get(product=product)
-
-            cart.total_price -= cart_product.price * cart_product.quantity
-            if cart.total_price < 0:
-                cart.total_price = 0
-
-            cart.quantity -= cart_product.quantity
-            if cart.quantity < 0:
-                cart.quantity = 0
-
-            cart.products.remove(cart_product)
-            cart.save()
-            cart_product.delete()
-
-            new_cart = CartModel.objects.filter(
-                user=request.user, status='actively').prefetch_related(
-                'products').first()
+            with transaction.atomic():
+                cart = CartModel.objects.filter(
+                    user=request.user, status='actively').first()
+                cart_product = cls.get_cart_product(cart, product)
+                if cart_product is not None:
+                    cart.products.remove(cart_product)
+                    cart_product.delete()
+                    CartTotalsService.change(
+                        cart, -cart_product.quantity, -cart_product.price)
+            StockReservationService.release(product, {'user': request.user})
+            if cart is None:
+                return None
+
             products_in_cart = AddItemToCart().get_products_list_from_cart(
-                cart=new_cart
+                cart=cart
             )
         else:
             cart = Cart(request)
             cart.delete(product)
+            StockReservationService.release(
+                product, StockReservationService.get_owner(request))
             products_in_cart = cart
 
         return products_in_cart
 
     @classmethod
-    def change_item_count_cart(cls, request, product, count):
-        """Изменяет количество товара в CartProduct."""
+    def change_item_count_cart(cls, request, product, count, reserve=True):
+        """
+        Изменяет количество товара в CartProduct. Товар резервируется
+         (возвращается в остаток при уменьшении количества); reserve=False
+          - товар уже зарезервирован, например, в корзине сессии. Цена
+           единицы - цена, по которой товар добавлен в корзину.
+        """
         if not isinstance(request.user, AnonymousUser):
-            cart = CartModel.objects.filter(
-                user=request.user, status='actively').prefetch_related(
-                'products').first()
-
-            cart_product = cart.products.get(product=product)
-            if count < 0:
-                cart_product.price -= product.price
-                cart.total_price -= product.price
-            else:
-                if product.quantity >= count:
-                    cart_product.price += product.price
-                    cart.total_price += product.price
-                else:
+            with transaction.atomic():
+                cart = CartModel.objects.filter(
+                    user=request.user, status='actively').first()
+                cart_product = cls.get_cart_product(cart, product)
+                if cart_product is None or \
+                        cart_product.quantity + count < 0:
+                    return 'error', None, None
+                if count < 0:
+                    StockReservationService.release(
+                        product, {'user': request.user}, -count)
+                elif reserve and count and not StockReservationService.reserve(
+                        product, count, {'user': request.user}):
                     return 'error', None, None
 
-            cart_product.quantity += count
-            cart.quantity += count
-            product.quantity -= count
-
-            cart_product.save()
-            product.save()
-            cart.save()
+                if cart_product.quantity:
+                    price = (
+                        cart_product.price / cart_product.quantity
+                    ).quantize(Decimal('0.01'))
+                else:
+                    price = product.price
+                CartProductModel.objects.filter(pk=cart_product.pk).update(
+                    quantity=F('quantity') + count,
+                    price=F('price') + price * count
+                )
+                CartTotalsService.change(cart, count, price * count)
             count_products_in_cart = cart.quantity
             total_price_cart = cart.total_price
 
         else:
-            if product.quantity >= count:
-                product.quantity -= count
-                product.save()
-                cart = Cart(request)
-                cart.update(product, qty=count)
-                count_products_in_cart = cart.__len__()
-                total_price_cart = cart.get_total_price()
-            else:
+            owner = StockReservationService.get_owner(request)
+            if count < 0:
+                StockReservationService.release(product, owner, -count)
+            elif reserve and count and not StockReservationService.reserve(
+                    product, count, owner):
                 return 'error', None, None
+            cart = Cart(request)
+            cart.update(product, qty=count)
+            count_products_in_cart = cart.__len__()
+            total_price_cart = cart.get_total_price()
 
         return None, count_products_in_cart, total_price_cart
 
@@ -276,6 +1213,258 @@ class AddItemToCart:
         return cart.total_price
 
 
+class CartMergeService:
+    """Перенос корзины сессии в корзину пользователя при входе."""
+    @classmethod
+    def merge(cls, request, user) -> int:
+        """
+        Товары корзины сессии добавляются в активную корзину пользователя
+         (если ее нет - создается) одной транзакцией: позиции корзины
+          загружаются одним запросом, новые создаются bulk_create,
+           измененные сохраняются bulk_update, итоги корзины пересчитываются
+            один раз. Число запросов не зависит от размера корзины. Товар
+             уже зарезервирован (StockReservationService.assign_to_user),
+              поэтому повторно не резервируется. Возвращает количество
+               перенесенных позиций.
+        """
+        session_cart = Cart(request)
+        items = session_cart.items
+        if not items:
+            return 0
+        with transaction.atomic():
+            cart = AddItemToCart.get_cart_for_update(user)
+            # Товары магазинов, удаленные после добавления в корзину
+            # сессии, пропускаются
+            product_ids = set(ProductOnShopModel.objects.filter(
+                pk__in=list(items)).values_list('pk', flat=True))
+            existing = {
+                cart_product.product_id: cart_product
+                for cart_product in cart.products.filter(
+                    product_id__in=product_ids)
+            }
+            new, changed = [], []
+            for product_id, (qty, price) in items.items():
+                if product_id not in product_ids:
+                    continue
+                line_price = from_kopecks(qty * price)
+                cart_product = existing.get(product_id)
+                if cart_product is None:
+                    new.append(CartProductModel(
+                        user=user, product_id=product_id, quantity=qty,
+                        price=line_price
+                    ))
+                else:
+                    cart_product.quantity += qty
+                    cart_product.price += line_price
+                    changed.append(cart_product)
+            CartProductModel.objects.bulk_update(
+                changed, ['quantity', 'price'])
+            AddItemToCart.add_cart_products(cart, new)
+            CartTotalsService.recalculate(cart)
+        session_cart.clear()
+        return len(new) + len(changed)
+
+
+class CartBatchService:
+    """
+    Пакетное изменение корзины. Операция - словарь {'action', 'id',
+     'quantity'}: add - добавить quantity (может быть отрицательным)
+      единиц товара магазина id, set - установить количество, remove -
+       убрать товар из корзины. Операции применяются по порядку и сводятся
+        к итоговому количеству каждого товара, после чего корзина меняется
+         одной транзакцией: остатки проверяются и резервируются пакетно,
+          цены новых товаров со скидками рассчитываются одним запросом.
+    """
+    actions = ('add', 'set', 'remove')
+    max_operations = 100
+
+    @classmethod
+    def parse(cls, operations) -> list:
+        """
+        Проверка операций, результат - список (действие, id, количество).
+         При неверных данных - ValueError.
+        """
+        if not isinstance(operations, list) or \
+                not 0 < len(operations) <= cls.max_operations:
+            raise ValueError('Invalid operations')
+        parsed = []
+        for operation in operations:
+            try:
+                action = operation['action']
+                product_id = int(operation['id'])
+                quantity = int(operation.get('quantity', 1))
+            except (KeyError, TypeError, ValueError):
+                raise ValueError('Invalid operation')
+            if action not in cls.actions or \
+                    action == 'set' and quantity < 0:
+                raise ValueError('Invalid operation')
+            parsed.append((action, product_id, quantity))
+        return parsed
+
+    @staticmethod
+    def get_targets(current, operations) -> dict:
+        """
+        Итоговое количество товаров, которые меняются: {id товара
+         магазина: количество}. current - количество товаров в корзине.
+        """
+        targets = {}
+        for action, product_id, quantity in operations:
+            value = targets.get(product_id, current.get(product_id, 0))
+            if action == 'add':
+                value = max(value + quantity, 0)
+            elif action == 'set':
+                value = quantity
+            else:
+                value = 0
+            targets[product_id] = value
+        return {
+            product_id: value for product_id, value in targets.items()
+            if value != current.get(product_id, 0)
+        }
+
+    @classmethod
+    def change_stock(cls, current, operations, owner) -> tuple:
+        """
+        Резервирование добавляемого и возврат в остаток убираемого товара.
+         Возвращает (итоговое количество, товары магазинов, ошибки);
+          товары с ошибками не меняются.
+        """
+        targets = cls.get_targets(current, operations)
+        products = ProductOnShopModel.objects.in_bulk(list(targets))
+        errors = {}
+        for product_id, value in list(targets.items()):
+            if value and product_id not in products:
+                errors[product_id] = 'not_found'
+                del targets[product_id]
+        increases = {
+            product_id: value - current.get(product_id, 0)
+            for product_id, value in targets.items()
+            if value > current.get(product_id, 0)
+        }
+        for product_id in StockReservationService.reserve_many(
+                increases, owner):
+            errors[product_id] = 'not_enough'
+            del targets[product_id]
+        for product_id, value in targets.items():
+            if value < current.get(product_id, 0):
+                StockReservationService.release(
+                    product_id, owner, current[product_id] - value)
+        return targets, products, errors
+
+    @staticmethod
+    def get_prices(products) -> dict:
+        """Цены единицы товаров магазинов со скидками: {id: цена}."""
+        prices = GetDiscountsForProductsService.get_discount_prices(
+            (product, product.price) for product in products)
+        return {product.pk: price for product, (price, _) in prices.items()}
+
+    @classmethod
+    def apply(cls, request, operations) -> dict:
+        """
+        Применение проверенных операций (см. parse) к корзине текущего
+         пользователя или сессии. Возвращает новое состояние корзины.
+        """
+        owner = StockReservationService.get_owner(request)
+        if request.user.is_authenticated:
+            with transaction.atomic():
+                return cls.apply_to_user_cart(
+                    request.user, owner, operations)
+        return cls.apply_to_session_cart(request, owner, operations)
+
+    @classmethod
+    def apply_to_user_cart(cls, user, owner, operations) -> dict:
+        cart = AddItemToCart.get_cart_for_update(user)
+        lines = {
+            cart_product.product_id: cart_product
+            for cart_product in CartProductModel.objects.filter(
+                cart=cart).select_for_update()
+        }
+        targets, products, errors = cls.change_stock(
+            {product_id: line.quantity for product_id, line in lines.items()},
+            operations, owner
+        )
+        prices = cls.get_prices(
+            products[product_id] for product_id, value in targets.items()
+            if value and product_id not in lines
+        )
+        new, changed, deleted = [], [], []
+        for product_id, value in targets.items():
+            line = lines.get(product_id)
+            if not value:
+                deleted.append(lines.pop(product_id))
+                continue
+            if line is None:
+                line = lines[product_id] = CartProductModel(
+                    user=user, product_id=product_id, quantity=0)
+                new.append(line)
+                price = prices[product_id]
+            else:
+                changed.append(line)
+                price = line.price / line.quantity if line.quantity else \
+                    products[product_id].price
+            line.quantity = value
+            line.price = (price * value).quantize(Decimal('0.01'))
+        if deleted:
+            cart.products.remove(*deleted)
+            CartProductModel.objects.filter(
+                pk__in=[line.pk for line in deleted]).delete()
+        CartProductModel.objects.bulk_update(changed, ['quantity', 'price'])
+        AddItemToCart.add_cart_products(cart, new)
+        CartTotalsService.recalculate(cart)
+        return cls.get_state(
+            {
+                product_id: (line.quantity, line.price)
+                for product_id, line in lines.items()
+            },
+            cart.quantity, cart.total_price, errors
+        )
+
+    @classmethod
+    def apply_to_session_cart(cls, request, owner, operations) -> dict:
+        cart = Cart(request)
+        targets, products, errors = cls.change_stock(
+            {product_id: qty for product_id, (qty, _) in cart.items.items()},
+            operations, owner
+        )
+        prices = cls.get_prices(
+            products[product_id] for product_id, value in targets.items()
+            if value and product_id not in cart.items
+        )
+        items = {}
+        for product_id, value in targets.items():
+            if product_id in prices:
+                price = prices[product_id]
+            elif value:
+                price = from_kopecks(cart.items[product_id][1])
+            else:
+                price = None
+            items[product_id] = (value, price)
+        cart.set_items(items)
+        return cls.get_state(
+            {
+                product_id: (qty, from_kopecks(qty * price))
+                for product_id, (qty, price) in cart.items.items()
+            },
+            len(cart), cart.get_total_price(), errors
+        )
+
+    @staticmethod
+    def get_state(items, quantity, total_price, errors) -> dict:
+        """Состояние корзины для ответа: позиции, итоги и ошибки."""
+        return {
+            'items': [
+                {'id': product_id, 'quantity': qty, 'price': price}
+                for product_id, (qty, price) in items.items()
+            ],
+            'quantity': quantity,
+            'total_price': total_price,
+            'errors': [
+                {'id': product_id, 'error': error}
+                for product_id, error in errors.items()
+            ],
+        }
+
+
 class AddCommentToProductService:
     """Добавление отзыва к товару."""
     @classmethod
@@ -306,6 +1495,23 @@ class AddCommentToProductService:
         reviews = product.review.filter(is_active=True).count()
         return reviews
 
+    @classmethod
+    def recount_reviews(cls, products=None) -> int:
+        """
+        Пересчет ProductModel.review_count по активным отзывам одним
+         запросом UPDATE (например, для базы, где счетчик еще не
+          заполнялся). Возвращает количество обновленных товаров.
+        """
+        if products is None:
+            products = ProductModel.objects.all()
+        return products.update(review_count=Coalesce(Subquery(
+            ReviewModel.objects.filter(
+                product=OuterRef('pk'), is_active=True
+            ).order_by().values('product').annotate(
+                count=Count('pk')).values('count'),
+            output_field=IntegerField()
+        ), 0))
+
 
 class ComparedProductsListService:
     """Список сравниваемых товаров."""
@@ -356,100 +1562,592 @@ class PaymentService:
         pass
 
 
+class CachedDataService:
+    """
+    Данные магазинов, товаров, тегов и категорий для шаблонов. В кэш
+     записываются только простые словари и списки, поэтому при попадании
+      в кэш запросы к базе данных не выполняются.
+    """
+    cache_alias = 'catalog'
+
+    @classmethod
+    def get_shop(cls, slug):
+        """Магазин по slug или None, если магазин не найден."""
+        return get_or_set(
+            'shop:{}'.format(slug), lambda: cls.build_shop(slug),
+            settings.CATALOG_CACHE_TIME, cache_alias=cls.cache_alias,
+            depends_on=cls.get_shop_dependencies
+        )
+
+    @classmethod
+    def get_product(cls, slug):
+        """Активный товар по slug или None, если товар не найден."""
+        return get_or_set(
+            'product:{}'.format(slug), lambda: cls.build_product(slug),
+            settings.CATALOG_CACHE_TIME, cache_alias=cls.cache_alias,
+            depends_on=cls.get_product_dependencies
+        )
+
+    @classmethod
+    def get_tags(cls, product):
+        """Список названий тегов товара."""
+        return get_or_set(
+            'tags:{}'.format(product['slug']),
+            lambda: list(TagsModel.objects.filter(
+                product=product['id']).values_list('name', flat=True)),
+            settings.CATALOG_CACHE_TIME, cache_alias=cls.cache_alias,
+            depends_on=[dependency(TagsModel, product_id=product['id'])]
+        )
+
+    @classmethod
+    def get_categories(cls):
+        """Список активных категорий."""
+        return get_or_set(
+            'categories', cls.build_categories,
+            settings.CATALOG_CACHE_TIME, cache_alias=cls.cache_alias,
+            depends_on=cls.get_categories_dependencies
+        )
+
+    @classmethod
+    def get_shop_dependencies(cls, shop):
+        if shop is None:
+            return [dependency(ShopModel)]
+        return [
+            dependency(ShopModel, shop['id']), dependency(ShopAddressModel),
+            *cls.get_file_dependencies([shop['image']])
+        ]
+
+    @classmethod
+    def get_product_dependencies(cls, product):
+        if product is None:
+            return [dependency(ProductModel)]
+        return [
+            dependency(ProductModel, product['id']),
+            dependency(CharacteristicModel),
+            dependency(CharacteristicNameModel),
+            dependency(ValueModel),
+            *cls.get_file_dependencies(
+                [product['main_image'], *product['gallery']])
+        ]
+
+    @classmethod
+    def get_categories_dependencies(cls, categories):
+        dependencies = [dependency(CategoryModel)]
+        for category in categories:
+            dependencies.append(
+                dependency(ProductModel, category_id=category['id']))
+            dependencies += cls.get_file_dependencies(
+                [category['icon'], category['image']])
+        return dependencies
+
+    @staticmethod
+    def get_file_dependencies(files):
+        return [dependency(FilesModel, file['id']) for file in files if file]
+
+    @classmethod
+    def build_shop(cls, slug):
+        shop = ShopModel.objects.filter(slug=slug).select_related(
+            'image').prefetch_related('address').first()
+        if shop is None:
+            return None
+        return {
+            'id': shop.pk,
+            'slug': shop.slug,
+            'name': shop.name,
+            'description': shop.description,
+            'phone': shop.phone,
+            'email': shop.email,
+            'address': [str(address) for address in shop.address.all()],
+            'image': cls.get_file_data(shop.image),
+        }
+
+    @classmethod
+    def build_product(cls, slug):
+        product = ProductModel.objects.filter(
+            is_active=True, slug=slug
+        ).select_related('main_image').prefetch_related(
+            'gallery',
+            Prefetch(
+                'characteristics',
+                queryset=CharacteristicModel.objects.select_related(
+                    'name', 'value')
+            )
+        ).first()
+        if product is None:
+            return None
+        return {
+            'id': product.pk,
+            'slug': product.slug,
+            'model': product.model,
+            'description': product.description,
+            'main_image': cls.get_file_data(product.main_image),
+            'gallery': [
+                cls.get_file_data(image) for image in product.gallery.all()
+            ],
+            'characteristics': [
+                (characteristic.name.name, characteristic.value.value)
+                for characteristic in product.characteristics.all()
+            ],
+        }
+
+    @classmethod
+    def build_categories(cls):
+        """
+        Категории с иконкой и изображением первого товара категории.
+         Изображения товаров загружаются одним запросом для всех категорий.
+        """
+        images = ProductModel.objects.filter(
+            category=OuterRef('pk')).order_by('id').values('main_image')[:1]
+        categories = list(
+            CategoryModel.objects.filter(is_active=True).select_related(
+                'icon').annotate(image_id=Subquery(images))
+        )
+        files = FilesModel.objects.in_bulk(
+            category.image_id for category in categories
+            if category.image_id is not None
+        )
+        return [
+            {
+                'id': category.pk,
+                'slug': category.slug,
+                'name': category.name,
+                'icon': cls.get_file_data(category.icon),
+                'image': cls.get_file_data(files.get(category.image_id)),
+            }
+            for category in categories
+        ]
+
+    @staticmethod
+    def get_file_data(file):
+        """Ссылка и имя файла или None, если файла нет."""
+        if file is None or not file.file:
+            return None
+        return {
+            'id': file.pk, 'url': file.file.url, 'filename': file.filename()
+        }
+
+
+class ProductPageService:
+    """
+    Сборка данных страницы товара: теги, отзывы, предложения магазинов
+     и цены со скидками. Число запросов не зависит от количества тегов,
+      отзывов и предложений: товар с количеством отзывов, теги,
+       предложения с магазинами, отзывы с пользователями и скидки всех
+        предложений загружаются по одному запросу. Как и в
+         CachedDataService, в кэш записываются только словари с полями,
+          которые выводит шаблон.
+    """
+    cache_alias = 'pages'
+    # Количество отзывов, выводимых до нажатия "Показать еще"
+    review_count = 2
+
+    @classmethod
+    def get_page(cls, product, all_reviews=False) -> dict:
+        """Данные страницы товара (product - словарь CachedDataService)."""
+        key = 'product_page:{}:{}'.format(
+            'all' if all_reviews else 'short', product['slug']
+        )
+        return get_or_set(
+            key,
+            lambda: cls.build_page(
+                product['id'], None if all_reviews else cls.review_count),
+            settings.PAGES_CACHE_TIME, cache_alias=cls.cache_alias,
+            depends_on=lambda page: cls.get_page_dependencies(
+                product['id'], page)
+        )
+
+    @classmethod
+    def build_page(cls, product_id, review_count=None) -> dict:
+        """
+        Теги, количество и список активных отзывов (первые review_count,
+         None - все), предложения магазинов с ценами со скидками и самое
+          дешевое предложение.
+        """
+        product = ProductModel.objects.filter(pk=product_id).annotate(
+            active_review_count=Count(
+                'review', filter=Q(review__is_active=True))
+        ).prefetch_related(
+            Prefetch('tags', queryset=TagsModel.objects.only(
+                'id', 'name', 'product_id')),
+            Prefetch(
+                'product_on_shop',
+                queryset=ProductOnShopModel.objects.filter(
+                    for_sale=True, quantity__gt=0).select_related('shop'),
+                to_attr='offers'
+            )
+        ).only('id', 'slug').first()
+        if product is None:
+            return {'tags': [], 'review_count': 0, 'reviews': [],
+                    'offers': [], 'min_price': 0}
+        reviews = product.review.filter(is_active=True).values(
+            'review', 'add_datetime', 'user__first_name', 'user__last_name')
+        if review_count is not None:
+            reviews = reviews[:review_count]
+        offers, min_price = cls.get_offer_prices(product.offers)
+        return {
+            'tags': [tag.name for tag in product.tags.all()],
+            'review_count': product.active_review_count,
+            'reviews': [
+                {
+                    'review': review['review'],
+                    'add_datetime': review['add_datetime'],
+                    'user': {
+                        'first_name': review['user__first_name'],
+                        'last_name': review['user__last_name'],
+                    },
+                }
+                for review in reviews
+            ],
+            'offers': offers,
+            'min_price': min_price,
+        }
+
+    @classmethod
+    def get_offer_prices(cls, offers):
+        """
+        Пары ((цена со скидкой, скидка), предложение) и самое дешевое
+         предложение. Скидки всех предложений получаются одним запросом.
+        """
+        if not offers:
+            return [], 0
+        discount_prices = GetDiscountsForProductsService.get_discount_prices(
+            (offer, offer.price) for offer in offers
+        )
+        offers = [
+            (
+                (discount_prices[offer][0],
+                 cls.serialize_discount(discount_prices[offer][1])),
+                cls.serialize_offer(offer)
+            )
+            for offer in offers
+        ]
+        return offers, min(offers, key=lambda elem: elem[0][0])
+
+    @staticmethod
+    def serialize_offer(offer) -> dict:
+        return {
+            'id': offer.pk,
+            'pk': offer.pk,
+            'price': offer.price,
+            'shop': {
+                'id': offer.shop_id,
+                'name': offer.shop.name,
+                'slug': offer.shop.slug,
+            },
+        }
+
+    @staticmethod
+    def serialize_discount(discount):
+        if discount is None:
+            return None
+        return {
+            'id': discount.pk,
+            'percent_discount': discount.percent_discount,
+            'value_discount': discount.value_discount,
+        }
+
+    @staticmethod
+    def get_page_dependencies(product_id, page) -> list:
+        """
+        Страница зависит от тегов, отзывов и предложений товара, самого
+         товара, магазинов предложений и скидок.
+        """
+        return [
+            dependency(ProductModel, product_id),
+            dependency(TagsModel, product_id=product_id),
+            dependency(ReviewModel, product_id=product_id),
+            dependency(ProductOnShopModel, product_id=product_id),
+            dependency(DiscountModel),
+            dependency(TypeOfDiscountModel),
+            *(dependency(ShopModel, offer['shop']['id'])
+              for _, offer in page['offers'])
+        ]
+
+
 class HomePageService:
     """
     Сервис для реализации блоков "Предложения дня", "Популярные товары",
      "Горячие предложения", "Ограниченный тираж" на главной странице.
     """
+    cache_alias = 'pages'
+    main_page_cache_key = 'main_page'
+    id_pools = ('banners', 'limited_products', 'hot_products')
+
+    @classmethod
+    def get_main_page_blocks(cls) -> dict:
+        """
+        Получение блоков главной страницы из кэша. Блоки заранее собираются
+         периодической задачей warm_up_main_page; если кэш пуст (например,
+          celery beat не запущен), блоки собираются при запросе.
+        """
+        return get_or_set(
+            cls.main_page_cache_key, cls.build_main_page_blocks,
+            settings.MAIN_PAGE_CACHE_TIME, cache_alias=cls.cache_alias, beta=0,
+            depends_on=cls.get_main_page_dependencies
+        )
+
+    @classmethod
+    def warm_up_main_page(cls, refresh_pools=False) -> dict:
+        """
+        Сборка всех блоков главной страницы и их запись в кэш одним ключом,
+         чтобы посетители никогда не видели частично обновленные блоки.
+          При refresh_pools=True предварительно обновляются пулы id для
+           случайной выборки.
+        """
+        if refresh_pools:
+            caches[cls.cache_alias].delete_many(
+                ['id_pool:{}'.format(name) for name in cls.id_pools]
+            )
+        blocks = cls.build_main_page_blocks()
+        set_value(
+            cls.main_page_cache_key, blocks, settings.MAIN_PAGE_CACHE_TIME,
+            cache_alias=cls.cache_alias,
+            depends_on=cls.get_main_page_dependencies
+        )
+        return blocks
+
+    @classmethod
+    def get_main_page_dependencies(cls, blocks) -> list:
+        """
+        Зависимости блоков главной страницы: показанные товары и их
+         предложения, а также баннеры, категории и скидки.
+        """
+        product_ids = {
+            product.pk
+            for name in ('top_products', 'hot_products', 'limited_products')
+            for _, product, _ in blocks[name] or ()
+        }
+        if blocks['offer_of_day']:
+            product_ids.add(blocks['offer_of_day'].pk)
+        dependencies = [
+            dependency(BannerModel), dependency(CategoryModel),
+            dependency(DiscountModel), dependency(TypeOfDiscountModel)
+        ]
+        for product_id in product_ids:
+            dependencies += [
+                dependency(ProductModel, product_id),
+                dependency(ProductOnShopModel, product_id=product_id)
+            ]
+        return dependencies
+
+    @classmethod
+    def build_main_page_blocks(cls) -> dict:
+        """
+        Сборка блоков "Баннеры", "Предложение дня", "Популярные товары",
+         "Горячие предложения" и "Ограниченный тираж".
+        """
+        offer_of_day = cls.get_random_product()
+        offer_of_day_price = None
+        if offer_of_day:
+            price, discount = \
+                GetDiscountsForProductsService.get_discount_price(
+                    product=offer_of_day, price=offer_of_day.min_price)
+            if discount:
+                offer_of_day_price = price
+
+        # Скидки для всех блоков с товарами получаем одним запросом
+        blocks = {
+            'top_products': cls.get_top_products(),
+            'hot_products': cls.get_hot_offers(),
+            'limited_products':
+                cls.get_limited_products(offer_of_day) if offer_of_day else [],
+        }
+        blocks = cls.get_blocks_with_prices(blocks)
+
+        return {
+            'home_categories': cls.get_home_categories(),
+            'banner_list': cls.get_banners(),
+            'offer_of_day': offer_of_day,
+            'offer_of_day_price': offer_of_day_price,
+            'top_products': blocks['top_products'] or None,
+            'hot_products': blocks['hot_products'] or None,
+            'limited_products': blocks['limited_products'] or None,
+        }
+
+    @classmethod
+    def get_home_categories(cls):
+        """Получение трех категорий для баннеров главной страницы."""
+        return CachedDataService.get_categories()[:3]
+
+    @classmethod
+    def get_id_pool(cls, name, queryset, depends_on=None) -> list:
+        """
+        Кэшированный пул значений (id товаров, баннеров) для случайной
+         выборки. Пул обновляется по истечении RANDOM_POOL_CACHE_TIME, что
+          избавляет базу данных от сортировки ORDER BY RANDOM() всей таблицы.
+        """
+        pool_cache_key = 'id_pool:{}'.format(name)
+        return get_or_set(
+            pool_cache_key, lambda: list(queryset),
+            settings.RANDOM_POOL_CACHE_TIME, cache_alias=cls.cache_alias,
+            depends_on=depends_on
+        )
+
+    @classmethod
+    def get_banners(cls, count=3):
+        """
+        Получение активных баннеров для главной страницы. Баннеры выбираются
+         случайно с учетом приоритета (weight): чем больше вес, тем выше
+          вероятность показа.
+        """
+        pool = cls.get_id_pool(
+            'banners', BannerModel.objects.filter(
+                is_active=True).values_list('id', 'weight'),
+            depends_on=[dependency(BannerModel)]
+        )
+        # Взвешенная выборка без повторов (алгоритм Эфраимидиса-Спиракиса)
+        banner_ids = sorted(
+            pool, reverse=True,
+            key=lambda banner: random.random() ** (1 / max(banner[1], 1))
+        )[:count]
+        banner_ids = [banner_id for banner_id, _ in banner_ids]
+        banners = BannerModel.objects.select_related(
+            'shop_product', 'image').filter(is_active=True).in_bulk(banner_ids)
+        return [banners[pk] for pk in banner_ids if pk in banners]
+
     @classmethod
     def get_random_product(cls):
         """Получение случайного товара из ограниченного тиража."""
+        pool = cls.get_id_pool(
+            'limited_products', ProductModel.objects.filter(
+                is_active=True, limited_edition=True,
+                product_on_shop__isnull=False
+            ).distinct().values_list('id', flat=True)
+        )
+        product_ids = random.sample(pool, min(len(pool), 5))
         products = ProductOnShopModel.objects.select_related('product').filter(
             product__is_active=True)
-        limited_deals = ProductModel.objects.select_related().annotate(
+        limited_deals = ProductModel.objects.select_related(
+            'category', 'main_image').annotate(
                 min_price=Min(
                     'product_on_shop__price', output_field=IntegerField()
                 )
             ).filter(
-            limited_edition=True, product_on_shop__in=products
-        ).order_by('?').first()
-        return limited_deals
+            limited_edition=True, product_on_shop__in=products,
+            id__in=product_ids
+        ).in_bulk()
+        for product_id in product_ids:
+            if product_id in limited_deals:
+                return limited_deals[product_id]
+        return None
 
     @classmethod
     def get_top_products(cls):
-        """Метод получения популярных товаров."""
-        top_products = {}
+        """
+        Метод получения популярных товаров по числу просмотров, перенесенному
+         из кэша задачей flush_product_views.
+        """
         products = ProductModel.objects.filter(is_active=True).select_related(
-            'category', 'main_image').order_by('-view_count')[:20]
-        for product in products:
-            product_on_shop = ProductOnShopModel.objects.filter(
-                product=product, for_sale=True).order_by('price').first()
-            top_products.update({product: product_on_shop})
-        return top_products
+            'category', 'main_image').order_by('-view_count', 'id')
+        return list(cls.annotate_cheapest_offer(products)[:20])
 
     @classmethod
     def get_hot_offers(cls):
         """
-        Метод получения товаров для блока "Горячие предложения" - до 9 товаров,
-         на которых действует какая-нибудь акция.
+        Метод получения товаров для блока "Горячие предложения" - до 10
+         товаров в наличии, на которых действует какая-нибудь акция.
         """
-        hot_offers = {}
+        relations = \
+            GetDiscountsForProductsService.get_active_discount_relations()
+        pool = cls.get_id_pool(
+            'hot_products', ProductModel.objects.filter(
+                is_active=True, pk__in=relations.values('productmodel_id')
+            ).values_list('id', flat=True)
+        )
+        # Пул может устареть, поэтому условия проверяются повторно для
+        # случайной выборки id с запасом
+        product_ids = random.sample(pool, min(len(pool), 30))
         products = ProductModel.objects.filter(
-            is_active=True).exclude(discounts=None).order_by('?')[:20]
-        products = [
-            product for product in products
-            if GetDiscountsForProductsService.get_priority_discount(product)
-        ]
-        for product in products:
-            if len(hot_offers) < 10:
-                product_on_shop = ProductOnShopModel.objects.filter(
-                    product=product, for_sale=True, quantity__gte=1
-                ).order_by('price').first()
-                if product_on_shop:
-                    hot_offers.update({product: product_on_shop})
-            else:
-                break
+            is_active=True, pk__in=relations.values('productmodel_id'),
+            id__in=product_ids
+        ).select_related('category', 'main_image')
+        hot_offers = list(
+            cls.annotate_cheapest_offer(products, in_stock=True)[:10]
+        )
+        random.shuffle(hot_offers)
         return hot_offers
 
     @classmethod
     def get_limited_products(cls, offer_of_day):
         """
-        Получение списка 16 товаров ограниченного тиража,
+        Получение списка 17 товаров ограниченного тиража,
         за исключением товара из отдельного блока Limited Deals.
         """
-        limited_products = {}
         products = ProductModel.objects.filter(
             is_active=True, limited_edition=True).exclude(
-            id=offer_of_day.id).select_related('category', 'main_image')[:20]
-        for product in products:
-            if len(limited_products) < 17:
-                product_on_shop = ProductOnShopModel.objects.filter(
-                    product=product, for_sale=True, quantity__gte=1
-                ).order_by('price').first()
-                if product_on_shop:
-                    limited_products.update({product: product_on_shop})
-            else:
-                break
-        return limited_products
+            id=offer_of_day.id).select_related('category', 'main_image')
+        return list(cls.annotate_cheapest_offer(products, in_stock=True)[:17])
+
+    @classmethod
+    def annotate_cheapest_offer(cls, products, in_stock=False):
+        """
+        Аннотация товаров id (offer_id) и ценой (offer_price) самого дешевого
+         предложения для продажи. Товары без таких предложений исключаются.
+        """
+        offers = ProductOnShopModel.objects.filter(
+            product=OuterRef('pk'), for_sale=True
+        ).order_by('price', 'id')
+        if in_stock:
+            offers = offers.filter(quantity__gte=1)
+        return products.annotate(
+            offer_id=Subquery(offers.values('id')[:1]),
+            offer_price=Subquery(offers.values('price')[:1]),
+        ).filter(offer_id__isnull=False)
+
+    @classmethod
+    def get_blocks_with_prices(cls, blocks: dict) -> dict:
+        """
+        Подготовка блоков товаров главной страницы. Принимает словарь
+         {название блока: товары, аннотированные методом
+          annotate_cheapest_offer} и возвращает для каждого блока список
+           ((цена, скидка, старая цена), товар, id товара в магазине).
+            Скидки для всех товаров всех блоков получаются одним запросом.
+        """
+        discounts = GetDiscountsForProductsService.get_priority_discounts(
+            product for products in blocks.values() for product in products
+        )
+        calculate_price = \
+            GetDiscountsForProductsService.calculate_discount_price
+        blocks_with_prices = {}
+        for name, products in blocks.items():
+            products_with_prices = []
+            for product in products:
+                discount = discounts.get(product.pk)
+                if discount:
+                    price = (
+                        calculate_price(product.offer_price, discount),
+                        discount,
+                        product.offer_price
+                    )
+                else:
+                    price = (product.offer_price, None, None)
+                products_with_prices.append(
+                    (price, product, product.offer_id)
+                )
+            blocks_with_prices[name] = products_with_prices
+        return blocks_with_prices
 
 
 class CatalogService:
     """Блок каталога."""
     @classmethod
     def get_category_product(cls, slug):
-
-        products = ProductOnShopModel.objects.select_related('product').filter(
-            product__is_active=True)
-
-        products = ProductModel.objects.select_related().annotate(
-            min_price=Min(
-                'product_on_shop__price', output_field=IntegerField()
+        """
+        Активные товары категории, которые продаются хотя бы в одном
+         магазине. Цены вычисляются подзапросами, поэтому запрос не
+          группируется и не размножает строки по предложениям магазинов.
+        """
+        offers = ProductOnShopModel.objects.filter(product=OuterRef('pk'))
+        products = cls.get_products(slug).annotate(
+            min_price=Subquery(
+                offers.order_by('price').values('price')[:1],
+                output_field=IntegerField()
             ),
-            max_price=Max(
-                'product_on_shop__price', output_field=IntegerField()
+            max_price=Subquery(
+                offers.order_by('-price').values('price')[:1],
+                output_field=IntegerField()
             ),
-            num_reviews=Count('review')).filter(
-            category__slug=slug, product_on_shop__in=products
+            discount_price=F('final_price')
         )
         category = CategoryModel.objects.get(slug=slug)
         shop = ShopModel.objects.filter(
@@ -457,38 +2155,270 @@ class CatalogService:
         ).distinct()
         return products, category, shop
 
+    @classmethod
+    def get_products(cls, slug):
+        """
+        Активные товары категории, которые продаются хотя бы в одном
+         магазине, без вычисляемых полей. По такому запросу фасеты
+          считаются агрегацией без вложенных подзапросов.
+        """
+        return ProductModel.objects.filter(
+            category__slug=slug, is_active=True
+        ).filter(
+            Exists(ProductOnShopModel.objects.filter(product=OuterRef('pk')))
+        )
+
+    @classmethod
+    def get_filters(cls, query_dict) -> dict:
+        """Фильтры каталога из GET-параметров в нормализованном виде."""
+        price = None
+        price_list = query_dict.get('price')
+        if price_list:
+            try:
+                prices = [Decimal(value) for value in price_list.split(';')]
+                price = (prices[0], prices[-1])
+            except (ArithmeticError, ValueError):
+                price = None
+        return {
+            'price': price,
+            'shop': query_dict.get('shop') or None,
+            'stock': bool(query_dict.get('stock')),
+            'manufacturer': sorted(set(query_dict.getlist('manufacturer'))),
+            'characteristic': cls.get_characteristic_groups(
+                query_dict.getlist('characteristic')
+            ),
+        }
+
+    @classmethod
+    def get_characteristic_groups(cls, values) -> list:
+        """
+        Выбранные значения характеристик, сгруппированные по названию
+         характеристики: [[id значения, ...], ...].
+        """
+        values = {int(pk) for pk in values if pk.isdigit()}
+        if not values:
+            return []
+        groups = defaultdict(list)
+        for pk, name_id in CharacteristicModel.objects.filter(
+                pk__in=values).order_by('pk').values_list('pk', 'name_id'):
+            groups[name_id].append(pk)
+        return [groups[name_id] for name_id in sorted(groups)]
+
+    @classmethod
+    def apply_filters(cls, queryset, filters, exclude=None):
+        """Применение фильтров, кроме фильтра exclude (для фасетов)."""
+        filters = {
+            name: value for name, value in filters.items() if name != exclude
+        }
+        price = filters.get('price')
+        return cls.filter_product(
+            queryset,
+            '{};{}'.format(*price) if price else None,
+            filters.get('shop'), filters.get('stock'),
+            filters.get('manufacturer'), filters.get('characteristic')
+        )
+
     @classmethod
     def filter_product(cls, queryset, price_list, shop,
-                       delivery, manufacturer):
+                       delivery, manufacturer, characteristics=None):
         if price_list:
             price_list = price_list.split(';')
             min_price = price_list[0]
             max_price = price_list[1]
             queryset = queryset.filter(
-                min_price__gte=min_price, min_price__lte=max_price
+                final_price__gte=min_price, final_price__lte=max_price
             )
+        offers = ProductOnShopModel.objects.filter(product=OuterRef('pk'))
         if shop:
-            queryset = queryset.filter(product_on_shop__shop__name=shop)
+            queryset = queryset.filter(Exists(offers.filter(shop__name=shop)))
         if manufacturer:
             queryset = queryset.filter(manufacturer__in=manufacturer)
 
         if delivery:
-            queryset = queryset.filter(product_on_shop__quantity__gt=0)
+            queryset = queryset.filter(Exists(offers.filter(quantity__gt=0)))
+
+        if characteristics:
+            # Значения одной характеристики объединяются через "или",
+            # разных характеристик - через "и"
+            through = ProductModel.characteristics.through.objects
+            for values in characteristics:
+                queryset = queryset.filter(Exists(through.filter(
+                    productmodel=OuterRef('pk'),
+                    characteristicmodel__in=values
+                )))
 
         return queryset
 
+    # Режимы сортировки каталога. Для каждого режима в ProductModel есть
+    # составной индекс, по которому сортировка внутри категории выполняется
+    # без отдельной сортировки строк
+    sort_modes = {
+        'popular': ('-view_count', '-id'),
+        'price': ('final_price', 'id'),
+        '-price': ('-final_price', '-id'),
+        'new': ('-created_at', '-id'),
+        'reviews': ('-review_count', '-id'),
+    }
+    default_sort_mode = 'popular'
+
+    @classmethod
+    def get_sort_mode(cls, order) -> str:
+        """
+        Режим сортировки order. Неизвестные значения заменяются режимом
+         по умолчанию.
+        """
+        return order if order in cls.sort_modes else cls.default_sort_mode
+
     @classmethod
     def sort_product(cls, queryset, order):
-        sorted_products = queryset.order_by(order)
+        sorted_products = queryset.order_by(
+            *cls.sort_modes[cls.get_sort_mode(order)]
+        )
         return sorted_products
 
     @classmethod
-    def paginate(cls, product_list, paginate_by, page=1):
-        paginator = Paginator(product_list, paginate_by)
-        try:
-            products = paginator.page(page)
-        except PageNotAnInteger:
-            products = paginator.page(1)
-        except EmptyPage:
-            products = paginator.page(paginator.num_pages)
-        return products
+    def paginate(cls, product_list, paginate_by, page=None, count=None):
+        """
+        Страница товаров по курсору page (см. KeysetPaginator). Если
+         количество товаров уже известно (count), оно не пересчитывается.
+        """
+        paginator = KeysetPaginator(product_list, paginate_by, count=count)
+        return paginator.page(page)
+
+
+class CatalogFacetService:
+    """
+    Фасеты каталога: количество товаров по производителям, магазинам,
+     диапазонам цен, наличию и значениям характеристик. Каждый фасет
+      считается агрегирующим запросом с учетом всех фильтров, кроме
+       собственного, и кэшируется для категории и набора фильтров.
+    """
+    cache_alias = 'catalog'
+    price_buckets = 5
+
+    @classmethod
+    def get_facets(cls, category, products, filters) -> dict:
+        """
+        Фасеты для товаров категории products (без фильтров) с учетом
+         фильтров filters (см. CatalogService.get_filters).
+        """
+        key = 'facets:{}:{}'.format(
+            category.pk, cls.get_filters_hash(filters)
+        )
+        return get_or_set(
+            key, lambda: cls.build_facets(products, filters),
+            settings.CATALOG_CACHE_TIME, cache_alias=cls.cache_alias,
+            depends_on=[
+                dependency(ProductModel, category_id=category.pk),
+                dependency(ProductOnShopModel,
+                           product__category_id=category.pk),
+                dependency(ShopModel),
+                dependency(CharacteristicModel),
+                dependency(CharacteristicNameModel),
+                dependency(ValueModel),
+            ]
+        )
+
+    @staticmethod
+    def get_filters_hash(filters) -> str:
+        return hashlib.md5(
+            json.dumps(filters, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    @classmethod
+    def build_facets(cls, products, filters) -> dict:
+        in_stock = Exists(ProductOnShopModel.objects.filter(
+            product=OuterRef('pk'), quantity__gt=0
+        ))
+        stock = CatalogService.apply_filters(
+            products, filters, exclude='stock'
+        ).aggregate(
+            total=Count('pk'),
+            in_stock=Coalesce(
+                Sum(Case(When(in_stock, then=1), output_field=IntegerField())),
+                0
+            )
+        )
+        return {
+            'total': stock['in_stock'] if filters['stock'] else stock['total'],
+            'in_stock': stock['in_stock'],
+            'price': cls.get_price_facet(products, filters),
+            'manufacturers': cls.get_manufacturer_facet(products, filters),
+            'shops': cls.get_shop_facet(products, filters),
+            'characteristics':
+                cls.get_characteristic_facet(products, filters),
+        }
+
+    @classmethod
+    def get_price_facet(cls, products, filters) -> dict:
+        """
+        Диапазон итоговых цен и количество товаров по интервалам цен.
+         Границы и количество по интервалам считаются агрегатами в базе,
+          цены товаров в память не загружаются.
+        """
+        products = CatalogService.apply_filters(
+            products, filters, exclude='price'
+        ).exclude(final_price=None)
+        prices = products.aggregate(
+            low=Min('final_price'), high=Max('final_price')
+        )
+        if prices['low'] is None:
+            return {'min': 0, 'max': 0, 'buckets': []}
+        low, high = int(prices['low']), int(prices['high']) + 1
+        step = max((high - low) // cls.price_buckets, 1)
+        edges = list(range(low, high, step))[:cls.price_buckets] + [high]
+        counts = products.aggregate(**{
+            f'bucket_{index}': Count(Case(When(
+                final_price__gte=start, final_price__lt=end, then='pk'
+            )))
+            for index, (start, end) in enumerate(zip(edges, edges[1:]))
+        })
+        buckets = []
+        for index, (start, end) in enumerate(zip(edges, edges[1:])):
+            if counts[f'bucket_{index}']:
+                buckets.append((start, end, counts[f'bucket_{index}']))
+        return {'min': low, 'max': high, 'buckets': buckets}
+
+    @classmethod
+    def get_manufacturer_facet(cls, products, filters) -> list:
+        return list(
+            CatalogService.apply_filters(
+                products, filters, exclude='manufacturer'
+            ).exclude(manufacturer='').order_by('manufacturer').values_list(
+                'manufacturer').annotate(count=Count('pk'))
+        )
+
+    @classmethod
+    def get_shop_facet(cls, products, filters) -> list:
+        product_ids = CatalogService.apply_filters(
+            products, filters, exclude='shop'
+        ).values('pk')
+        return list(
+            ProductOnShopModel.objects.filter(
+                product__in=product_ids
+            ).order_by('shop__name').values_list('shop__name').annotate(
+                count=Count('product', distinct=True))
+        )
+
+    @classmethod
+    def get_characteristic_facet(cls, products, filters) -> list:
+        """
+        Значения характеристик, сгруппированные по названию:
+         [(название, [(id значения, значение, количество товаров), ...])].
+        """
+        product_ids = CatalogService.apply_filters(
+            products, filters, exclude='characteristic'
+        ).values('pk')
+        rows = ProductModel.characteristics.through.objects.filter(
+            productmodel__in=product_ids
+        ).order_by(
+            'characteristicmodel__name__name',
+            'characteristicmodel__value__value'
+        ).values_list(
+            'characteristicmodel__name__name', 'characteristicmodel',
+            'characteristicmodel__value__value'
+        ).annotate(count=Count('productmodel', distinct=True))
+        facet = {}
+        for name, pk, value, count in rows:
+            facet.setdefault(name, []).append((pk, value, count))
+        return list(facet.items())
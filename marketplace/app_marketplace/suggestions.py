@@ -0,0 +1,230 @@
+import heapq
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError
+from django.db.models import Count
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from sortedcontainers import SortedList
+from .models import CategoryModel, ProductModel
+from .search import TOKEN_RE, normalize
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('products', 'categories', 'manufacturers')
+
+
+def get_words(text) -> list:
+    return TOKEN_RE.findall(normalize(text))
+
+
+class SuggestionIndex:
+    """
+    Индекс подсказок поиска в памяти процесса: отсортированный список
+     слов названий товаров (и их тегов), категорий и производителей.
+      Поиск по началу слова выполняется двоичным поиском без обращений
+       к базе данных.
+
+    Изменения объектов записываются сигналами в журнал в Redis
+     (log_changes). Процесс не чаще раза в SUGGEST_CHECK_INTERVAL секунд
+      сверяет номер версии журнала и обновляет только измененные записи;
+       если журнал успел обрезаться, индекс строится заново.
+    """
+    log_key = 'suggest:log'
+    version_key = 'suggest:version'
+    # Минимальная длина слова запроса для подсказок
+    min_length = 2
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.keys = SortedList()
+        self.entries = {}
+        self.version = None
+        self.checked_at = 0.0
+
+    @classmethod
+    def get_redis(cls):
+        return get_redis_connection(settings.SUGGEST_CACHE_ALIAS)
+
+    @classmethod
+    def make_key(cls, key):
+        return caches[settings.SUGGEST_CACHE_ALIAS].make_key(key)
+
+    @classmethod
+    def log_changes(cls, changes):
+        """
+        Запись изменений объектов в журнал индекса подсказок. changes -
+         список пар (вид, ключ), например ('products', 1).
+        """
+        changes = list(changes)
+        if not changes:
+            return
+        redis = cls.get_redis()
+        version = redis.incrby(cls.make_key(cls.version_key), len(changes))
+        log_key = cls.make_key(cls.log_key)
+        pipeline = redis.pipeline(transaction=False)
+        for number, (kind, key) in enumerate(changes):
+            pipeline.lpush(log_key, '{}:{}:{}'.format(
+                version - len(changes) + number + 1, kind, key
+            ))
+        pipeline.ltrim(log_key, 0, settings.SUGGEST_LOG_SIZE)
+        pipeline.execute()
+
+    def get_version(self) -> int:
+        return int(self.get_redis().get(self.make_key(self.version_key)) or 0)
+
+    def load(self):
+        """Построение индекса по всем объектам."""
+        with self._lock:
+            version = self.get_version()
+            self.keys = SortedList()
+            self.entries = {}
+            products = ProductModel.objects.filter(is_active=True).only(
+                'id', 'model', 'slug', 'view_count'
+            ).prefetch_related('tags')
+            for product in products:
+                self._set_product(product)
+            for category in CategoryModel.objects.filter(is_active=True):
+                self._set_category(category)
+            for name, count in self.get_manufacturers():
+                self._set('manufacturers', name, name, name, count, name)
+            self.version = version
+            self.checked_at = time.monotonic()
+
+    def warm_up(self):
+        """Загрузка индекса при старте процесса."""
+        try:
+            self.load()
+        except (DatabaseError, RedisError):
+            logger.exception('Suggestion index was not loaded')
+
+    def refresh(self):
+        """Применение изменений из журнала, не чаще раза в интервал."""
+        if self.version is None:
+            self.load()
+            return
+        if time.monotonic() - self.checked_at < \
+                settings.SUGGEST_CHECK_INTERVAL:
+            return
+        with self._lock:
+            self.checked_at = time.monotonic()
+            version = self.get_version()
+            if version == self.version:
+                return
+            if version < self.version:
+                self.load()
+                return
+            changes = self.get_redis().lrange(
+                self.make_key(self.log_key), 0, version - self.version - 1
+            )
+            changes = [change.decode().split(':', 2) for change in changes]
+            if len(changes) < version - self.version or \
+                    int(changes[-1][0]) != self.version + 1:
+                # Часть журнала уже удалена - строим индекс заново
+                self.load()
+                return
+            self.apply(
+                {(kind, key) for _, kind, key in changes}
+            )
+            self.version = version
+
+    def apply(self, changes):
+        products = {key for kind, key in changes if kind == 'products'}
+        categories = {key for kind, key in changes if kind == 'categories'}
+        manufacturers = {
+            key for kind, key in changes if kind == 'manufacturers'
+        }
+        for pk in products:
+            self._remove('products', int(pk))
+        for product in ProductModel.objects.filter(
+                pk__in=products, is_active=True
+        ).only('id', 'model', 'slug', 'view_count').prefetch_related('tags'):
+            self._set_product(product)
+        for pk in categories:
+            self._remove('categories', int(pk))
+        for category in CategoryModel.objects.filter(
+                pk__in=categories, is_active=True):
+            self._set_category(category)
+        for name in manufacturers:
+            self._remove('manufacturers', name)
+        for name, count in self.get_manufacturers(manufacturers):
+            self._set('manufacturers', name, name, name, count, name)
+
+    @staticmethod
+    def get_manufacturers(names=None):
+        products = ProductModel.objects.filter(is_active=True).exclude(
+            manufacturer='')
+        if names is not None:
+            products = products.filter(manufacturer__in=names)
+        return products.order_by().values_list('manufacturer').annotate(
+            count=Count('pk'))
+
+    def _set_product(self, product):
+        text = ' '.join(
+            [product.model] + [tag.name for tag in product.tags.all()
+                               if tag.is_active]
+        )
+        self._set('products', product.pk, product.model, text,
+                  product.view_count, product.slug)
+
+    def _set_category(self, category):
+        self._set('categories', category.pk, category.name, category.name,
+                  0, category.slug)
+
+    def _set(self, kind, pk, label, text, score, slug):
+        words = set(get_words(text))
+        self.entries[kind, pk] = (label, score, slug, words)
+        for word in words:
+            self.keys.add((word, kind, pk))
+
+    def _remove(self, kind, pk):
+        entry = self.entries.pop((kind, pk), None)
+        if entry is not None:
+            for word in entry[3]:
+                self.keys.discard((word, kind, pk))
+
+    def suggest(self, query, limit=None) -> dict:
+        """
+        Подсказки для введенного текста: по limit лучших товаров,
+         категорий и производителей, у которых каждое слово запроса
+          является началом одного из слов названия.
+        """
+        limit = limit or settings.SUGGEST_LIMIT
+        result = {kind: [] for kind in KINDS}
+        words = get_words(query)
+        if not words:
+            return result
+        # Кандидаты выбираются по самому длинному слову запроса
+        longest = max(words, key=len)
+        if len(longest) < self.min_length:
+            return result
+        try:
+            self.refresh()
+        except RedisError:
+            # Подсказки выдаются по текущему индексу
+            logger.exception('Suggestion index was not refreshed')
+        candidates = {kind: {} for kind in KINDS}
+        with self._lock:
+            for _, kind, pk in self.keys.irange(
+                    (longest,), (longest + '\uffff',)):
+                entry = self.entries[kind, pk]
+                if all(
+                        any(word.startswith(part) for word in entry[3])
+                        for part in words
+                ):
+                    candidates[kind][pk] = entry
+        for kind, entries in candidates.items():
+            best = heapq.nsmallest(
+                limit, entries.items(),
+                key=lambda item: (-item[1][1], item[1][0])
+            )
+            result[kind] = [
+                (pk, label, slug) for pk, (label, _, slug, _) in best
+            ]
+        return result
+
+
+suggestion_index = SuggestionIndex()
@@ -27,6 +27,57 @@ def change_status_all_jobs():
             return
 
 
+@app.task
+def update_effective_prices():
+    """
+    Пересчет итоговых цен товаров, срок действия которых истек на границе
+     начала или окончания скидок.
+    """
+    from .services import EffectivePriceService
+    EffectivePriceService.update_expired_prices()
+
+
+@app.task
+def warm_up_main_page():
+    """
+    Пересборка блоков главной страницы до истечения их кэша, чтобы
+     запросы посетителей не собирали блоки самостоятельно.
+    """
+    from .services import HomePageService
+    HomePageService.warm_up_main_page(refresh_pools=True)
+
+
+@app.task
+def flush_product_views():
+    """Перенос накопленных в кэше просмотров товаров в базу данных."""
+    from .services import ProductViewCounterService
+    ProductViewCounterService.flush()
+
+
+@app.task
+def flush_view_history():
+    """Запись накопленных просмотров товаров в историю просмотров."""
+    from .services import AddLookedProductsService
+    AddLookedProductsService.flush_watch_list()
+
+
+@app.task
+def warm_up_searches():
+    """
+    Обновление кэша результатов самых частых поисковых запросов до
+     истечения его срока.
+    """
+    from .search import warm_up_searches
+    warm_up_searches()
+
+
+@app.task
+def release_expired_reservations():
+    """Возврат в остаток товаров из просроченных резервов корзин."""
+    from .services import StockReservationService
+    StockReservationService.release_expired()
+
+
 @app.task
 def payment_request(data):
     response = requests.post(
@@ -66,6 +117,10 @@ def payment_request(data):
                         if cart:
                             cart.status = 'completed'
                             cart.save(update_fields=['status'])
+                            # Зарезервированный товар списан заказом
+                            from .services import StockReservationService
+                            StockReservationService.commit(
+                                {'user': cart.user_id})
                     else:
                         # В модели оплаты поле подтверждения устанавливаем
                         # в False
@@ -1,6 +1,6 @@
 from django.test import TestCase
 from app_marketplace.forms import CreateOrderDeliveryForm, \
-    CreateOrderPaymentForm, CreatePaymentForm
+    CreateOrderPaymentForm, CreatePaymentForm, ClearCacheForm
 from app_marketplace.models import DeliveryModel
 
 
@@ -35,3 +35,10 @@ class TestForms(TestCase):
     def test_create_payment_form(self):
         form = CreatePaymentForm(data={'card_number': '111111111'})
         self.assertTrue(form.is_valid())
+
+    def test_clear_cache_form(self):
+        choices = dict(ClearCacheForm().fields['cache_name'].choices)
+        for name in ('pages', 'catalog', 'sessions', 'counters'):
+            self.assertIn(name, choices)
+        form = ClearCacheForm(data={'cache_name': 'pages'})
+        self.assertTrue(form.is_valid())
@@ -1,13 +1,45 @@
-from django.test import TestCase, Client
+import threading
+import time
+from io import StringIO
+from unittest import mock
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from django.db import connection, transaction, OperationalError
+from django.db.models import Sum
+from django.http import QueryDict
+from django.urls import reverse
+from django.test import TestCase, TransactionTestCase, Client, \
+    RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 import app_marketplace.services as serv
+from app_marketplace.search import search_products, stem, get_query_key, \
+    get_search_ids, get_query_stats, warm_up_searches, trim_query_log, \
+    get_log_keys
+from app_marketplace.suggestions import SuggestionIndex
+from app_marketplace.cart import Cart, get_cart_summary
+from app_marketplace.context_processors import cart_information
+from app_marketplace.discounts import discount_scope, get_discount_scope
+from app_marketplace.caching import get_or_set, set_value, cache_stats, \
+    dependency, invalidate
 from app_marketplace.models import ProductModel, FilesModel, CategoryModel, \
     ProductOnShopModel, ShopModel, ProductViewHistoryModel, CartModel, \
     OrderModel, CartProductModel, PurchaseHistoryModel, TypeOfDiscountModel, \
-    DiscountModel
+    DiscountModel, EffectivePriceModel, BannerModel, CharacteristicModel, \
+    CharacteristicNameModel, ValueModel, TagsModel, ReviewModel, \
+    StockReservationModel
 from django.core.files.uploadedfile import SimpleUploadedFile
 from app_users.models import User
 from datetime import datetime, timedelta
 from decimal import Decimal
+from django.utils import timezone
+
+
+def clear_caches():
+    for alias in settings.CACHES:
+        caches[alias].clear()
 
 
 class BaseConf(TestCase):
@@ -95,8 +127,14 @@ class TestLookedProduct(BaseConf):
         super().setUpClass()
         cls.serv_locked = serv.AddLookedProductsService()
 
+    def setUp(self) -> None:
+        clear_caches()
+
     def test_watch_list(self):
         self.serv_locked.add_item_to_watch_list(self.user, self.product)
+        self.assertFalse(
+            ProductViewHistoryModel.objects.filter(user=self.user).exists())
+        self.assertEqual(self.serv_locked.flush_watch_list(), 1)
         res = ProductViewHistoryModel.objects.filter(user=self.user).first()
         self.assertEqual(res.product, self.product)
 
@@ -114,6 +152,50 @@ class TestLookedProduct(BaseConf):
         res_v4 = ProductViewHistoryModel.objects.filter(user=self.user).first()
         self.assertEqual(res_v4, None)
 
+    def test_watch_list_bad_events(self):
+        service = serv.AddLookedProductsService
+        redis = get_redis_connection(service.cache_alias)
+        cache = caches[service.cache_alias]
+        queue_key = cache.make_key(service.queue_key)
+        redis.rpush(queue_key, 'broken', 'a:b:c', '\xff', '1:999999:1')
+        service.add_item_to_watch_list(self.user, self.product)
+        # Неразборчивые события и события удаленных товаров пропускаются
+        self.assertEqual(service.flush_watch_list(), 1)
+        self.assertEqual(redis.llen(queue_key), 0)
+
+        service.add_item_to_watch_list(self.user, self.product)
+        with mock.patch.object(service, 'save_views',
+                               side_effect=OperationalError):
+            for attempt in range(1, service.max_attempts):
+                self.assertEqual(service.flush_watch_list(), 0)
+                event = redis.lrange(queue_key, 0, -1)[0].decode()
+                self.assertTrue(event.endswith(f':{attempt}'))
+            self.assertEqual(service.flush_watch_list(), 0)
+        self.assertEqual(redis.llen(queue_key), 0)
+        failed = redis.lrange(cache.make_key(service.failed_key), 0, -1)
+        self.assertEqual(len(failed), 1)
+        # Событие из списка неудачных можно вернуть в очередь
+        redis.rpush(queue_key, *failed)
+        self.assertEqual(service.flush_watch_list(), 1)
+
+    def test_watch_list_ring(self):
+        products = [self.product] + [
+            ProductModel.objects.create(
+                model=f'telefon{i}', category=self.category,
+                slug=f'telefon{i}', code=f'code{i}', is_active=True)
+            for i in range(3)]
+        for product in products + [self.product]:
+            self.serv_locked.add_item_to_watch_list(self.user, product)
+        with mock.patch.object(serv.AddLookedProductsService,
+                               'history_size', 3):
+            self.assertEqual(self.serv_locked.flush_watch_list(), 5)
+        # Повторный просмотр поднимает товар в начало истории, самый
+        # старый просмотр удаляется
+        history = self.serv_locked.get_a_list_of_viewed_products(self.user)
+        self.assertEqual(
+            [item.product for item in history],
+            [self.product, products[3], products[2]])
+
 
 class TestPurchaseHistory(BaseConf):
     @classmethod
@@ -157,6 +239,131 @@ class TestGetDiscount(BaseConf):
             self.product_on_shop.price * self.discount.percent_discount / 100
         self.assertEqual(new_price, price)
 
+    def test_get_priority_discounts(self):
+        with self.assertNumQueries(1):
+            discounts = self.serv_discounts.get_priority_discounts(
+                [self.product])
+        self.assertEqual(discounts, {self.product.pk: self.discount})
+
+    def test_get_discount_prices(self):
+        with self.assertNumQueries(1):
+            prices = self.serv_discounts.get_discount_prices(
+                [(self.product_on_shop, self.product_on_shop.price),
+                 (self.product, self.product_on_shop.price)])
+        expected = self.serv_discounts.get_discount_price(
+            self.product, self.product_on_shop.price)
+        self.assertEqual(prices[self.product_on_shop], expected)
+        self.assertEqual(prices[self.product], expected)
+
+    def test_discount_scope(self):
+        other = ProductModel.objects.create(
+            model='other', category=self.category, slug='other',
+            code='other', is_active=True)
+        with discount_scope() as scope:
+            with self.assertNumQueries(2):
+                for _ in range(3):
+                    self.serv_discounts.get_discount_price(
+                        self.product, self.product_on_shop.price)
+                self.serv_discounts.get_discount_prices(
+                    [(self.product_on_shop, self.product_on_shop.price)])
+                # Загружаются только скидки новых товаров
+                discounts = self.serv_discounts.get_priority_discounts(
+                    [self.product, other])
+                self.assertIsNone(
+                    self.serv_discounts.get_priority_discount(other))
+        self.assertEqual(discounts, {self.product.pk: self.discount})
+        self.assertEqual(
+            (scope.lookups, scope.resolutions, scope.products), (6, 2, 2))
+        self.assertIsNone(get_discount_scope())
+
+    def test_discount_scope_after_changes(self):
+        other = DiscountModel.objects.create(
+            name='other', description='other', type_of_discount=self.type_disc,
+            date_end=self.discount.date_end, is_active=True, slug='other',
+            percent_discount=Decimal(50))
+        with discount_scope():
+            self.assertEqual(
+                self.serv_discounts.get_priority_discount(self.product),
+                self.discount)
+            self.product.discounts.set([other])
+            self.assertEqual(
+                self.serv_discounts.get_priority_discount(self.product),
+                other)
+        effective_price = EffectivePriceModel.objects.get(
+            product_on_shop=self.product_on_shop)
+        self.assertEqual(effective_price.price, Decimal('5.00'))
+        self.assertEqual(effective_price.discount, other)
+        self.assertIsNotNone(effective_price.valid_until)
+
+    @override_settings(DEBUG=True)
+    def test_discount_scope_middleware(self):
+        clear_caches()
+        url = reverse('good_details', args=['telefon'])
+        response = self.client.get(url)
+        self.assertEqual(response['X-Discount-Resolutions'], '1')
+        response = self.client.get(url)
+        self.assertEqual(response['X-Discount-Resolutions'], '0')
+
+
+class TestEffectivePrice(BaseConf):
+    @classmethod
+    def setUpClass(cls) -> object:
+        super().setUpClass()
+        cls.serv_prices = serv.EffectivePriceService()
+
+    def test_price_created_with_discount(self):
+        effective_price = EffectivePriceModel.objects.get(
+            product_on_shop=self.product_on_shop)
+        self.assertEqual(effective_price.price, Decimal('9.50'))
+        self.assertEqual(effective_price.discount, self.discount)
+        date_end = DiscountModel.objects.get(pk=self.discount.pk).date_end
+        self.assertEqual(
+            timezone.localtime(effective_price.valid_until).date(),
+            timezone.localtime(date_end).date() + timedelta(days=1))
+
+    def test_price_updated_on_changes(self):
+        self.product_on_shop.price = Decimal(20)
+        self.product_on_shop.save()
+        effective_price = EffectivePriceModel.objects.get(
+            product_on_shop=self.product_on_shop)
+        self.assertEqual(effective_price.price, Decimal('19.00'))
+
+        self.type_disc.is_active = False
+        self.type_disc.save()
+        effective_price.refresh_from_db()
+        self.assertEqual(effective_price.price, Decimal('20.00'))
+        self.assertIsNone(effective_price.discount)
+
+        self.type_disc.is_active = True
+        self.type_disc.save()
+        self.product.discounts.remove(self.discount)
+        effective_price.refresh_from_db()
+        self.assertIsNone(effective_price.discount)
+
+    def test_product_final_price(self):
+        product = ProductModel.objects.get(pk=self.product.pk)
+        self.assertEqual(product.final_price, Decimal('9.50'))
+        offer = ProductOnShopModel.objects.create(
+            shop=self.shop, product=self.product, quantity=1,
+            price=Decimal(5), for_sale=True)
+        product.refresh_from_db()
+        self.assertEqual(product.final_price, Decimal('4.75'))
+        # Сохранение товара не перезаписывает пересчитанную цену
+        self.product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.final_price, Decimal('4.75'))
+        offer.delete()
+        product.refresh_from_db()
+        self.assertEqual(product.final_price, Decimal('9.50'))
+
+    def test_update_expired_prices(self):
+        EffectivePriceModel.objects.update(
+            price=0, valid_until=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(self.serv_prices.update_expired_prices(), 1)
+        effective_price = EffectivePriceModel.objects.get(
+            product_on_shop=self.product_on_shop)
+        self.assertEqual(effective_price.price, Decimal('9.50'))
+
 
 class TestAddItemToCart(BaseConf):
     @classmethod
@@ -200,6 +407,67 @@ class TestAddItemToCart(BaseConf):
         self.assertEqual(total_price_cart,
                          Decimal(self.product_on_shop.price) * 2)
 
+    def test_add_product(self):
+        other = ProductOnShopModel.objects.create(
+            shop=self.shop, product=self.product, quantity=5,
+            price=Decimal('2.50'), for_sale=True)
+        stale = CartModel.objects.get(pk=self.cart.pk)
+        self.serv_cart.add_product(self.user, other, 2, Decimal('2.50'))
+        cart = self.serv_cart.add_product(
+            self.user, self.product_on_shop, 1, Decimal('9'))
+        self.assertEqual((cart.quantity, cart.total_price),
+                         (4, Decimal('24')))
+        # Итоги не зависят от устаревшего объекта корзины
+        self.serv_cart.increasing_the_number_of_items_in_the_cart(
+            stale, 0, 0)
+        self.assertEqual((stale.quantity, stale.total_price),
+                         (4, Decimal('24')))
+
+        request = self.auth_client.request().wsgi_request
+        error, quantity, total_price = self.serv_cart.change_item_count_cart(
+            request, self.product_on_shop, -1)
+        self.assertEqual((quantity, total_price), (3, Decimal('14.50')))
+        self.assertEqual(
+            self.serv_cart.change_item_count_cart(request, other, -3),
+            ('error', None, None))
+        self.serv_cart.remove_item_from_cart(request, other)
+        cart.refresh_from_db()
+        self.assertEqual((cart.quantity, cart.total_price),
+                         (1, Decimal('9.50')))
+        self.assertEqual(serv.CartTotalsService.reconcile(), 0)
+
+    def test_get_cart_for_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                cart = self.serv_cart.get_cart_for_update(self.user)
+        self.assertEqual(cart, self.cart)
+        if connection.features.has_select_for_update:
+            self.assertIn('FOR UPDATE', queries.captured_queries[-1]['sql'])
+        self.cart.status = 'completed'
+        self.cart.save()
+        with transaction.atomic():
+            cart = self.serv_cart.get_cart_for_update(self.user)
+            self.assertEqual(
+                self.serv_cart.get_cart_for_update(self.user), cart)
+        self.assertNotEqual(cart, self.cart)
+
+    def test_reconcile(self):
+        empty = CartModel.objects.create(
+            user=self.user, status='completed', quantity=2, total_price=5)
+        CartModel.objects.filter(pk=self.cart.pk).update(
+            quantity=7, total_price=Decimal('70'))
+        out = StringIO()
+        call_command('reconcile_carts', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Reconciled carts: 1')
+        call_command('reconcile_carts', '--all', stdout=out)
+        self.assertIn('Reconciled carts: 1', out.getvalue())
+        self.cart.refresh_from_db()
+        empty.refresh_from_db()
+        self.assertEqual((self.cart.quantity, self.cart.total_price),
+                         (1, Decimal('10')))
+        self.assertEqual((empty.quantity, empty.total_price), (0, 0))
+        self.assertEqual(serv.CartTotalsService.reconcile(), 0)
+
     def test_get_products_list_from_cart(self):
         resp = self.serv_cart.get_products_list_from_cart(self.cart)
         self.assertEqual(resp, list(self.cart.products.all()))
@@ -213,6 +481,463 @@ class TestAddItemToCart(BaseConf):
         self.assertEqual(resp, self.cart.total_price)
 
 
+class TestSessionCart(BaseConf):
+    def setUp(self) -> None:
+        self.request = self.client.request().wsgi_request
+        self.other = ProductOnShopModel.objects.create(
+            shop=self.shop, product=self.product, quantity=5,
+            price=Decimal('2.50'), for_sale=True)
+
+    def test_cart(self):
+        cart = Cart(self.request)
+        cart.add(self.product_on_shop, 2, Decimal('9.50'))
+        cart.add(self.other, 1)
+        cart.add(self.other, 2)
+        cart.update(self.product_on_shop, -1)
+        self.assertEqual(self.request.session[settings.CART_SESSION_ID], {
+            'items': [[self.product_on_shop.pk, 1, 950],
+                      [self.other.pk, 3, 250]],
+            'count': 4, 'total': 1700})
+
+        # Количество и сумма берутся из сессии без запросов
+        with self.assertNumQueries(0):
+            cart = Cart(self.request)
+            self.assertEqual(len(cart), 4)
+            self.assertEqual(cart.get_total_price(), Decimal('17'))
+        with self.assertNumQueries(1):
+            items = list(cart)
+            [item['product'].product.main_image for item in items]
+            [item['product'].shop.name for item in items]
+            list(cart)
+        self.assertEqual(
+            [(item['product'], item['quantity'], item['price'])
+             for item in items],
+            [(self.product_on_shop, 1, Decimal('9.5')),
+             (self.other, 3, Decimal('7.5'))])
+
+        cart.update(self.product_on_shop, -1)
+        cart.delete(self.other)
+        self.assertEqual(len(cart), 0)
+        self.assertEqual(list(cart), [])
+
+    def test_convert(self):
+        self.request.session[settings.CART_SESSION_ID] = {
+            str(self.other.pk): {'price': '2.50', 'qty': 2}}
+        cart = Cart(self.request)
+        self.assertEqual(len(cart), 2)
+        self.assertEqual(cart.get_total_price(), Decimal(5))
+        self.assertEqual([item['product'] for item in cart], [self.other])
+
+
+class TestCartSummary(BaseConf):
+    def setUp(self) -> None:
+        clear_caches()
+        CartModel.objects.filter(pk=self.cart.pk).update(
+            quantity=3, total_price=Decimal('30.50'))
+        self.cart.refresh_from_db()
+        self.client.force_login(self.user)
+
+    def get_compare(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('compare'))
+        cart_queries = [
+            query for query in queries.captured_queries
+            if 'app_marketplace_cartmodel' in query['sql']
+        ]
+        return response, len(cart_queries)
+
+    def test_lazy(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with self.assertNumQueries(0):
+            context = cart_information(request)
+        with override_settings(CART_SUMMARY_COOKIE_AGE=0):
+            with self.assertNumQueries(1):
+                self.assertEqual(context['count_product_in_cart'](), 3)
+                self.assertEqual(context['total_price_cart'](),
+                                 Decimal('30.50'))
+                self.assertEqual(get_cart_summary(request),
+                                 (3, Decimal('30.50')))
+
+    def test_cookie(self):
+        response, queries = self.get_compare()
+        self.assertEqual(queries, 1)
+        self.assertContains(response, 'id="number_of_goods">3<')
+        self.assertIn(settings.CART_SUMMARY_COOKIE, response.cookies)
+
+        # Корзина не менялась - итоги берутся из cookie
+        response, queries = self.get_compare()
+        self.assertEqual(queries, 0)
+        self.assertContains(response, 'id="number_of_goods">3<')
+        self.assertContains(response, '30,50')
+
+        self.cart.quantity = 5
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cart.save()
+            # До фиксации транзакции версия корзины не меняется
+            response, queries = self.get_compare()
+            self.assertEqual(queries, 0)
+        response, queries = self.get_compare()
+        self.assertEqual(queries, 1)
+        self.assertContains(response, 'id="number_of_goods">5<')
+
+        # Подделанная cookie не принимается
+        self.client.cookies[settings.CART_SUMMARY_COOKIE] = \
+            self.client.cookies[settings.CART_SUMMARY_COOKIE].value.replace(
+                ':5:', ':7:')
+        response, queries = self.get_compare()
+        self.assertEqual(queries, 1)
+        self.assertContains(response, 'id="number_of_goods">5<')
+
+        cookie = self.client.cookies[settings.CART_SUMMARY_COOKIE].value
+        self.client.logout()
+        self.client.cookies[settings.CART_SUMMARY_COOKIE] = cookie
+        response = self.client.get(reverse('compare'))
+        self.assertEqual(
+            response.cookies[settings.CART_SUMMARY_COOKIE].value, '')
+
+    @override_settings(CART_SUMMARY_COOKIE_AGE=0)
+    def test_cookie_disabled(self):
+        for _ in range(2):
+            response, queries = self.get_compare()
+            self.assertEqual(queries, 1)
+            self.assertNotIn(settings.CART_SUMMARY_COOKIE, response.cookies)
+
+
+class TestCartMerge(BaseConf):
+    def setUp(self) -> None:
+        self.request = self.client.request().wsgi_request
+        self.others = [
+            ProductOnShopModel.objects.create(
+                shop=self.shop, product=self.product, quantity=5,
+                price=Decimal(price), for_sale=True)
+            for price in ('2.50', '3', '4', '5')
+        ]
+
+    def merge(self, items):
+        cart = Cart(self.request)
+        for product, qty in items:
+            cart.add(product, qty)
+        with CaptureQueriesContext(connection) as queries:
+            merged = serv.CartMergeService.merge(self.request, self.user)
+        self.assertEqual(len(Cart(self.request)), 0)
+        return merged, len(queries)
+
+    def test_merge(self):
+        merged, queries = self.merge(
+            [(self.product_on_shop, 2), (self.others[0], 2)])
+        self.assertEqual(merged, 2)
+        merged, many_queries = self.merge(
+            [(self.product_on_shop, 1)] +
+            [(product, 2) for product in self.others[1:]])
+        self.assertEqual(merged, 4)
+        # Число запросов не зависит от количества позиций
+        self.assertEqual(many_queries, queries)
+
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.quantity, 12)
+        self.assertEqual(self.cart.total_price, Decimal('69'))
+        self.assertEqual(
+            list(self.cart.products.values_list('product', 'quantity')),
+            [(self.product_on_shop.pk, 4)] +
+            [(product.pk, 2) for product in self.others])
+
+    def test_merge_ignores_orphan_lines(self):
+        orphan = CartProductModel.objects.create(
+            product=self.others[0], user=self.user, quantity=7,
+            price=Decimal(21))
+        self.merge([(self.others[0], 2)])
+        self.assertEqual(
+            list(self.cart.products.values_list('product', 'quantity')),
+            [(self.product_on_shop.pk, 1), (self.others[0].pk, 2)])
+        self.assertFalse(orphan.cart.exists())
+
+    def test_merge_without_cart(self):
+        self.cart.status = 'completed'
+        self.cart.save()
+        self.assertEqual(self.merge([]), (0, 0))
+        deleted = self.others[-1]
+        cart = Cart(self.request)
+        cart.add(deleted, 1)
+        deleted.delete()
+        self.merge([(product, 1) for product in self.others[:-1]])
+        cart = CartModel.objects.get(user=self.user, status='actively')
+        self.assertEqual(cart.quantity, 3)
+        self.assertEqual(cart.total_price, Decimal('9.50'))
+
+    def test_login(self):
+        user = User.objects.create_user(
+            username='buyer', email='buyer@mail.ru', slug='buyer', phone='77',
+            password='Admin123aa')
+        for product in self.others[:2]:
+            self.client.get(reverse('add_cart_product'), {
+                'primary_product_shop_id': product.pk, 'amount': 2})
+        response = self.client.post(reverse('login'), {
+            'email': 'buyer@mail.ru', 'password': 'Admin123aa'})
+        self.assertEqual(response.status_code, 302)
+        cart = CartModel.objects.get(user=user, status='actively')
+        self.assertEqual(cart.quantity, 4)
+        self.assertEqual(cart.products.count(), 2)
+        self.assertNotIn(settings.CART_SESSION_ID, self.client.session)
+        # Резерв переходит к пользователю, а не создается повторно
+        self.assertEqual(
+            StockReservationModel.objects.filter(user=user).aggregate(
+                Sum('quantity'))['quantity__sum'], 4)
+        self.others[0].refresh_from_db()
+        self.assertEqual(self.others[0].quantity, 3)
+
+
+class TestCartBatch(BaseConf):
+    def setUp(self) -> None:
+        self.others = [
+            ProductOnShopModel.objects.create(
+                shop=self.shop, product=self.product, quantity=5,
+                price=Decimal(price), for_sale=True)
+            for price in ('3', '4', '5')
+        ]
+        self.operations = [
+            {'action': 'add', 'id': self.others[0].pk, 'quantity': 2},
+            {'action': 'add', 'id': self.product_on_shop.pk},
+            {'action': 'set', 'id': self.others[1].pk, 'quantity': 3},
+            {'action': 'remove', 'id': self.others[1].pk},
+            {'action': 'add', 'id': self.others[2].pk, 'quantity': 10},
+            {'action': 'add', 'id': 999999},
+        ]
+
+    def post(self, operations):
+        return self.client.post(
+            reverse('cart_batch'), {'operations': operations},
+            content_type='application/json')
+
+    def get_stock(self):
+        return [
+            product.quantity for product in ProductOnShopModel.objects.filter(
+                pk__in=[product.pk for product in self.others])
+        ]
+
+    def test_user_cart(self):
+        self.client.force_login(self.user)
+        response = self.post(self.operations)
+        self.assertEqual(response.json(), {
+            'items': [
+                {'id': self.product_on_shop.pk, 'quantity': 2,
+                 'price': '20.00'},
+                {'id': self.others[0].pk, 'quantity': 2, 'price': '5.70'},
+            ],
+            'quantity': 4,
+            'total_price': '25.70',
+            'errors': [
+                {'id': 999999, 'error': 'not_found'},
+                {'id': self.others[2].pk, 'error': 'not_enough'},
+            ],
+        })
+        self.assertEqual(self.get_stock(), [3, 5, 5])
+        self.assertEqual(serv.CartTotalsService.reconcile(), 0)
+
+        response = self.post([
+            {'action': 'add', 'id': self.others[0].pk, 'quantity': -1},
+            {'action': 'remove', 'id': self.product_on_shop.pk},
+        ])
+        self.assertEqual(response.json()['items'], [
+            {'id': self.others[0].pk, 'quantity': 1, 'price': '2.85'}])
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.quantity, self.cart.total_price),
+                         (1, Decimal('2.85')))
+        self.assertEqual(self.get_stock(), [4, 5, 5])
+        self.product_on_shop.refresh_from_db()
+        self.assertEqual(self.product_on_shop.quantity, 1)
+
+    def test_session_cart(self):
+        response = self.post(self.operations[:5])
+        state = response.json()
+        self.assertEqual(state['items'], [
+            {'id': self.others[0].pk, 'quantity': 2, 'price': '5.70'},
+            {'id': self.product_on_shop.pk, 'quantity': 1, 'price': '9.50'},
+        ])
+        self.assertEqual((state['quantity'], state['total_price']),
+                         (3, '15.20'))
+        self.assertEqual(self.client.session[settings.CART_SESSION_ID], {
+            'items': [[self.others[0].pk, 2, 285],
+                      [self.product_on_shop.pk, 1, 950]],
+            'count': 3, 'total': 1520})
+        self.assertEqual(StockReservationModel.objects.filter(
+            session_key=self.client.session.session_key).count(), 2)
+
+        state = self.post([
+            {'action': 'set', 'id': self.others[0].pk, 'quantity': 1}
+        ]).json()
+        self.assertEqual((state['quantity'], state['total_price']),
+                         (2, '12.35'))
+        self.assertEqual(self.get_stock(), [4, 5, 5])
+
+    def test_invalid(self):
+        for operations in ([], [{'action': 'buy', 'id': 1}],
+                           [{'action': 'set', 'id': 1, 'quantity': -1}],
+                           [{'id': 1}], 'add'):
+            response = self.post(operations)
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('cart_batch'), 'null',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class TestStockReservation(BaseConf):
+    def setUp(self) -> None:
+        self.owner = {'user': self.user}
+        ProductOnShopModel.objects.filter(
+            pk=self.product_on_shop.pk).update(quantity=5)
+
+    def get_stock(self):
+        return ProductOnShopModel.objects.get(pk=self.product_on_shop.pk)\
+            .quantity
+
+    def test_reserve_and_release(self):
+        service = serv.StockReservationService
+        self.assertTrue(service.reserve(self.product_on_shop, 3, self.owner))
+        self.assertFalse(service.reserve(self.product_on_shop, 3, self.owner))
+        self.assertTrue(service.reserve(self.product_on_shop, 1, self.owner))
+        self.assertEqual(self.get_stock(), 1)
+        reservation = StockReservationModel.objects.get()
+        self.assertEqual(reservation.quantity, 4)
+
+        self.assertEqual(service.release(self.product_on_shop, self.owner, 1),
+                         1)
+        self.assertEqual(self.get_stock(), 2)
+        # Возвращается не больше зарезервированного
+        self.assertEqual(service.release(self.product_on_shop, self.owner),
+                         3)
+        self.assertEqual(service.release(self.product_on_shop, self.owner),
+                         0)
+        self.assertEqual(self.get_stock(), 5)
+        self.assertFalse(StockReservationModel.objects.exists())
+
+    def test_assign_to_user_merges_reservations(self):
+        service = serv.StockReservationService
+        session = {'session_key': 'session'}
+        self.assertFalse(service.reserve(self.product_on_shop, 0, self.owner))
+        self.assertFalse(service.reserve(self.product_on_shop, -2, session))
+        self.assertEqual(self.get_stock(), 5)
+        self.assertTrue(service.reserve(self.product_on_shop, 1, self.owner))
+        self.assertTrue(service.reserve(self.product_on_shop, 1, session))
+        self.assertEqual(service.assign_to_user('session', self.user), 1)
+        reservation = StockReservationModel.objects.get()
+        self.assertEqual(reservation.quantity, 2)
+        self.assertTrue(service.reserve(self.product_on_shop, 1, self.owner))
+        self.assertEqual(self.get_stock(), 2)
+        self.assertEqual(service.release(self.product_on_shop, self.owner),
+                         3)
+        self.assertEqual(self.get_stock(), 5)
+
+    def test_ensure_reserved(self):
+        service = serv.StockReservationService
+        for _ in range(2):
+            self.assertEqual(service.ensure_reserved(self.cart, self.owner),
+                             set())
+            self.assertEqual(self.get_stock(), 4)
+        # Резерв истек, а вернувшийся товар купили
+        StockReservationModel.objects.update(expires_at=timezone.now())
+        service.release_expired()
+        ProductOnShopModel.objects.filter(
+            pk=self.product_on_shop.pk).update(quantity=0)
+        self.assertEqual(service.ensure_reserved(self.cart, self.owner),
+                         {self.product_on_shop.pk})
+
+        self.client.force_login(self.user)
+        with mock.patch.object(serv.PaymentService, 'order_payment') as pay:
+            response = self.client.post(reverse('create_payment'),
+                                        {'card_number': '12345678'})
+        pay.assert_not_called()
+        self.assertContains(response, 'Недостаточно товара')
+
+    def test_release_expired(self):
+        service = serv.StockReservationService
+        service.reserve(self.product_on_shop, 2, self.owner)
+        service.reserve(self.product_on_shop, 1, {'session_key': 'key'})
+        StockReservationModel.objects.filter(session_key='key').update(
+            expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(service.release_expired(), 1)
+        self.assertEqual(self.get_stock(), 3)
+        self.assertEqual(StockReservationModel.objects.get().quantity, 2)
+
+    def test_assign_and_commit(self):
+        service = serv.StockReservationService
+        service.reserve(self.product_on_shop, 2, {'session_key': 'key'})
+        self.assertEqual(service.assign_to_user('key', self.user), 1)
+        self.assertEqual(StockReservationModel.objects.get().user, self.user)
+        self.assertEqual(service.commit(self.owner), 1)
+        self.assertEqual(self.get_stock(), 3)
+
+    def test_add_to_cart_reserves_stock(self):
+        response = self.client.get(reverse('add_cart_product'), {
+            'primary_product_shop_id': self.product_on_shop.pk,
+            'amount': 6})
+        self.assertIn('message_1', response.json()['data'])
+        self.client.get(reverse('add_cart_product'), {
+            'primary_product_shop_id': self.product_on_shop.pk,
+            'amount': 2})
+        self.assertEqual(self.get_stock(), 3)
+        reservation = StockReservationModel.objects.get()
+        self.assertEqual(reservation.session_key,
+                         self.client.session.session_key)
+
+
+class TestStockReservationConcurrency(TransactionTestCase):
+    def setUp(self) -> None:
+        file = FilesModel.objects.create(file=SimpleUploadedFile(
+            name='small.jpg', content=b'GIF89a', content_type='image/jpg'))
+        category = CategoryModel.objects.create(
+            name='telefons', slug='telefons', icon=file)
+        product = ProductModel.objects.create(
+            model='telefon', category=category, slug='telefon',
+            is_active=True)
+        shop = ShopModel.objects.create(
+            name='shop', description='shop', phone='1', email='s@mail.ru',
+            slug='shop', image=file)
+        self.product_on_shop = ProductOnShopModel.objects.create(
+            shop=shop, product=product, quantity=5, price=Decimal(10),
+            for_sale=True)
+
+    # Повтор попытки безопасен, только если все запросы резервирования
+    # выполняются в одной транзакции, поэтому сброс кэша отключен
+    @mock.patch.object(serv.StockReservationService, 'stock_changed')
+    def test_parallel_reserve(self, stock_changed):
+        threads_count = 10
+        barrier = threading.Barrier(threads_count)
+        results = []
+
+        def reserve(number):
+            try:
+                barrier.wait()
+                while True:
+                    try:
+                        results.append(serv.StockReservationService.reserve(
+                            self.product_on_shop.pk, 1,
+                            {'session_key': f'session{number}'}))
+                        break
+                    except OperationalError:
+                        # SQLite в памяти не ждет снятия блокировки записи,
+                        # как другие СУБД, а сразу возвращает ошибку
+                        time.sleep(0.01)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=reserve, args=(number,))
+            for number in range(threads_count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count(True), 5)
+        self.product_on_shop.refresh_from_db()
+        self.assertEqual(self.product_on_shop.quantity, 0)
+        self.assertEqual(
+            StockReservationModel.objects.aggregate(
+                total=Sum('quantity'))['total'], 5)
+
+
 class TestReview(BaseConf):
     @classmethod
     def setUpClass(cls) -> object:
@@ -229,6 +954,103 @@ class TestReview(BaseConf):
         self.assertEqual(reviews[0].review, 'Норм')
         count = self.serv_review.get_review_count(self.product)
         self.assertEqual(count, 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.review_count, 1)
+        reviews[0].delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.review_count, 0)
+
+    def test_review_count_active(self):
+        review = ReviewModel.objects.create(
+            product=self.product, user=self.user, review='a')
+        ReviewModel.objects.create(
+            product=self.product, user=self.user, review='b',
+            is_active=False)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.review_count, 1)
+        review.is_active = False
+        review.save()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.review_count, 0)
+        review.is_active = True
+        review.save()
+        review.review = 'c'
+        review.save()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.review_count, 1)
+
+        # Счетчик существующей базы заполняется командой
+        ProductModel.objects.update(review_count=0)
+        out = StringIO()
+        call_command('recount_reviews', stdout=out)
+        self.assertIn('Recounted products', out.getvalue())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.review_count, 1)
+
+
+class TestProductPageService(BaseConf):
+    def setUp(self) -> None:
+        clear_caches()
+
+    def add_offer(self, slug, price):
+        shop = ShopModel.objects.create(
+            name=slug, description=slug, phone=slug, email=f'{slug}@mail.ru',
+            slug=slug, image=self.file)
+        return ProductOnShopModel.objects.create(
+            shop=shop, product=self.product, quantity=1, price=price,
+            for_sale=True)
+
+    def test_build_page(self):
+        with self.assertNumQueries(5):
+            page = serv.ProductPageService.build_page(self.product.pk, 2)
+        self.assertEqual(page['review_count'], 0)
+        self.assertEqual(len(page['offers']), 1)
+
+        # Число запросов не зависит от количества данных
+        cheap = self.add_offer('cheap', Decimal(5))
+        self.add_offer('other', Decimal(20))
+        for i in range(3):
+            ReviewModel.objects.create(
+                product=self.product, user=self.user, review=f'review{i}')
+        ReviewModel.objects.create(
+            product=self.product, user=self.user, review='hidden',
+            is_active=False)
+        for name in ('a', 'b'):
+            TagsModel.objects.create(name=name, product=self.product)
+        with self.assertNumQueries(5):
+            page = serv.ProductPageService.build_page(self.product.pk, 2)
+        self.assertEqual(page['tags'], ['a', 'b'])
+        self.assertEqual(page['review_count'], 3)
+        self.assertEqual(
+            [review['review'] for review in page['reviews']],
+            ['review0', 'review1'])
+        self.assertEqual(len(page['offers']), 3)
+        (price, discount), offer = page['min_price']
+        self.assertEqual(offer, {
+            'id': cheap.pk, 'pk': cheap.pk, 'price': Decimal(5),
+            'shop': {'id': cheap.shop_id, 'name': 'cheap', 'slug': 'cheap'}})
+        self.assertEqual(price, Decimal('4.75'))
+        self.assertEqual(discount, {
+            'id': self.discount.pk, 'percent_discount': Decimal(5),
+            'value_discount': self.discount.value_discount})
+        # В кэш попадают только простые данные
+        self.assertEqual(
+            set(page['reviews'][0]), {'review', 'add_datetime', 'user'})
+        self.assertEqual(
+            set(page['reviews'][0]['user']), {'first_name', 'last_name'})
+
+    def test_get_page(self):
+        product = serv.CachedDataService.get_product('telefon')
+        serv.ProductPageService.get_page(product)
+        with self.assertNumQueries(0):
+            serv.ProductPageService.get_page(product)
+        with self.captureOnCommitCallbacks(execute=True):
+            ReviewModel.objects.create(
+                product=self.product, user=self.user, review='new')
+        page = serv.ProductPageService.get_page(product, all_reviews=True)
+        self.assertEqual(page['review_count'], 1)
+        self.assertEqual(
+            serv.ProductPageService.get_page(product)['review_count'], 1)
 
 
 class TestCatalogService(BaseConf):
@@ -243,3 +1065,646 @@ class TestCatalogService(BaseConf):
         self.assertEqual(products.first(), self.product)
         self.assertEqual(category, self.category)
         self.assertEqual(shop.first(), self.shop)
+
+    def test_sort_product(self):
+        self.assertEqual(
+            self.serv_catalog.get_sort_mode('-price'), '-price')
+        self.assertEqual(
+            self.serv_catalog.get_sort_mode('description'), 'popular')
+        products = self.serv_catalog.sort_product(
+            ProductModel.objects.all(), 'description')
+        self.assertEqual(products.query.order_by, ('-view_count', '-id'))
+
+    def test_facets(self):
+        clear_caches()
+        color = CharacteristicNameModel.objects.create(name='color')
+        black = CharacteristicModel.objects.create(
+            name=color, value=ValueModel.objects.create(value='black'))
+        white = CharacteristicModel.objects.create(
+            name=color, value=ValueModel.objects.create(value='white'))
+        self.product.characteristics.add(black)
+        product = ProductModel.objects.create(
+            model='smartfon', category=self.category, slug='smartfon',
+            code='smartfon', manufacturer='acme', is_active=True)
+        product.characteristics.add(white)
+        ProductOnShopModel.objects.create(
+            shop=self.shop, product=product, quantity=0,
+            price=Decimal(100), for_sale=True)
+
+        filters = self.serv_catalog.get_filters(
+            QueryDict(f'characteristic={white.pk}&stock=on'))
+        self.assertEqual(filters['characteristic'], [[white.pk]])
+        products = self.serv_catalog.get_products('telefons')
+        self.assertFalse(
+            self.serv_catalog.apply_filters(products, filters).exists())
+        filters['stock'] = False
+        self.assertEqual(
+            list(self.serv_catalog.apply_filters(products, filters)),
+            [product])
+
+        with self.assertNumQueries(6):
+            facets = serv.CatalogFacetService.get_facets(
+                self.category, products, filters)
+        self.assertEqual(facets['total'], 1)
+        self.assertEqual(facets['in_stock'], 0)
+        self.assertEqual(facets['manufacturers'], [('acme', 1)])
+        self.assertEqual(facets['shops'], [('sitilink', 1)])
+        # Фасет характеристики не учитывает собственный фильтр
+        self.assertEqual(facets['characteristics'], [
+            ('color', [(black.pk, 'black', 1), (white.pk, 'white', 1)])])
+        self.assertEqual(facets['price']['min'], 100)
+        with self.assertNumQueries(0):
+            serv.CatalogFacetService.get_facets(
+                self.category, products, filters)
+
+        product.manufacturer = 'other'
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        facets = serv.CatalogFacetService.get_facets(
+            self.category, products, filters)
+        self.assertEqual(facets['manufacturers'], [('other', 1)])
+
+        # Предложения товаров другой категории фасеты не сбрасывают
+        other_category = CategoryModel.objects.create(
+            name='other', slug='other', icon=self.file)
+        other = ProductModel.objects.create(
+            model='other', category=other_category, slug='other',
+            code='other', is_active=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductOnShopModel.objects.create(
+                shop=self.shop, product=other, quantity=1,
+                price=Decimal(1), for_sale=True)
+        with self.assertNumQueries(0):
+            serv.CatalogFacetService.get_facets(
+                self.category, products, filters)
+        offer = ProductOnShopModel.objects.get(product=product)
+        offer.quantity = 1
+        with self.captureOnCommitCallbacks(execute=True):
+            offer.save()
+        facets = serv.CatalogFacetService.get_facets(
+            self.category, products, filters)
+        self.assertEqual(facets['in_stock'], 1)
+
+    def test_price_facet(self):
+        for slug, price in (('a', '20'), ('b', '49.9'), ('c', None)):
+            ProductModel.objects.create(
+                model=slug, category=self.category, slug=slug, code=slug,
+                is_active=True)
+            ProductModel.objects.filter(slug=slug).update(
+                final_price=price and Decimal(price))
+        products = ProductModel.objects.filter(category=self.category)
+        filters = self.serv_catalog.get_filters(QueryDict(''))
+        with self.assertNumQueries(2):
+            facet = serv.CatalogFacetService.get_price_facet(
+                products, filters)
+        self.assertEqual(facet, {
+            'min': 9, 'max': 50,
+            'buckets': [(9, 17, 1), (17, 25, 1), (41, 50, 1)]})
+
+        facet = serv.CatalogFacetService.get_price_facet(
+            products.filter(final_price=None), filters)
+        self.assertEqual(facet, {'min': 0, 'max': 0, 'buckets': []})
+
+
+class TestSearch(BaseConf):
+    def test_stem(self):
+        self.assertEqual(stem('телефоны'), stem('телефон'))
+        self.assertEqual(stem('черная'), stem('черный'))
+        self.assertEqual(stem('phones'), 'phone')
+        self.assertEqual(stem('x100'), 'x100')
+
+    def test_search_products(self):
+        product = ProductModel.objects.create(
+            model='Смартфон Ёлка', description='Черный телефон',
+            category=self.category, slug='smartfon', code='A-100',
+            manufacturer='Acme', is_active=True)
+        other = ProductModel.objects.create(
+            model='Телефон', category=self.category, slug='phone',
+            code='B-200', is_active=True)
+
+        def search(query):
+            return list(search_products(query))
+
+        self.assertEqual(search('смартфоны'), [product])
+        self.assertEqual(search('елка'), [product])
+        # Слова ищутся по началу и в любом порядке
+        self.assertEqual(search('смарт'), [product])
+        self.assertEqual(search('черный тел'), [product])
+        self.assertEqual(search('тел черн'), [product])
+        # Совпадение в названии важнее совпадения в описании
+        self.assertEqual(search('телефоны'), [other, product])
+        self.assertEqual(search('a 100'), [product])
+        self.assertEqual(search(''), [])
+
+        # Индекс обновляется при изменении товара, тегов и характеристик
+        TagsModel.objects.create(name='гаджет', product=other)
+        self.assertEqual(search('гаджеты'), [other])
+        characteristic = CharacteristicModel.objects.create(
+            name=CharacteristicNameModel.objects.create(name='color'),
+            value=ValueModel.objects.create(value='white'))
+        product.characteristics.add(characteristic)
+        self.assertEqual(search('white'), [product])
+        value = characteristic.value
+        value.value = 'green'
+        value.save()
+        self.assertEqual(search('white'), [])
+        self.assertEqual(search('green'), [product])
+        product.is_active = False
+        product.save()
+        self.assertEqual(search('смартфон'), [])
+
+
+class TestSearchCache(BaseConf):
+    def setUp(self) -> None:
+        clear_caches()
+
+    def test_query_key(self):
+        self.assertEqual(get_query_key('Черный  Смартфон'),
+                         get_query_key('смартфоны ЧЁРНЫЕ'))
+        self.assertNotEqual(get_query_key('смартфон'),
+                            get_query_key('смартфон черный'))
+        self.assertEqual(get_search_ids('  '), [])
+
+    def test_search_ids(self):
+        product = ProductModel.objects.create(
+            model='Смартфон', category=self.category, slug='smartfon',
+            code='A-100', is_active=True)
+        self.assertEqual(get_search_ids('смартфоны'), [product.pk])
+        # Запрос с другим написанием берется из кэша
+        with self.assertNumQueries(0):
+            self.assertEqual(get_search_ids(' СМАРТФОН '), [product.pk])
+
+        # Изменение товара или индекса сбрасывает кэш
+        with self.captureOnCommitCallbacks(execute=True):
+            other = ProductModel.objects.create(
+                model='Смартфон Про', category=self.category,
+                slug='smartfon-pro', code='A-200', is_active=True)
+        self.assertEqual(get_search_ids('смартфон'), [other.pk, product.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            TagsModel.objects.create(name='подарок', product=product)
+        self.assertEqual(get_search_ids('подарок'), [product.pk])
+
+        stats = {item['key']: item for item in get_query_stats()}
+        item = stats[get_query_key('смартфон')]
+        self.assertEqual((item['count'], item['hits']), (3, 1))
+        self.assertEqual(item['query'], 'смартфон')
+
+    def test_warm_up(self):
+        product = ProductModel.objects.create(
+            model='Смартфон', category=self.category, slug='smartfon',
+            code='A-100', is_active=True)
+        get_search_ids('смартфон')
+        clear_caches()
+        get_search_ids('смартфон')
+        caches['pages'].clear()
+        self.assertEqual(warm_up_searches(), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_search_ids('смартфон'), [product.pk])
+        self.assertEqual(get_query_stats()[0]['count'], 2)
+
+    def test_trim_query_log(self):
+        for query in ('телефон', 'телефон', 'планшет', 'ноутбук'):
+            get_search_ids(query)
+        self.assertEqual(trim_query_log(1), 2)
+        self.assertEqual(
+            [item['key'] for item in get_query_stats()],
+            [get_query_key('телефон')])
+        redis = get_redis_connection(settings.SEARCH_LOG_CACHE_ALIAS)
+        keys = get_log_keys()
+        self.assertEqual(redis.hkeys(keys['time']),
+                         [get_query_key('телефон').encode()])
+        self.assertEqual(trim_query_log(1), 0)
+
+    def test_search_view(self):
+        products = [
+            ProductModel.objects.create(
+                model=f'Смартфон {i}', category=self.category,
+                slug=f'smartfon{i}', code=f'A-{i}', is_active=True)
+            for i in range(3)
+        ]
+        response = self.client.get(reverse('search_products'), {'q': 'смарт'})
+        self.assertEqual(response.context['paginator'].count, 3)
+        self.assertEqual(response.context['object_list'], products[::-1])
+
+
+@override_settings(SUGGEST_CHECK_INTERVAL=0)
+class TestSuggestions(BaseConf):
+    def setUp(self) -> None:
+        clear_caches()
+
+    def test_suggest(self):
+        product = ProductModel.objects.create(
+            model='Смартфон Ёлка', category=self.category, slug='smartfon',
+            code='A-100', manufacturer='Acme', is_active=True, view_count=5)
+        index = SuggestionIndex()
+        index.load()
+        with self.assertNumQueries(0):
+            result = index.suggest('елк смар')
+        self.assertEqual(result['products'],
+                         [(product.pk, 'Смартфон Ёлка', 'smartfon')])
+        self.assertEqual(index.suggest('tel')['categories'],
+                         [(self.category.pk, 'telefons', 'telefons')])
+        self.assertEqual(index.suggest('ac')['manufacturers'],
+                         [('Acme', 'Acme', 'Acme')])
+        self.assertEqual(index.suggest('a')['products'], [])
+
+        # Изменения применяются из журнала без полной перестройки
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            product.model = 'Планшет'
+            product.manufacturer = 'Other'
+            product.save()
+            TagsModel.objects.create(name='гаджет', product=self.product)
+            # До фиксации транзакции журнал не меняется
+            self.assertEqual(index.suggest('смартфон')['products'],
+                             [(product.pk, 'Смартфон Ёлка', 'smartfon')])
+        self.assertTrue(callbacks)
+        with self.assertNumQueries(3):
+            result = index.suggest('смартфон')
+        self.assertEqual(result['products'], [])
+        self.assertEqual(index.suggest('гадж')['products'],
+                         [(self.product.pk, 'telefon', 'telefon')])
+        self.assertEqual(index.suggest('acme')['manufacturers'], [])
+
+        # После обрезки журнала индекс строится заново
+        SuggestionIndex.get_redis().delete(
+            SuggestionIndex.make_key(SuggestionIndex.log_key))
+        product.model = 'Ноутбук'
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertEqual(index.suggest('ноут')['products'],
+                         [(product.pk, 'Ноутбук', 'smartfon')])
+
+        # Ошибка Redis не ломает подсказки
+        with mock.patch.object(SuggestionIndex, 'get_redis',
+                               side_effect=RedisError):
+            self.assertEqual(index.suggest('ноут')['products'],
+                             [(product.pk, 'Ноутбук', 'smartfon')])
+
+    def test_suggestions_view(self):
+        response = self.client.get(
+            reverse('search_suggestions'), {'q': 'tele'})
+        self.assertEqual(response.json()['products'], [
+            {'name': 'telefon', 'url': reverse('good_details',
+                                               args=['telefon'])}])
+
+
+class TestKeysetPagination(BaseConf):
+    def setUp(self) -> None:
+        clear_caches()
+
+    def test_paginate(self):
+        for i in range(4):
+            product = ProductModel.objects.create(
+                model=f'telefon{i}', category=self.category,
+                slug=f'telefon{i}', code=f'code{i}', is_active=True,
+                view_count=i % 2)
+            ProductOnShopModel.objects.create(
+                shop=self.shop, product=product, quantity=1,
+                price=Decimal(20 + i), for_sale=True)
+        products, _, _ = serv.CatalogService.get_category_product('telefons')
+        for order in serv.CatalogService.sort_modes:
+            queryset = serv.CatalogService.sort_product(products, order)
+            expected = list(queryset)
+            pages = [serv.CatalogService.paginate(queryset, 2)]
+            while pages[-1].has_next():
+                with self.assertNumQueries(1):
+                    pages.append(serv.CatalogService.paginate(
+                        queryset, 2, pages[-1].next_page_number(),
+                        count=len(expected)))
+            self.assertEqual(
+                [product for page in pages for product in page], expected)
+            self.assertEqual(
+                [page.number for page in pages], [1, 2, 3])
+            self.assertEqual(pages[-1].paginator.num_pages, 3)
+            previous = serv.CatalogService.paginate(
+                queryset, 2, pages[-1].previous_page_number())
+            self.assertEqual(list(previous), list(pages[1]))
+            self.assertEqual(previous.number, 2)
+            self.assertTrue(previous.has_previous())
+            # Курсор другой сортировки открывает первую страницу
+            page = serv.CatalogService.paginate(
+                products.order_by('-id'), 2, pages[1].next_page_number())
+            self.assertEqual(page.number, 1)
+
+        page = serv.CatalogService.paginate(products, 2, 'broken')
+        self.assertEqual(page.number, 1)
+        self.assertFalse(page.has_previous())
+        with self.assertNumQueries(1):
+            self.assertEqual(page.paginator.count, 5)
+        page = serv.CatalogService.paginate(products, 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(page.paginator.count, 5)
+
+    def test_paginate_null_keys(self):
+        # У товаров без предложений final_price = NULL
+        for i in range(3):
+            ProductModel.objects.create(
+                model=f'empty{i}', category=self.category,
+                slug=f'empty{i}', code=f'empty{i}', is_active=True)
+        product = ProductModel.objects.create(
+            model='telefon1', category=self.category, slug='telefon1',
+            code='code1', is_active=True)
+        ProductOnShopModel.objects.create(
+            shop=self.shop, product=product, quantity=1,
+            price=Decimal(20), for_sale=True)
+        products = ProductModel.objects.filter(category=self.category)
+        self.assertEqual(products.filter(final_price=None).count(), 3)
+        for order in ('price', '-price'):
+            queryset = serv.CatalogService.sort_product(products, order)
+            pages = [serv.CatalogService.paginate(queryset, 2)]
+            while pages[-1].has_next():
+                pages.append(serv.CatalogService.paginate(
+                    queryset, 2, pages[-1].next_page_number()))
+            result = [product for page in pages for product in page]
+            self.assertEqual(len(result), 5)
+            self.assertEqual(len(set(result)), 5)
+            # Товары без цены выводятся в конце
+            self.assertEqual(
+                [product.final_price is None for product in result],
+                [False, False, True, True, True])
+            self.assertEqual(len(pages), 3)
+            previous = serv.CatalogService.paginate(
+                queryset, 2, pages[-1].previous_page_number())
+            self.assertEqual(list(previous), list(pages[1]))
+            previous = serv.CatalogService.paginate(
+                queryset, 2, previous.previous_page_number())
+            self.assertEqual(list(previous), list(pages[0]))
+
+
+class TestHomePageService(BaseConf):
+    @classmethod
+    def setUpClass(cls) -> object:
+        super().setUpClass()
+        cls.serv_home = serv.HomePageService()
+
+    def setUp(self) -> None:
+        clear_caches()
+
+    def test_get_random_product(self):
+        self.assertIsNone(self.serv_home.get_random_product())
+        self.product.limited_edition = True
+        self.product.save()
+        clear_caches()
+        self.assertEqual(self.serv_home.get_random_product(), self.product)
+
+    def test_get_banners(self):
+        banners = [
+            BannerModel.objects.create(
+                name=f'banner{weight}', description='banner',
+                shop_product=self.product, weight=weight)
+            for weight in (0, 1, 10, 10)]
+        with self.assertNumQueries(2):
+            result = self.serv_home.get_banners()
+        self.assertEqual(len(set(result)), 3)
+        self.assertTrue(set(result) <= set(banners))
+        with self.assertNumQueries(1):
+            self.serv_home.get_banners()
+
+    def test_blocks(self):
+        self.serv_home.get_hot_offers()
+        with self.assertNumQueries(3):
+            blocks = self.serv_home.get_blocks_with_prices({
+                'top_products': self.serv_home.get_top_products(),
+                'hot_products': self.serv_home.get_hot_offers()})
+        expected = [
+            ((Decimal('9.50'), self.discount, self.product_on_shop.price),
+             self.product, self.product_on_shop.pk)]
+        self.assertEqual(blocks['top_products'], expected)
+        self.assertEqual(blocks['hot_products'], expected)
+
+    def test_main_page_queries(self):
+        self.product.limited_edition = True
+        self.product.save()
+        with CaptureQueriesContext(connection) as queries:
+            self.serv_home.warm_up_main_page(refresh_pools=True)
+        self.assertLessEqual(len(queries.captured_queries), 13)
+
+        # Прогретые блоки не пересобираются при запросе страницы
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['offer_of_day'], self.product)
+        marketplace_queries = [
+            query for query in queries.captured_queries
+            if 'app_marketplace' in query['sql']]
+        self.assertLessEqual(len(marketplace_queries), 2)
+
+
+class TestCachedDataService(BaseConf):
+    def setUp(self) -> None:
+        clear_caches()
+
+    def test_shop(self):
+        shop = serv.CachedDataService.get_shop('sitilink')
+        self.assertEqual(shop['name'], self.shop.name)
+        self.assertEqual(shop['image']['url'], self.file.file.url)
+        with self.assertNumQueries(0):
+            self.assertEqual(serv.CachedDataService.get_shop('sitilink'), shop)
+        self.assertIsNone(serv.CachedDataService.get_shop('unknown'))
+
+    def test_product(self):
+        product = serv.CachedDataService.get_product('telefon')
+        self.assertEqual(product['id'], self.product.pk)
+        self.assertEqual(product['characteristics'], [])
+        self.assertEqual(serv.CachedDataService.get_tags(product), [])
+        with self.assertNumQueries(0):
+            serv.CachedDataService.get_product('telefon')
+            serv.CachedDataService.get_tags(product)
+
+    def test_categories(self):
+        categories = serv.CachedDataService.get_categories()
+        self.assertEqual(categories[0]['slug'], self.category.slug)
+        self.assertEqual(categories[0]['image']['url'], self.file.file.url)
+        with self.assertNumQueries(0):
+            serv.CachedDataService.get_categories()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.save()
+        with self.assertNumQueries(2):
+            serv.CachedDataService.get_categories()
+
+    def test_cache_version(self):
+        serv.CachedDataService.get_shop('sitilink')
+        catalog = caches['catalog']
+        self.assertIsNotNone(catalog.get('shop:sitilink'))
+        # Ключи другой версии не видны
+        self.assertIsNone(
+            catalog.get('shop:sitilink', version=settings.CACHE_VERSION + 1))
+        self.assertIsNone(caches['pages'].get('shop:sitilink'))
+
+
+class TestProductViewCounter(BaseConf):
+    def setUp(self) -> None:
+        clear_caches()
+
+    def test_flush(self):
+        for _ in range(3):
+            serv.ProductViewCounterService.add_view(self.product.pk)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.view_count, 0)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(serv.ProductViewCounterService.flush(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.view_count, 3)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(serv.ProductViewCounterService.flush(), 0)
+        serv.ProductViewCounterService.add_view(self.product.pk)
+        serv.ProductViewCounterService.flush()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.view_count, 4)
+
+    def test_flush_lock_and_errors(self):
+        service = serv.ProductViewCounterService
+        cache = caches[service.cache_alias]
+        redis = get_redis_connection(service.cache_alias)
+        counter_key = cache.make_key(f'views:{self.product.pk}')
+        service.add_view(self.product.pk)
+        # Перенос, запущенный во время другого переноса, ничего не делает
+        cache.add(service.lock_key, 1)
+        self.assertEqual(service.flush(), 0)
+        cache.delete(service.lock_key)
+
+        with mock.patch.object(serv.ProductModel.objects, 'filter',
+                               side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                service.flush()
+        # Забранные просмотры возвращаются в счетчик
+        self.assertEqual(int(redis.get(counter_key)), 1)
+        self.assertIsNone(cache.get(service.lock_key))
+
+        self.assertEqual(service.flush(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.view_count, 1)
+        # Счетчики перенесенных товаров удаляются
+        self.assertFalse(redis.exists(counter_key))
+
+    def test_save_keeps_view_count(self):
+        product = ProductModel.objects.get(pk=self.product.pk)
+        serv.ProductViewCounterService.add_view(self.product.pk)
+        serv.ProductViewCounterService.flush()
+        # Сохранение загруженного ранее товара не затирает счетчик
+        product.model = 'smartphone'
+        product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.model, 'smartphone')
+        self.assertEqual(product.view_count, 1)
+
+    def test_product_page_view(self):
+        self.client.get('/product/telefon/')
+        self.client.get('/product/telefon/')
+        serv.ProductViewCounterService.flush()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.view_count, 2)
+
+
+class TestCacheInvalidation(BaseConf):
+    def setUp(self) -> None:
+        clear_caches()
+
+    def test_product_changes(self):
+        serv.CachedDataService.get_product('telefon')
+        catalog = caches['catalog']
+        # Изменение неотслеживаемого поля не сбрасывает кэш и не требует
+        # повторного чтения товара из базы
+        product = ProductModel.objects.get(pk=self.product.pk)
+        product.view_count += 1
+        with self.assertNumQueries(1):
+            product.save()
+        self.assertIsNotNone(catalog.get('product:telefon'))
+
+        product.model = 'smartphone'
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+            # До фиксации транзакции кэш не сбрасывается
+            self.assertIsNotNone(catalog.get('product:telefon'))
+        self.assertIsNone(catalog.get('product:telefon'))
+        self.assertEqual(
+            serv.CachedDataService.get_product('telefon')['model'],
+            'smartphone')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.gallery.add(self.file)
+        self.assertIsNone(catalog.get('product:telefon'))
+
+    def test_related_changes(self):
+        product = serv.CachedDataService.get_product('telefon')
+        serv.CachedDataService.get_tags(product)
+        get_or_set(
+            'product_on_shops:telefon', lambda: 1, 60, cache_alias='pages',
+            depends_on=[
+                dependency(ProductOnShopModel, product_id=self.product.pk)]
+        )
+        self.product_on_shop.price = Decimal(11)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product_on_shop.save()
+        self.assertIsNone(caches['pages'].get('product_on_shops:telefon'))
+        self.assertIsNotNone(caches['catalog'].get('tags:telefon'))
+        self.assertIsNotNone(caches['catalog'].get('product:telefon'))
+
+    def test_invalidate_many_caches(self):
+        deps = [dependency(ShopModel, self.shop.pk)]
+        get_or_set('a', lambda: 1, 60, cache_alias='pages', depends_on=deps)
+        get_or_set('b', lambda: 2, 60, cache_alias='catalog',
+                   depends_on=deps)
+        get_or_set('c', lambda: 3, 60, cache_alias='catalog')
+        invalidate(deps)
+        self.assertIsNone(caches['pages'].get('a'))
+        self.assertIsNone(caches['catalog'].get('b'))
+        self.assertIsNotNone(caches['catalog'].get('c'))
+
+
+class TestGetOrSet(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        cache_stats.reset()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return self.calls
+
+    def test_hit_and_miss(self):
+        self.assertEqual(get_or_set('key', self.compute, 60, beta=0), 1)
+        self.assertEqual(get_or_set('key', self.compute, 60, beta=0), 1)
+        self.assertEqual(self.calls, 1)
+        stats = cache_stats.as_dict()
+        self.assertEqual((stats['misses'], stats['hits']), (1, 1))
+
+    def test_stale_value(self):
+        set_value('key', 'old', -1)
+        # Пока другой процесс обновляет значение, отдается устаревшее
+        cache.add('lock:key', 1)
+        self.assertEqual(get_or_set('key', self.compute, 60), 'old')
+        self.assertEqual(cache_stats.as_dict()['stale'], 1)
+        cache.delete('lock:key')
+        self.assertEqual(get_or_set('key', self.compute, 60), 1)
+        self.assertEqual(cache_stats.as_dict()['refreshes'], 1)
+
+    @override_settings(CACHES={
+        alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': alias}
+        for alias in ('default', 'pages')
+    })
+    def test_locmem_dependencies(self):
+        deps = [dependency(ShopModel, 1)]
+        get_or_set('a', self.compute, 60, cache_alias='pages',
+                   depends_on=deps)
+        get_or_set('b', self.compute, 60, depends_on=deps + [
+            dependency(ShopModel, 2)])
+        get_or_set('c', self.compute, 60, depends_on=[
+            dependency(ShopModel, 2)])
+        invalidate(deps)
+        self.assertIsNone(caches['pages'].get('a'))
+        self.assertIsNone(caches['default'].get('b'))
+        self.assertIsNotNone(caches['default'].get('c'))
+
+    def test_wait_for_lock(self):
+        cache.add('lock:key', 1)
+        with self.settings(CACHE_LOCK_WAIT_TIME=0.1):
+            self.assertEqual(get_or_set('key', self.compute, 60), 1)
+        self.assertEqual(cache_stats.as_dict()['waits'], 1)
+
+    def test_no_timeout(self):
+        get_or_set('key', self.compute, 0)
+        self.assertEqual(get_or_set('key', self.compute, 0), 2)
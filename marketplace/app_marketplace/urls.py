@@ -32,8 +32,11 @@ urlpatterns = [
          name='add_cart_product'),
     path('change-cart-product/', views.DynamicChangeProductToCart.as_view(),
          name='change_cart_product'),
+    path('cart/batch/', views.CartBatchView.as_view(), name='cart_batch'),
     path('search_products/', SearchProductsView.as_view(),
          name='search_products'),
+    path('search_products/suggestions/',
+         views.SearchSuggestionsView.as_view(), name='search_suggestions'),
     path('contact/', TemplateView.as_view(
         template_name="app_marketplace/contact.html"), name='contact'),
 ]
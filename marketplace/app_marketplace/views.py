@@ -1,9 +1,8 @@
 from django.contrib import messages
 from django.contrib.auth.mixins import UserPassesTestMixin, LoginRequiredMixin
 from django.contrib.auth.models import AnonymousUser
-from django.core.cache import cache
 from django.db.models import Q, Count
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponseRedirect
 from django.http import JsonResponse
 from django.shortcuts import render
 from django.template.loader import render_to_string
@@ -15,24 +14,31 @@ from app_marketplace.forms import (
     CreateOrderPaymentForm, CreatePaymentForm
 )
 from app_marketplace.models import (
-    ShopModel, ProductOnShopModel, BannerModel, ProductModel, CartModel,
-    TagsModel, CartProductModel, User, OrderModel, DiscountModel,
+    ShopModel, ProductOnShopModel, ProductModel, CartModel,
+    CartProductModel, User, OrderModel, DiscountModel,
     CategoryModel
 )
 from app_marketplace.services import (
-    HomePageService, CatalogService, AddCommentToProductService,
-    AddItemToCart, GetDiscountsForProductsService, ComparedProductsListService,
-    AddLookedProductsService, PaymentService
+    HomePageService, CatalogService, CatalogFacetService,
+    AddCommentToProductService, AddItemToCart, GetDiscountsForProductsService,
+    ComparedProductsListService, AddLookedProductsService, PaymentService,
+    CachedDataService, ProductPageService, ProductViewCounterService,
+    StockReservationService, CartBatchService
 )
+from app_marketplace.pagination import KeysetPaginationMixin
+from app_marketplace.search import get_search_ids
+from app_marketplace.suggestions import suggestion_index
 from app_marketplace.utils import clear_cache
 from app_users.views import RegistrationView
 from marketplace import settings
 from .cart import Cart
+import json
 import random
 from django.utils import timezone
 from datetime import date, timedelta
+from urllib.parse import urlencode
 
-cached_time = settings.CACHED_TIME
+cached_time = settings.PAGES_CACHE_TIME
 
 
 class MainPageView(TemplateView):
@@ -41,157 +47,14 @@ class MainPageView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        category = CategoryModel.objects.all().select_related().filter(
-            is_active=True)[:3]
-
-        # Устанавливаем кэш для баннеров
-        if 'banners' not in cache:
-            banner_list = BannerModel.objects.select_related(
-                'shop_product').filter(is_active=True).order_by('?')[:3]
-            cache.set('banners', banner_list, cached_time)
-        else:
-            banner_list = cache.get('banners')
-
-        # Устанавливаем кэш для товара "Предложения дня"
-        offer_of_day_price = None
-        if 'offer_of_day' not in cache:
-            offer_of_day = HomePageService.get_random_product()
-            if offer_of_day:
-                cache.set('offer_of_day', offer_of_day, cached_time)
-                offer_of_day_price, discount = \
-                    GetDiscountsForProductsService.get_discount_price(
-                        product=offer_of_day, price=offer_of_day.min_price)
-                if discount:
-                    cache.set('offer_of_day_price', offer_of_day_price,
-                              cached_time)
-        else:
-            offer_of_day = cache.get('offer_of_day')
-            offer_of_day_price = cache.get('offer_of_day_price')
-
-        # Устанавливаем кэш для популярных товаров
-        top_products = None
-        if 'top_products' not in cache:
-            top_goods_list = HomePageService.get_top_products()
-            if all(top_goods_list.values()):
-                top_products = []
-                for product, product_on_shop in top_goods_list.items():
-                    discount_price, discount = \
-                        GetDiscountsForProductsService.get_discount_price(
-                            product=product, price=product_on_shop.price
-                        )
-                    if discount:
-                        top_products.append(
-                            ((discount_price, discount, product_on_shop.price),
-                             product,
-                             product_on_shop.pk)
-                        )
-                    else:
-                        top_products.append(
-                            ((product_on_shop.price, None, None),
-                             product,
-                             product_on_shop.pk)
-                        )
-                cache.set('top_products', top_products, cached_time)
-                del top_goods_list
-        else:
-            top_products = cache.get('top_products')
-
-        # Устанавливаем кэш для товаров со скидкой ("Горячие предложения")
-        hot_products = None
-        if 'hot_products' not in cache:
-            hot_products_list = HomePageService.get_hot_offers()
-            if len(hot_products_list):
-                hot_products = []
-                for product, product_on_shop in hot_products_list.items():
-                    discount_price, discount = \
-                        GetDiscountsForProductsService.get_discount_price(
-                            product=product, price=product_on_shop.price
-                        )
-                    if discount:
-                        hot_products.append(
-                            (
-                                (
-                                    discount_price,
-                                    discount,
-                                    product_on_shop.price
-                                ),
-                                product,
-                                product_on_shop.pk
-                            )
-                        )
-                    else:
-                        hot_products.append(
-                            (
-                                (
-                                    product_on_shop.price,
-                                    None,
-                                    None
-                                ),
-                                product,
-                                product_on_shop.pk
-                            )
-                        )
-                cache.set('hot_products', hot_products, cached_time)
-                del hot_products_list
-        else:
-            hot_products = cache.get('hot_products')
-
-        # Устанавливаем кэш для товаров с ограниченным тиражом
-        limited_products = None
-        if 'limited_products' not in cache:
-            if offer_of_day:
-                limited_products_list = HomePageService.get_limited_products(
-                    offer_of_day
-                )
-                if len(limited_products_list):
-                    limited_products = []
-                    for product, product_on_shop in \
-                            limited_products_list.items():
-                        discount_price, discount = \
-                            GetDiscountsForProductsService.get_discount_price(
-                                product=product, price=product_on_shop.price
-                            )
-                        if discount:
-                            limited_products.append(
-                                (
-                                    (
-                                        discount_price,
-                                        discount,
-                                        product_on_shop.price
-                                    ),
-                                    product,
-                                    product_on_shop.pk
-                                )
-                            )
-                        else:
-                            limited_products.append(
-                                (
-                                    (
-                                        product_on_shop.price,
-                                        None,
-                                        None
-                                    ),
-                                    product,
-                                    product_on_shop.pk
-                                )
-                            )
-                    cache.set(
-                        'limited_products', limited_products, cached_time
-                    )
-                    del limited_products_list
-        else:
-            limited_products = cache.get('limited_products')
+
+        # Блоки главной страницы заранее собираются периодической задачей
+        blocks = HomePageService.get_main_page_blocks()
 
         today = date.today() + timedelta(days=2)
         today = today.strftime("%d.%m.%Y")
 
-        context['banner_list'] = banner_list
-        context['home_categories'] = category
-        context['offer_of_day'] = offer_of_day
-        context['offer_of_day_price'] = offer_of_day_price
-        context['top_products'] = top_products
-        context['hot_products'] = hot_products
-        context['limited_products'] = limited_products
+        context.update(blocks)
         context['date'] = today
         return context
 
@@ -216,30 +79,26 @@ class ShopDetailView(DetailView):
     template_name = 'app_marketplace/shop_details.html'
     context_object_name = 'shop'
 
-    def get_queryset(self):
-        # Устанавливаем кэш для текущего магазина
-        shop_cache_key = 'shop:{}'.format(self.kwargs['slug'])
-        if shop_cache_key not in cache:
-            queryset = ShopModel.objects.filter(
-                slug=self.kwargs['slug']
-            ).select_related('image')
-            cache.set(shop_cache_key, queryset, cached_time)
-        else:
-            queryset = cache.get(shop_cache_key)
-        return queryset
+    def get_object(self, queryset=None):
+        # Данные магазина берутся из кэша
+        shop = CachedDataService.get_shop(self.kwargs['slug'])
+        if shop is None:
+            raise Http404
+        return shop
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data()
         shop_products = ProductOnShopModel.objects.filter(
-            product__is_active=True, shop=context.get('shop'), for_sale=True
+            product__is_active=True, shop=context['shop']['id'],
+            for_sale=True
         ).select_related('product').order_by('-product__view_count')[:10]
+        discount_prices = GetDiscountsForProductsService.get_discount_prices(
+            (shop_product, shop_product.price)
+            for shop_product in shop_products
+        )
         shop_products_discount_prices = [
-            GetDiscountsForProductsService.get_discount_price(
-                product=shop_product.product,
-                price=shop_product.price
-            )
-            if len(GetDiscountsForProductsService.get_discounts(
-                shop_product.product)) else (None, None)
+            discount_prices[shop_product]
+            if discount_prices[shop_product][1] else (None, None)
             for shop_product in shop_products
         ]
         context['shop_products'] = list(
@@ -266,25 +125,22 @@ class ProductDetailView(DetailView):
     template_name = 'app_marketplace/product_details.html'
     context_object_name = 'product'
 
-    def get_queryset(self):
-        # Устанавливаем кэш для текущего товара
-        product_cache_key = 'product:{}'.format(self.kwargs['slug'])
-        if product_cache_key not in cache:
-            queryset = ProductModel.objects.filter(
-                is_active=True, slug=self.kwargs['slug']
-            ).select_related('main_image').prefetch_related('characteristics')
-            cache.set(product_cache_key, queryset, cached_time)
-        else:
-            queryset = cache.get(product_cache_key)
-        return queryset
+    def get_object(self, queryset=None):
+        # Данные товара берутся из кэша
+        product = CachedDataService.get_product(self.kwargs['slug'])
+        if product is None:
+            raise Http404
+        return product
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data()
+        product_data = context['product']
+        # Товар для запросов к связанным моделям без обращения к базе
+        product = ProductModel(pk=product_data['id'])
 
-        # Увеличиваем количество просмотров текущего товара
-        product = context.get('product', None)
-        product.view_count += 1
-        product.save(update_fields=['view_count'])
+        # Учитываем просмотр текущего товара в кэше, в базу данных
+        # просмотры переносятся задачей flush_product_views
+        ProductViewCounterService.add_view(product.pk)
 
         # Добавляем товар в список просмотренных товаров
         user = self.request.user
@@ -293,95 +149,17 @@ class ProductDetailView(DetailView):
                 user=user, product=product
             )
 
-        # Устанавливаем кэш для тэгов текущего товара
-        tags_cache_key = 'tags:{}'.format(self.kwargs['slug'])
-        if tags_cache_key not in cache:
-            context['tags'] = TagsModel.objects.filter(product=product)
-            cache.set(tags_cache_key, context['tags'], cached_time)
-        else:
-            context['tags'] = cache.get(tags_cache_key)
-
-        # Устанавливаем кэш для количества отзывов для текущего товара
-        count_comments_cache_key = 'count_comments:{}'.format(
-            self.kwargs['slug']
-        )
-        if count_comments_cache_key not in cache:
-            context['count_comments'] = \
-                AddCommentToProductService.get_review_count(product=product)
-            cache.set(
-                count_comments_cache_key,
-                context['count_comments'],
-                cached_time
-            )
-        else:
-            context['count_comments'] = cache.get(count_comments_cache_key)
-
-        # Устанавливаем кэш для отзывов для текущего товара
-        all_comments_cache_key = 'all_comments_cache_key:{}'.format(
-            self.kwargs['slug']
+        # Теги, отзывы и предложения магазинов собираются фиксированным
+        # числом запросов и кэшируются вместе
+        page = ProductPageService.get_page(
+            product_data, all_reviews='rewShowMore' in self.request.GET
         )
-        comments_cache_key = 'comments_cache_key:{}'.format(
-            self.kwargs['slug']
-        )
-        if 'rewShowMore' in self.request.GET:
-            if all_comments_cache_key not in cache:
-                comments = AddCommentToProductService().get_review_list(
-                    product=product
-                )
-                cache.set(all_comments_cache_key, comments, cached_time)
-                context['comments'] = comments
-            else:
-                context['comments'] = cache.get(all_comments_cache_key)
-        else:
-            if comments_cache_key not in cache:
-                comments = AddCommentToProductService().get_review_list(
-                    product=product, count=2
-                )
-                cache.set(comments_cache_key, comments, cached_time)
-                context['comments'] = comments
-            else:
-                context['comments'] = cache.get(comments_cache_key)
-
-        # Устанавливаем кэш для списка с текущим товаром с данными о
-        # продаже в разных магазинах
-        product_on_shops_cache_key = 'product_on_shops:{}'.format(
-            self.kwargs['slug']
-        )
-        min_price_cache_key = 'min_price_cache_key:{}'.format(
-            self.kwargs['slug']
-        )
-        if product_on_shops_cache_key not in cache:
-            min_price = 0
-
-            # Получаем данные из базы
-            product_on_shops = ProductOnShopModel.objects.filter(
-                product=product, for_sale=True, quantity__gt=0
-            ).select_related('shop', 'product')
-
-            # Если товар продается, актуализируем цену с учетом скидок
-            if len(product_on_shops):
-                product_on_shops = [
-                    (
-                        GetDiscountsForProductsService.get_discount_price(
-                            product=product.product, price=product.price
-                        )
-                        if product.product.discounts.exists() else (
-                            product.price, None), product
-                    )
-                    for product in product_on_shops
-                ]
-                min_price = min(product_on_shops, key=lambda elem: elem[0][0])
-                cache.set(
-                    product_on_shops_cache_key, product_on_shops, cached_time
-                )
-                cache.set(min_price_cache_key, min_price, cached_time)
-        else:
-            product_on_shops = cache.get(product_on_shops_cache_key)
-            min_price = cache.get(min_price_cache_key)
-
-        context['product_on_shops'] = product_on_shops
-        context['min_price'] = min_price
-        context['title'] = product.model
+        context['tags'] = page['tags']
+        context['count_comments'] = page['review_count']
+        context['comments'] = page['reviews']
+        context['product_on_shops'] = page['offers']
+        context['min_price'] = page['min_price']
+        context['title'] = product_data['model']
         return context
 
     def post(self, request, *args, **kwargs):
@@ -399,10 +177,12 @@ class ProductDetailView(DetailView):
             )
         if 'compare' in request.POST.keys():
             product_on_shop_id = request.POST.get('compare')
-            if product_on_shop_id.isdigit():
+            product = ProductModel.objects.filter(
+                is_active=True, **kwargs).first()
+            if product_on_shop_id.isdigit() and product:
                 return ComparedProductsListService.add_item_to_cookies(
                     request=request,
-                    product=self.get_object(),
+                    product=product,
                     product_on_shop_id=product_on_shop_id
                 )
         return HttpResponseRedirect(redirect_to=request.path)
@@ -425,31 +205,30 @@ class DynamicAddProductToCart(View):
             shop_product = ProductOnShopModel.objects.filter(
                 id=primary_product_shop_id).select_related(
                 'shop', 'product')[0]
-            amount = int(amount)
-            if amount <= shop_product.quantity:
-                quantity = amount
-            elif amount == 1:
+            quantity = int(amount) if amount and amount.isdigit() else 0
+            if quantity < 1:
                 return JsonResponse(
-                    {'data': {'message_1': 'Товара нет в наличии'}}
-                )
-            else:
-                return JsonResponse(
-                    {
-                        'data': {
-                            'message_1': 'Недостаточно товара.'
-                                         ' Попробуйте уменьшить количество.'
-                        }
-                    }
-                )
+                    {'data': {'message_1': 'Неверное количество товара.'}})
+            # Товар резервируется сразу, чтобы его не купили одновременно
+            if not StockReservationService.reserve(
+                    shop_product, quantity,
+                    StockReservationService.get_owner(request)):
+                if quantity == 1:
+                    message = 'Товара нет в наличии'
+                else:
+                    message = 'Недостаточно товара.' \
+                              ' Попробуйте уменьшить количество.'
+                return JsonResponse({'data': {'message_1': message}})
 
         # Если данные поступили от второго скрипта
         # (добавление товара через список во вкладке "Продавцы")
         elif shop_product_id is not None:
             shop_product = ProductOnShopModel.objects.filter(
                 id=shop_product_id).select_related('shop', 'product')[0]
-            if shop_product.quantity > 0:
-                quantity = 1
-            else:
+            quantity = 1
+            if not StockReservationService.reserve(
+                    shop_product, quantity,
+                    StockReservationService.get_owner(request)):
                 return JsonResponse(
                     {'data': {'message_2': 'Товара нет в наличии'}}
                 )
@@ -460,54 +239,16 @@ class DynamicAddProductToCart(View):
         discount_price = GetDiscountsForProductsService().get_discount_price(
             product=shop_product.product, price=shop_product.price)[0]
 
-        # Проверяем, добавлен ли текущий товар у данного пользователя в корзину
         if not isinstance(user, AnonymousUser):
-            # Ищем корзину текущего пользователя
-            cart = CartModel.objects.filter(
-                user=user, status='actively').prefetch_related('products')
-
-            if not len(cart):  # Если нет корзины - создаем
-                cart = CartModel.objects.create(user=user, status='actively')
-            else:
-                cart = cart[0]
-
-            # Проверяем, если в корзине модель CartProduct с текущим
-            # товаром из магазина
-            product_in_cart = cart.products.filter(product=shop_product)
-
-            # Если нет - создаем экземпляр класса CartProduct с
-            # текущим товаром магазина
-            if not len(product_in_cart):
-                cart_product = CartProductModel.objects.create(
-                    user=user, product=shop_product,
-                    quantity=quantity, price=discount_price
-                )
-                # Добавляем товар в корзину
-                AddItemToCart.add_item_to_cart(
-                    cart=cart, product=cart_product,
-                    amount=quantity, price=discount_price
-                )
-            else:
-                # Если создан, то увеличиваем количество на соответствующее
-                # значение и цену модели CartProduct
-                cart_product = product_in_cart[0]
-                cart_product.quantity += quantity
-                cart_product.price = cart_product.quantity * discount_price
-                cart_product.save(update_fields=['quantity', 'price'])
-
-                # Увеличиваем количество товара и цену в корзине
-                AddItemToCart.increasing_the_number_of_items_in_the_cart(
-                    cart=cart, amount=quantity, price=discount_price
-                )
+            # Позиция и итоги корзины меняются атомарно
+            cart = AddItemToCart.add_product(
+                user=user, product=shop_product, amount=quantity,
+                price=discount_price
+            )
             number_of_goods = cart.quantity
         else:
             cart = Cart(request)
-            if amount is not None:
-                cart.add(
-                    product=shop_product, qty=amount, price=discount_price
-                )
-            else:
-                cart.add(product=shop_product, qty=1, price=discount_price)
+            cart.add(product=shop_product, qty=quantity, price=discount_price)
             number_of_goods = cart.__len__()
 
         # Передаем количество товара в корзине на страницу
@@ -519,6 +260,24 @@ class DynamicAddProductToCart(View):
         }})
 
 
+class CartBatchView(View):
+    """
+    Пакетное изменение корзины по ajax-запросу. Тело запроса - JSON
+     {"operations": [{"action": "add" | "set" | "remove", "id": id товара
+      магазина, "quantity": количество}, ...]}, ответ - новое состояние
+       корзины (см. CartBatchService).
+    """
+
+    @staticmethod
+    def post(request):
+        try:
+            operations = CartBatchService.parse(
+                json.loads(request.body)['operations'])
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({'error': 'Неверные данные'}, status=400)
+        return JsonResponse(CartBatchService.apply(request, operations))
+
+
 class DynamicChangeProductToCart(View):
     """Класс динамического изменения товара в корзине по ajax-запросам."""
 
@@ -594,13 +353,15 @@ class CompareView(View):
                     products_on_shops.append((product, product_on_shop))
 
             # Актуализируем цену сравниваемых товаров с учетом скидок
+            discount_prices = \
+                GetDiscountsForProductsService.get_discount_prices(
+                    (product_on_shop, product_on_shop.price)
+                    for _, product_on_shop in products_on_shops
+                )
             compare_list = []
             for product, product_on_shop in products_on_shops:
-
-                if len(GetDiscountsForProductsService.get_discounts(product)):
-                    discount_price = \
-                        GetDiscountsForProductsService.get_discount_price(
-                            product=product, price=product_on_shop.price)[0]
+                discount_price, discount = discount_prices[product_on_shop]
+                if discount:
                     compare_list.append(
                         (
                             discount_price,
@@ -733,71 +494,66 @@ class CategoryCatalogView(ListView):
     template_name = 'app_marketplace/catalog.html'
     ordering = ['view_count']
 
-    def get_context_data(self, *args, **kwargs):
-        context = super().get_context_data(**kwargs)
-        products_list, category, shop = CatalogService().get_category_product(
+    def get_queryset(self):
+        products, self.category, _ = CatalogService.get_category_product(
             self.kwargs['slug']
         )
-        if products_list:
-            price_list = self.request.GET.get('price', None)
-            filter_shop = self.request.GET.get('shop', None)
-            filter_stock = self.request.GET.get('stock', None)
-            filter_manufacturer = self.request.GET.getlist('manufacturer',
-                                                           None)
-            products_list = CatalogService().filter_product(
-                products_list, price_list, filter_shop, filter_stock,
-                filter_manufacturer)
-            manufacturer_list = [product.manufacturer for product in
-                                 products_list]
-            manufacturers = set(manufacturer_list)
-            manufacturers = sorted(list(manufacturers))
-            page = self.request.GET.get('page')
-            order = self.request.GET.get('ordering', 'view_count')
-            products_list = CatalogService().sort_product(products_list, order)
-            products = CatalogService().paginate(
-                products_list, self.paginate_by, page
-            )
+        self.filters = CatalogService.get_filters(self.request.GET)
+        self.facets = CatalogFacetService.get_facets(
+            self.category,
+            CatalogService.get_products(self.kwargs['slug']),
+            self.filters
+        )
+        self.order = CatalogService.get_sort_mode(
+            self.request.GET.get('ordering')
+        )
+        products = CatalogService.apply_filters(products, self.filters)
+        return CatalogService.sort_product(
+            products, self.order
+        ).select_related('main_image').prefetch_related('discounts')
+
+    def paginate_queryset(self, queryset, page_size):
+        # Количество товаров уже посчитано фасетами
+        page = CatalogService.paginate(
+            queryset, page_size, self.request.GET.get('page'),
+            count=self.facets['total']
+        )
+        return page.paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(**kwargs)
+        facets = self.facets
+        if facets['total']:
             get_copy = self.request.GET.copy()
-            if get_copy.get('page'):
-                get_copy.pop('page')
-            elif get_copy.get('ordering'):
-                get_copy.pop('ordering')
-            elif get_copy.get('add_compare_list'):
-                get_copy.pop('add_compare_list')
+            # Курсор страницы действителен только для своей сортировки
+            for name in ('page', 'ordering', 'add_compare_list'):
+                get_copy.pop(name, None)
             context['get_copy'] = get_copy
-            context['product_paginate'] = products
-
-            if len(products):
-                products = [
-                    (
-                        GetDiscountsForProductsService.get_discount_price(
-                            product=product, price=product.min_price)[0] if
-                        product.discounts.exists() else product.min_price,
-                        product) for product in products
-                ]
-                min_price = min(product[0] for product in products)
-                max_price = max(product[0] for product in products)
-                context['products'] = products
-                context['min_price'] = int(min_price)
-                context['max_price'] = int(max_price)
-
-            price_list = self.request.GET.get('price', None)
-            filter_shop = self.request.GET.get('shop', None)
-
-            if price_list:
-                prices = price_list.split(';')
-                min_filter_price = int(prices[0])
-                max_filter_price = int(prices[-1])
-                context['min_filter_price'] = min_filter_price
-                context['max_filter_price'] = max_filter_price
-
-            context['price_list'] = price_list
-            context['filter_shop'] = filter_shop
-            context['manufacturers'] = manufacturers
-            context['shops'] = shop
-            context['category'] = category
-            context['orderby'] = order
-            return context
+            context['product_paginate'] = context['page_obj']
+            context['products'] = [
+                (product.discount_price, product)
+                for product in context['page_obj']
+            ]
+            context['min_price'] = facets['price']['min']
+            context['max_price'] = facets['price']['max']
+
+        price_list = self.request.GET.get('price', None)
+        if self.filters['price']:
+            context['min_filter_price'] = int(self.filters['price'][0])
+            context['max_filter_price'] = int(self.filters['price'][1])
+
+        context['price_list'] = price_list
+        context['filter_shop'] = self.filters['shop']
+        context['filters'] = self.filters
+        context['selected_characteristics'] = [
+            pk for group in self.filters['characteristic'] for pk in group
+        ]
+        context['facets'] = facets
+        context['manufacturers'] = facets['manufacturers']
+        context['shops'] = facets['shops']
+        context['category'] = self.category
+        context['orderby'] = self.order
+        return context
 
     def get(self, request, *args, **kwargs):
         self.object_list = self.get_queryset()
@@ -910,6 +666,10 @@ class CreateOrderDeliveryView(LoginRequiredMixin, View):
         if not order:
             order = OrderModel.objects.create(
                 cart=user_cart, status='actively')
+        # Товар с истекшим резервом мог быть продан другому покупателю
+        if StockReservationService.ensure_reserved(
+                user_cart, {'user': request.user}):
+            form.add_error(None, 'Недостаточно товара. Измените корзину.')
         if form.is_valid():
             type_delivery = form.cleaned_data['delivery_for_order']
 
@@ -1029,7 +789,7 @@ class CartView(View):
             return render(request, 'app_marketplace/cart.html', context)
 
 
-class DiscountsListView(ListView):
+class DiscountsListView(KeysetPaginationMixin, ListView):
     """
     Представление, отображающее список всех активных скидок,
      которые действуют хотя на один товар.
@@ -1120,7 +880,7 @@ class CreatePayment(FormView):
     success_url = '/'
 
     def get_context_data(self, **kwargs):
-        context = super(CreatePayment, self).get_context_data()
+        context = super(CreatePayment, self).get_context_data(**kwargs)
         user_cart = CartModel.objects.filter(
             user=self.request.user, status='actively'
         )
@@ -1134,6 +894,10 @@ class CreatePayment(FormView):
             user=self.request.user, status='actively'
         )
         order = OrderModel.objects.get(cart=user_cart[0], status='actively')
+        if StockReservationService.ensure_reserved(
+                user_cart[0], {'user': self.request.user}):
+            form.add_error(None, 'Недостаточно товара. Измените корзину.')
+            return self.form_invalid(form)
         PaymentService.order_payment(
             order=order, price=order.order_total_price, card_number=card_number
         )
@@ -1141,15 +905,53 @@ class CreatePayment(FormView):
 
 
 class SearchProductsView(generic.ListView):
+    """
+    Результаты поиска. Список id найденных товаров берется из кэша
+     результатов, страница выбирается срезом списка, из базы данных
+      загружаются только товары текущей страницы.
+    """
     model = ProductModel
     template_name = 'app_marketplace/search_products.html'
+    paginate_by = 8
 
     def get_queryset(self):
-        query = self.request.GET.get('q')
-        object_list = ProductModel.objects.filter(
-            Q(model__icontains=query) | Q(description__icontains=query)
+        return get_search_ids(self.request.GET.get('q', ''))
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator, page, ids, is_paginated = super().paginate_queryset(
+            queryset, page_size
         )
-        return object_list
+        products = ProductModel.objects.filter(
+            pk__in=ids, is_active=True
+        ).select_related('main_image').in_bulk()
+        page.object_list = [products[pk] for pk in ids if pk in products]
+        return paginator, page, page.object_list, is_paginated
+
+
+class SearchSuggestionsView(View):
+    """Подсказки поиска по введенному тексту в формате JSON."""
+
+    @staticmethod
+    def get(request):
+        suggestions = suggestion_index.suggest(request.GET.get('q', ''))
+        return JsonResponse({
+            'products': [
+                {'name': name,
+                 'url': reverse('good_details', kwargs={'slug': slug})}
+                for _, name, slug in suggestions['products']
+            ],
+            'categories': [
+                {'name': name,
+                 'url': reverse('catalog', kwargs={'slug': slug})}
+                for _, name, slug in suggestions['categories']
+            ],
+            'manufacturers': [
+                {'name': name,
+                 'url': '{}?{}'.format(
+                     reverse('search_products'), urlencode({'q': name}))}
+                for _, name, _ in suggestions['manufacturers']
+            ],
+        })
 
 
 class CategoryListView(ListView):
@@ -1157,6 +959,9 @@ class CategoryListView(ListView):
     template_name = 'app_marketplace/categories.html'
     context_object_name = 'categories'
 
+    def get_queryset(self):
+        return CachedDataService.get_categories()
+
 
 class ShopListView(ListView):
     model = ShopModel
@@ -8,13 +8,11 @@ from app_users.forms import LoginForm, RegistrationForm, EditProfileForm
 from app_users.models import User
 from app_marketplace.services import (
     GetPurchaseHistoryService, AddLookedProductsService,
-    GetDiscountsForProductsService, AddItemToCart
-)
-from app_marketplace.models import (
-    ProductModel, CartProductModel, CartModel, OrderModel
+    EffectivePriceService, StockReservationService, CartMergeService
 )
+from app_marketplace.models import ProductModel, OrderModel
 from django.views.generic import DetailView, TemplateView, ListView
-from app_marketplace.cart import Cart
+from app_marketplace.pagination import KeysetPaginationMixin
 
 
 class LoginView(views.View):
@@ -35,34 +33,12 @@ class LoginView(views.View):
             password = form.cleaned_data['password']
             user = authenticate(email=email, password=password)
             if user:
+                session_key = request.session.session_key
                 login(request, user)
-                cart_session = Cart(request)
-                if cart_session.__len__() != 0:
-                    for product in cart_session:
-                        cart = CartModel.objects.filter(
-                            user=user, status='actively').prefetch_related(
-                            'products').first()
-                        obj, created = \
-                            CartProductModel.objects.update_or_create(
-                                product=product['product'], user=user)
-                        if created:
-                            AddItemToCart().add_item_to_cart(
-                                cart=cart,
-                                product=obj,
-                                amount=product['quantity'],
-                                price=product['product'].price * product[
-                                    'quantity']
-                            )
-
-                        else:
-                            AddItemToCart().change_item_count_cart(
-                                request=request,
-                                product=obj.product,
-                                count=product['quantity']
-                            )
-
-                        cart_session.delete(product['product'])
-
+                # Товар, зарезервированный в сессии, остается за
+                # пользователем
+                StockReservationService.assign_to_user(session_key, user)
+                CartMergeService.merge(request, user)
                 return HttpResponseRedirect('/')
         context = {
             'form': form
@@ -137,14 +113,13 @@ class AccountView(DetailView):
                 'product_on_shop__price', output_field=IntegerField()
             ),
             max_price=Max(
-                'product_on_shop__price', output_field=IntegerField())
+                'product_on_shop__price', output_field=IntegerField()),
+            discount_price=EffectivePriceService.get_min_price_annotation()
         ).filter(id__in=products_list)
 
         if len(products_on_shops):
             product_on_shops = [
-                (GetDiscountsForProductsService.get_discount_price(
-                    product=product, price=product.min_price)[0]
-                 if product.discounts.exists() else product.min_price, product)
+                (product.discount_price, product)
                 for product in products_on_shops
             ]
 
@@ -206,14 +181,13 @@ class ProductHistoryView(TemplateView):
                 'product_on_shop__price', output_field=IntegerField()
             ),
             max_price=Max(
-                'product_on_shop__price', output_field=IntegerField())
+                'product_on_shop__price', output_field=IntegerField()),
+            discount_price=EffectivePriceService.get_min_price_annotation()
         ).filter(id__in=products_list)
 
         if len(products_on_shops):
             product_on_shops = [
-                (GetDiscountsForProductsService.get_discount_price(
-                    product=product, price=product.min_price)[0]
-                 if product.discounts.exists() else product.min_price, product)
+                (product.discount_price, product)
                 for product in products_on_shops
             ]
 
@@ -222,11 +196,12 @@ class ProductHistoryView(TemplateView):
         return context
 
 
-class OrderHistoryView(ListView):
+class OrderHistoryView(KeysetPaginationMixin, ListView):
     """История заказов пользователя."""
     model = OrderModel
     template_name = 'app_users/order_history_list.html'
     context_object_name = 'order_list'
+    paginate_by = 10
 
     def get_queryset(self):
         qs = super().get_queryset()
@@ -34,6 +34,8 @@ MIDDLEWARE = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'app_marketplace.middleware.DiscountScopeMiddleware',
+    'app_marketplace.middleware.CartSummaryMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     # 'debug_toolbar.middleware.DebugToolbarMiddleware',
     'author.middlewares.AuthorDefaultBackendMiddleware'
@@ -66,12 +68,72 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'marketplace.wsgi.application'
 
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+# Общий для всех процессов кэш в Redis. Каждый именованный кэш хранится в
+# своей базе Redis, поэтому очистка одного кэша не затрагивает остальные
+CACHE_REDIS_URL = config('CACHE_REDIS_URL', default='redis://localhost:6379')
+# Версия ключей всех кэшей: увеличение (например, при деплое) сбрасывает
+# все кэши сразу
+CACHE_VERSION = config('CACHE_VERSION', default=1, cast=int)
+# Версии ключей отдельных кэшей: увеличение сбрасывает только этот кэш
+CACHE_NAMESPACE_VERSIONS = {
+    'default': 1,
+    'pages': 1,
+    'catalog': 1,
+    'sessions': 1,
+    'counters': 1,
+}
+# Время жизни ключей именованных кэшей, сек. (None - без ограничения)
+DEFAULT_CACHE_TIME = 300
+PAGES_CACHE_TIME = 600
+CATALOG_CACHE_TIME = 600
+SESSIONS_CACHE_TIME = 60 * 60 * 24 * 14
+COUNTERS_CACHE_TIME = None
+# Время кэширования количества строк для постраничного вывода, сек.
+PAGINATION_COUNT_CACHE_TIME = 60
+# Подсказки поиска: кэш с журналом изменений индекса, размер журнала,
+# интервал проверки изменений процессом (сек.) и число подсказок каждого вида
+SUGGEST_CACHE_ALIAS = 'default'
+SUGGEST_LOG_SIZE = 1000
+SUGGEST_CHECK_INTERVAL = 5
+SUGGEST_LIMIT = 5
+# Поиск: время кэширования результатов (сек.), максимальное число товаров
+# в результате, кэш журнала запросов, число запросов, которые остаются в
+# журнале при обрезке, и число частых запросов, результаты которых
+# обновляются заранее
+SEARCH_CACHE_TIME = 120
+SEARCH_RESULTS_LIMIT = 1000
+SEARCH_LOG_CACHE_ALIAS = 'counters'
+SEARCH_LOG_SIZE = 10000
+SEARCH_WARM_UP_SIZE = 50
+
+CACHE_OPTIONS = {
+    'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+}
+
+
+def _redis_cache(name, db, timeout):
+    return {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': '{}/{}'.format(CACHE_REDIS_URL, db),
+        'TIMEOUT': timeout,
+        'KEY_PREFIX': '{}:{}'.format(name, CACHE_NAMESPACE_VERSIONS[name]),
+        'VERSION': CACHE_VERSION,
+        'OPTIONS': CACHE_OPTIONS,
     }
+
+
+# База Redis 0 используется celery
+CACHES = {
+    'default': _redis_cache('default', 1, DEFAULT_CACHE_TIME),
+    'pages': _redis_cache('pages', 2, PAGES_CACHE_TIME),
+    'catalog': _redis_cache('catalog', 3, CATALOG_CACHE_TIME),
+    'sessions': _redis_cache('sessions', 4, SESSIONS_CACHE_TIME),
+    'counters': _redis_cache('counters', 5, COUNTERS_CACHE_TIME),
 }
 
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'sessions'
+
 if DEBUG:
     DATABASES = {
         'default': {
@@ -143,15 +205,30 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LOGOUT_REDIRECT_URL = '/'
 
-CACHED_TIME = 600
-SHOP_INFO_CACHE_TIME = 0
-CATEGORIES_CACHE_TIME = 0
+# Защита от одновременного пересчета кэша (app_marketplace.caching)
+CACHE_STALE_TIME = 60
+CACHE_LOCK_TIMEOUT = 10
+CACHE_LOCK_WAIT_TIME = 3
+# Кэш, в котором хранятся зависимости фрагментов кэша от моделей
+CACHE_DEPENDENCY_ALIAS = 'default'
+# Должно быть не меньше времени жизни любого фрагмента с зависимостями
+CACHE_DEPENDENCY_TIME = 60 * 60 * 24
+RANDOM_POOL_CACHE_TIME = 3600
+# Должно превышать интервал задачи warm_up_main_page
+MAIN_PAGE_CACHE_TIME = 900
 
 INTERNAL_IPS = [
     '127.0.0.1',
 ]
 
 CART_SESSION_ID = 'cart'
+# Подписанная cookie с количеством и суммой корзины; время жизни, сек.
+# (0 - итоги всегда берутся из базы данных)
+CART_SUMMARY_COOKIE = 'cart_summary'
+CART_SUMMARY_COOKIE_AGE = 60 * 60
+CART_SUMMARY_CACHE_ALIAS = 'sessions'
+# Время резервирования товара в корзине, сек.
+STOCK_RESERVATION_TIME = 60 * 30
 
 # celery
 CELERY_BROKER_URL = "redis://localhost:6379/0"
@@ -162,6 +239,30 @@ CELERY_BEAT_SCHEDULE = {
         "task": "app_marketplace.tasks.change_status_all_jobs",
         "schedule": crontab(minute="*/30"),
     },
+    "update_effective_prices": {
+        "task": "app_marketplace.tasks.update_effective_prices",
+        "schedule": crontab(minute="*/15"),
+    },
+    "warm_up_main_page": {
+        "task": "app_marketplace.tasks.warm_up_main_page",
+        "schedule": crontab(minute="*/5"),
+    },
+    "flush_product_views": {
+        "task": "app_marketplace.tasks.flush_product_views",
+        "schedule": crontab(minute="*"),
+    },
+    "flush_view_history": {
+        "task": "app_marketplace.tasks.flush_view_history",
+        "schedule": crontab(minute="*"),
+    },
+    "warm_up_searches": {
+        "task": "app_marketplace.tasks.warm_up_searches",
+        "schedule": crontab(minute="*/2"),
+    },
+    "release_expired_reservations": {
+        "task": "app_marketplace.tasks.release_expired_reservations",
+        "schedule": crontab(minute="*"),
+    },
 }
 IMPORT_EXPORT_CELERY_MODELS = {
     "ProductModel": {
@@ -0,0 +1,17 @@
+"""
+Настройки для запуска тестов:
+python manage.py test --settings=marketplace.test_settings
+"""
+from fakeredis import FakeConnection, FakeServer
+
+from .settings import *  # noqa: F401,F403
+from .settings import CACHES
+
+# Вместо Redis используется его локальная замена в памяти, общая для
+# всех кэшей
+CACHE_SERVER = FakeServer()
+for cache in CACHES.values():
+    cache['OPTIONS'] = dict(cache['OPTIONS'], CONNECTION_POOL_KWARGS={
+        'connection_class': FakeConnection,
+        'server': CACHE_SERVER,
+    })
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'marketplace.settings')
 
 application = get_wsgi_application()
+
+# Индекс подсказок поиска загружается при старте процесса
+from app_marketplace.suggestions import suggestion_index  # noqa: E402
+
+suggestion_index.warm_up()
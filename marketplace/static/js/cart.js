@@ -1,57 +1,73 @@
 $(document).ready(function () {
-    $('.Amount-remove').on('click', function () {
-        let shop_product_id = $(this.parentElement).attr('shop_product_id')
-        url_cart = $(this.parentElement).attr('href')
-        let data = {
-            shop_product_id: shop_product_id,
-            action: 'remove'
-        }
-
-        let count = parseInt($(`.Amount-input[shop_product_id="${shop_product_id}"]`).attr('value'))
+    // Нажатия копятся и отправляются одним запросом после паузы
+    const DEBOUNCE_TIME = 400
+    let pending = {}
+    let timer = null
+    let url_cart = null
 
-        if (count !== 0) {
-            $(`.Amount-input[shop_product_id="${shop_product_id}"]`).attr('value', `${count - 1}`)
-            if ($(`.error[shop_product_id="${shop_product_id}"]`).text() === 'Недостаточно товара') {
-                $(`.error[shop_product_id="${shop_product_id}"]`).text('')
-            } else {
-                change_count(data, url_cart)
-            }
+    function amount_input(shop_product_id) {
+        return $(`.Amount-input[shop_product_id="${shop_product_id}"]`)
+    }
 
+    function change_count(shop_product_id, delta) {
+        let input = amount_input(shop_product_id)
+        let count = parseInt(input.attr('value'))
+        // Товар убирается из корзины кнопкой удаления, а не количеством
+        if (count + delta < 1) {
+            return
         }
+        input.attr('value', `${count + delta}`)
+        $(`.error[shop_product_id="${shop_product_id}"]`).text('')
+        pending[shop_product_id] = (pending[shop_product_id] || 0) + delta
+        clearTimeout(timer)
+        timer = setTimeout(send_changes, DEBOUNCE_TIME)
+    }
+
+    $('.Amount-remove').on('click', function () {
+        url_cart = $(this.parentElement).attr('href')
+        change_count($(this.parentElement).attr('shop_product_id'), -1)
     });
 
     $('.Amount-add').on('click', function () {
-        let shop_product_id = $(this.parentElement).attr('shop_product_id')
         url_cart = $(this.parentElement).attr('href')
-        let data = {
-            shop_product_id: shop_product_id,
-            action: 'add'
-        }
-        let count = parseInt($(`.Amount-input[shop_product_id="${shop_product_id}"]`).attr('value'))
-        $(`.Amount-input[shop_product_id="${shop_product_id}"]`).attr('value', `${count + 1}`)
-
-        change_count(data, url_cart)
+        change_count($(this.parentElement).attr('shop_product_id'), 1)
     });
 
-    function change_count(params, url_cart) {
-        var csrftoken = getCookie('csrftoken');
+    function send_changes() {
+        let operations = []
+        for (let shop_product_id in pending) {
+            if (pending[shop_product_id] !== 0) {
+                operations.push({
+                    action: 'add',
+                    id: shop_product_id,
+                    quantity: pending[shop_product_id]
+                })
+            }
+        }
+        pending = {}
+        if (operations.length === 0) {
+            return
+        }
         $.ajax({
-            method: "GET",
+            method: "POST",
             dataType: "json",
-            data: params,
+            contentType: "application/json",
+            data: JSON.stringify({operations: operations}),
             url: url_cart,
-            headers: {'X-CSRFToken': csrftoken},
+            headers: {'X-CSRFToken': getCookie('csrftoken')},
             success: function (data) {
-                let shop_product_id = params['shop_product_id']
-                if (data['error'] === 'Недостаточно товара') {
-                    $(`.error[shop_product_id="${shop_product_id}"]`).text('Недостаточно товара')
-                    alert('Недостаточно товара')
-                    $(`.Amount-remove[shop_product_id="${shop_product_id}"]`).trigger("click")
-                } else {
-                    $("#total_price_cart").text(data['total_price'] + 'руб.')
-                    $(".CartBlock-price").text(data['total_price'] + 'руб.')
-                    $("#number_of_goods").text(data['quantity'])
+                // Количество на странице приводится к состоянию корзины
+                for (let item of data['items']) {
+                    amount_input(item['id']).attr('value', `${item['quantity']}`)
+                }
+                for (let error of data['errors']) {
+                    if (error['error'] === 'not_enough') {
+                        $(`.error[shop_product_id="${error['id']}"]`).text('Недостаточно товара')
+                    }
                 }
+                $("#total_price_cart").text(data['total_price'] + 'руб.')
+                $(".CartBlock-price").text(data['total_price'] + 'руб.')
+                $("#number_of_goods").text(data['quantity'])
             }
         })
     };
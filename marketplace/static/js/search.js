@@ -0,0 +1,26 @@
+$(document).ready(function () {
+    let input = $('#query')
+    let list = $('#search-suggestions')
+    let timer = null
+
+    input.on('input', function () {
+        clearTimeout(timer)
+        timer = setTimeout(function () {
+            let query = input.val()
+            if (query.length < 2) {
+                list.empty()
+                return
+            }
+            fetch(`${input.attr('suggest_url')}?q=${encodeURIComponent(query)}`)
+                .then(response => response.json())
+                .then(data => {
+                    list.empty()
+                    for (let kind of ['products', 'categories', 'manufacturers']) {
+                        for (let item of data[kind]) {
+                            list.append($('<option>').attr('value', item.name))
+                        }
+                    }
+                })
+        }, 150)
+    });
+});